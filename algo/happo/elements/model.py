@@ -74,12 +74,11 @@ class Model(MAModelBase):
     self.jit_action_logprob = jax.jit(self.action_logprob)
     self.jit_value = jax.jit(self.raw_value)
 
-  def action(self, data, evaluation):
+  def process_action_input(self, data):
     for d in data:
       if 'global_state' not in d:
         d.global_state = d.obs
-    action, stats, state = super().action(data, evaluation)
-    return action, stats, state
+    return data
 
   def raw_action(self, params, rng, data, evaluation=False):
     rngs = random.split(rng, self.n_groups)
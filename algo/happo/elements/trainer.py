@@ -11,10 +11,37 @@ from tools.log import do_logging
 from core.names import TRAIN_AXIS
 from core.elements.trainer import TrainerBase, create_trainer
 from core import optimizer
-from core.typing import AttrDict
+from core.typing import AttrDict, dict2AttrDict
+from tools.display import print_dict_info
 from tools.rms import RunningMeanStd
 from tools.utils import flatten_dict, prefix_name, yield_from_tree_with_indices
-from algo.ppo.elements.trainer import construct_fake_data
+
+
+def construct_fake_data(env_stats, aid):
+  b = 8
+  s = 400
+  u = len(env_stats.aid2uids[aid])
+  shapes = env_stats.obs_shape[aid]
+  dtypes = env_stats.obs_dtype[aid]
+  action_dim = env_stats.action_dim[aid]
+  basic_shape = (b, s, u)
+  data = {k: jnp.zeros((b, s+1, u, *v), dtypes[k]) 
+    for k, v in shapes.items()}
+  data = dict2AttrDict(data)
+  data.setdefault('global_state', data.obs)
+  data.action = jnp.zeros((*basic_shape, action_dim), jnp.float32)
+  data.value = jnp.zeros(basic_shape, jnp.float32)
+  data.reward = jnp.zeros(basic_shape, jnp.float32)
+  data.discount = jnp.zeros(basic_shape, jnp.float32)
+  data.reset = jnp.zeros(basic_shape, jnp.float32)
+  data.mu_logprob = jnp.zeros(basic_shape, jnp.float32)
+  data.mu_logits = jnp.zeros((*basic_shape, action_dim), jnp.float32)
+  data.advantage = jnp.zeros(basic_shape, jnp.float32)
+  data.v_target = jnp.zeros(basic_shape, jnp.float32)
+
+  print_dict_info(data)
+  
+  return data
 
 
 class Trainer(TrainerBase):
@@ -26,10 +26,10 @@ class Model(MAModelBase):
   def compile_model(self):
     self.jit_action = jax.jit(self.raw_action, static_argnames=('evaluation'))
 
-  def action(self, data, evaluation):
+  def process_action_input(self, data):
     if 'global_state' not in data:
       data.global_state = data.obs
-    return super().action(data, evaluation)
+    return data
 
   def raw_action(
     self, 
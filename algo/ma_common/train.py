@@ -2,6 +2,7 @@ import os
 import importlib
 import ray
 
+from core.ckpt.writer import AsyncCheckpointer
 from core.elements.builder import ElementsBuilder
 from core.names import ANCILLARY
 from core.typing import get_basic_model_name
@@ -15,6 +16,10 @@ from tools.pkg import get_package
 from algo.ma_common.run import Runner
 
 
+# writes checkpoints in the background
+checkpointer = AsyncCheckpointer('save')
+
+
 def init_running_stats(agents, runner: Runner, n_steps=None):
   if n_steps is None:
     n_steps = min(100, runner.env.max_episode_steps)
@@ -85,14 +90,16 @@ def eval_and_log(agents, runner: Runner, routine_config, record_video=False, nam
       })
       if video is not None:
         agent.video_summary(video, step=agent.get_env_step(), fps=1)
+  save(agents)
   for agent in agents:
-    save(agent)
     log(agent)
 
 
 @timeit
-def save(agent):
-  agent.save()
+def save(agents):
+  with checkpointer.save():
+    for agent in agents:
+      agent.save()
 
 
 @timeit
@@ -213,5 +220,6 @@ def main(configs, train=train, Runner=Runner):
 
   routine_config = config.routine.copy()
   train(agents, runner, routine_config)
+  checkpointer.wait()
 
   do_logging('Training completed', level='info')
@@ -49,21 +49,20 @@ class Model(MAModelBase):
               self.params.value[k][kk] = reset_weights(vv, rng, self.value_rnn_init)
 
   def compile_model(self):
-    self.jit_action = jax.jit(self.raw_action, static_argnames=('evaluation'))
+    super().compile_model()
     self.jit_value = jax.jit(self.raw_value)
 
-  def action(self, data, evaluation):
+  def process_action_input(self, data):
     if 'global_state' not in data:
       data.global_state = data.obs
-    action, stats, state = super().action(data, evaluation)
-    return action, stats, state
+    return data
 
   def raw_action(self, params, rng, data, evaluation=False):
     rngs = random.split(rng, 3)
     state = data.pop('state', AttrDict())
     # add the sequential dimension
     if self.has_rnn:
-      data = jax.tree_map(lambda x: jnp.expand_dims(x, 1), data)
+      data = jax.tree_util.tree_map(lambda x: jnp.expand_dims(x, 1), data)
     act_outs, state.policy = self.forward_policy(params.policy, rngs[0], data, state.policy)
     act_dists = self.policy_dist(act_outs, evaluation)
 
@@ -96,7 +95,7 @@ class Model(MAModelBase):
       stats.value = value
     if self.has_rnn:
       # squeeze the sequential dimension
-      action, stats = jax.tree_map(
+      action, stats = jax.tree_util.tree_map(
         lambda x: jnp.squeeze(x, 1), (action, stats))
     if state.policy is None and state.value is None:
       state = None
@@ -106,7 +105,7 @@ class Model(MAModelBase):
   def raw_value(self, params, rng, data):
     state = data.pop('state', AttrDict())
     if self.has_rnn:
-      data = jax.tree_map(lambda x: jnp.expand_dims(x, 1) , data)
+      data = jax.tree_util.tree_map(lambda x: jnp.expand_dims(x, 1) , data)
     v = self.forward_value(
       params, rng, data, state.value, return_state=False
     )
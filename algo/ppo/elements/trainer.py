@@ -10,37 +10,75 @@ from core.ckpt.pickle import save, restore
 from tools.log import do_logging
 from core.names import TRAIN_AXIS
 from core.elements.trainer import TrainerBase, create_trainer
+from core.jit import jit
 from core import optimizer
 from core.typing import AttrDict, dict2AttrDict
+from env.utils import get_action_mask
 from tools.display import print_dict_info
 from tools.rms import RunningMeanStd
 from tools.utils import flatten_dict, prefix_name, yield_from_tree_with_indices
 
 
-def construct_fake_data(env_stats, aid):
-  b = 8
-  s = 400
+def construct_fake_data(env_stats, aid, batch_size=8, seq_len=400, model=None):
+  """ Constructs a batch of training data with zeros
+  
+  Args:
+    model: if given, the RNN states and the statistics of the behavior 
+      policy are those of the model
+  """
+  b = batch_size
+  s = seq_len
   u = len(env_stats.aid2uids[aid])
   shapes = env_stats.obs_shape[aid]
   dtypes = env_stats.obs_dtype[aid]
   action_dim = env_stats.action_dim[aid]
+  action_shape = env_stats.action_shape[aid]
+  action_dtype = env_stats.action_dtype[aid]
+  use_action_mask = env_stats.use_action_mask[aid]
   basic_shape = (b, s, u)
-  data = {k: jnp.zeros((b, s+1, u, *v), dtypes[k]) 
+  data = {k: jnp.zeros((*basic_shape, *v), dtypes[k]) 
     for k, v in shapes.items()}
   data = dict2AttrDict(data)
   data.setdefault('global_state', data.obs)
-  data.action = jnp.zeros((*basic_shape, action_dim), jnp.float32)
-  data.value = jnp.zeros(basic_shape, jnp.float32)
+  data.action = AttrDict()
+  data.prev_info = AttrDict()
+  for k in action_dim.keys():
+    data.action[k] = jnp.zeros((*basic_shape, *action_shape[k]), action_dtype[k])
+    data.prev_info[k] = jnp.zeros((*basic_shape, action_dim[k]), jnp.float32)
+    if use_action_mask[k]:
+      data.action[f'{k}_mask'] = jnp.ones((*basic_shape, action_dim[k]), bool)
+  for k in list(shapes) + ['global_state', 'prev_info']:
+    data[f'next_{k}'] = data[k]
+  data.value = jnp.zeros((b, s+1, u), jnp.float32)
   data.reward = jnp.zeros(basic_shape, jnp.float32)
   data.discount = jnp.zeros(basic_shape, jnp.float32)
   data.reset = jnp.zeros(basic_shape, jnp.float32)
+  data.state_reset = jnp.zeros((b, s+1, u), jnp.float32)
   data.mu_logprob = jnp.zeros(basic_shape, jnp.float32)
-  data.mu_logits = jnp.zeros((*basic_shape, action_dim), jnp.float32)
-  data.advantage = jnp.zeros(basic_shape, jnp.float32)
-  data.v_target = jnp.zeros(basic_shape, jnp.float32)
+  if model is None:
+    for k in action_dim.keys():
+      data[f'{k}_mu_logits'] = jnp.zeros((*basic_shape, action_dim[k]), jnp.float32)
+    return data
+
+  state = model.get_initial_state(b)
+  if state is not None:
+    data.state = jax.tree_util.tree_map(
+      lambda x: jnp.zeros((b, s, *x.shape[1:]), x.dtype), state)
+  # statistics have the same structure as those recorded by runners
+  inp = AttrDict()
+  for k in list(shapes) + ['global_state', 'prev_info']:
+    inp[k] = jax.tree_util.tree_map(lambda x: x[:, 0], data[k])
+  inp.state_reset = data.state_reset[:, 0]
+  inp.action_mask = get_action_mask(
+    jax.tree_util.tree_map(lambda x: x[:, 0], data.action))
+  if state is not None:
+    inp.state = state
+  _, stats, _ = jax.eval_shape(
+    model.raw_action, model.params, random.PRNGKey(0), inp)
+  stats.pop('value', None)
+  for k, v in stats.items():
+    data[k] = jnp.zeros((b, s, *v.shape[1:]), v.dtype)
 
-  print_dict_info(data)
-  
   return data
 
 
@@ -71,14 +109,33 @@ class Trainer(TrainerBase):
       )
 
   def compile_train(self):
-    _jit_train = jax.jit(self.theta_train, static_argnames=['debug'])
+    _jit_train = jit(
+      self.theta_train, 
+      name=f'{self.name}_train', 
+      static_argnames='debug', 
+      max_traces=self.config.get('max_traces')
+    )
     def jit_train(*args, **kwargs):
       self.rng, rng = random.split(self.rng)
       return _jit_train(*args, rng=rng, **kwargs)
     self.jit_train = jit_train
+    self._jit_train = _jit_train
 
     self.haiku_tabulate()
 
+  def warmup(self, data: AttrDict=None):
+    """ Compiles jit_train ahead of time for the shapes of a minibatch """
+    if data is None:
+      batch_size = max(self.config.n_runners * self.config.n_envs // self.config.n_mbs, 1)
+      data = construct_fake_data(
+        self.env_stats, self.aid, batch_size, self.config.n_steps, model=self.model)
+    if self.config.popart:
+      data.popart_mean = self.popart.mean
+      data.popart_std = self.popart.std
+    theta = self.model.theta.copy()
+    return self._jit_train.warmup(
+      theta, self.rng, self.params.theta, data, debug=self.config.debug)
+
   def train(self, data: AttrDict):
     if self.config.n_runners * self.config.n_envs < self.config.n_mbs:
       self.indices = np.arange(self.config.n_mbs)
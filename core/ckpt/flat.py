@@ -0,0 +1,258 @@
+""" Flat parameter buffers
+
+A parameter tree is packed into one contiguous uint8 buffer in which
+every leaf starts at an ALIGNMENT-byte boundary. The layout, i.e., the
+treedef and the shape, dtype and offset of each leaf, is computed once
+per tree structure and reused, so packing a new version of the same
+parameters amounts to a memcpy per leaf and unpacking creates views into
+the buffer without copying. A buffer put in the Ray object store is
+thereby read by every process from shared memory.
+
+The same layout backs the checkpoint format. A checkpoint file consists
+of a magic string, the byte size of a JSON header, the header, and the
+packed array leaves starting at the first ALIGNMENT-byte boundary after
+the header. The header records the tree structure, the shape and dtype
+of every array, and Python scalars in place. Trees of dicts, lists and
+tuples are described in JSON; other containers, e.g., optimizer states,
+fall back to a pickled treedef. Files are written to a temporary path
+and renamed, so a checkpoint is either complete or absent, and restored
+through mmap, so arrays are only read from disk when accessed.
+"""
+import base64
+import json
+import mmap
+import os
+from typing import Any, List, Sequence
+import cloudpickle
+import numpy as np
+import jax.numpy as jnp
+from jax import tree_util
+
+from core.typing import AttrDict
+
+
+ALIGNMENT = 64
+MAGIC = b'FLATCKPT'
+FLAT_SUFFIX = '.flat'
+_SCALAR_TYPES = (bool, int, float, str, type(None))
+
+
+def _align(n: int, alignment: int=ALIGNMENT):
+  return (n + alignment - 1) // alignment * alignment
+
+
+def _leaf_dtype(x):
+  """ The dtype of an array leaf, avoiding np.result_type on jax arrays """
+  return np.dtype(x.dtype) if hasattr(x, 'dtype') else np.result_type(x)
+
+
+class FlatLayout:
+  def __init__(self, treedef, shapes: Sequence[tuple], dtypes: Sequence[np.dtype]):
+    self.treedef = treedef
+    self.shapes = tuple(tuple(s) for s in shapes)
+    self.dtypes = tuple(np.dtype(d) for d in dtypes)
+    self.sizes = tuple(int(np.prod(s)) for s in self.shapes)
+    self.offsets = []
+    offset = 0
+    for size, dtype in zip(self.sizes, self.dtypes):
+      self.offsets.append(offset)
+      offset = _align(offset + size * dtype.itemsize)
+    self.offsets = tuple(self.offsets)
+    self.nbytes = offset
+
+  @classmethod
+  def from_tree(cls, tree):
+    leaves, treedef = tree_util.tree_flatten(tree)
+    return cls.from_leaves(leaves, treedef)
+
+  @classmethod
+  def from_leaves(cls, leaves: List, treedef):
+    return cls(
+      treedef,
+      [np.shape(x) for x in leaves],
+      [_leaf_dtype(x) for x in leaves]
+    )
+
+  def matches(self, leaves: List, treedef):
+    return treedef == self.treedef and len(leaves) == len(self.shapes) \
+      and all(np.shape(x) == s and _leaf_dtype(x) == d
+        for x, s, d in zip(leaves, self.shapes, self.dtypes))
+
+  def pack(self, leaves: List, out: np.ndarray=None):
+    """ Copies leaves into out, a new buffer if not given """
+    if out is None:
+      out = np.empty(self.nbytes, np.uint8)
+    assert out.nbytes >= self.nbytes, (out.nbytes, self.nbytes)
+    for x, offset, size, dtype in zip(leaves, self.offsets, self.sizes, self.dtypes):
+      out[offset: offset + size * dtype.itemsize] = \
+        np.ascontiguousarray(x, dtype=dtype).reshape(-1).view(np.uint8)
+    return out
+
+  def unpack(self, buffer):
+    """ Returns the parameter tree as views into buffer """
+    leaves = [
+      np.frombuffer(buffer, dtype=dtype, count=size, offset=offset).reshape(shape)
+      for shape, dtype, size, offset
+      in zip(self.shapes, self.dtypes, self.sizes, self.offsets)
+    ]
+    return tree_util.tree_unflatten(self.treedef, leaves)
+
+
+class FlatParams:
+  """ A tree of arrays, e.g., parameters or data, packed in a single buffer """
+  def __init__(self, layout: FlatLayout, buffer: np.ndarray):
+    self.layout = layout
+    self.buffer = buffer
+
+  @property
+  def nbytes(self):
+    return self.buffer.nbytes
+
+  def unpack(self):
+    return self.layout.unpack(self.buffer)
+
+
+class FlatPacker:
+  """ Packs versions of a parameter tree, caching their layout """
+  def __init__(self):
+    self._layout: FlatLayout = None
+
+  def pack(self, tree: Any):
+    leaves, treedef = tree_util.tree_flatten(tree)
+    if self._layout is None or not self._layout.matches(leaves, treedef):
+      self._layout = FlatLayout.from_leaves(leaves, treedef)
+    return FlatParams(self._layout, self._layout.pack(leaves))
+
+
+class _Unstructured(Exception):
+  pass
+
+
+def _encode_structure(tree, leaves: List):
+  """ Returns the JSON structure of tree, appending its leaves to leaves """
+  if isinstance(tree, dict):
+    if not all(isinstance(k, str) for k in tree):
+      raise _Unstructured
+    return {
+      'type': 'attrdict' if isinstance(tree, AttrDict) else 'dict',
+      'items': [[k, _encode_structure(v, leaves)] for k, v in tree.items()]
+    }
+  if type(tree) in (list, tuple):
+    return {
+      'type': type(tree).__name__,
+      'items': [_encode_structure(v, leaves) for v in tree]
+    }
+  if isinstance(tree, _SCALAR_TYPES) or hasattr(tree, '__array__'):
+    leaves.append(tree)
+    return len(leaves) - 1
+  raise _Unstructured
+
+
+def _decode_structure(structure, leaves: List):
+  if isinstance(structure, int):
+    return leaves[structure]
+  items = structure['items']
+  if structure['type'] == 'attrdict':
+    tree = AttrDict()
+    for k, v in items:
+      tree[k] = _decode_structure(v, leaves)
+    return tree
+  if structure['type'] == 'dict':
+    return {k: _decode_structure(v, leaves) for k, v in items}
+  items = [_decode_structure(v, leaves) for v in items]
+  return tuple(items) if structure['type'] == 'tuple' else items
+
+
+def _dtype(name: str):
+  try:
+    return np.dtype(name)
+  except TypeError:
+    # extended types, e.g., bfloat16
+    return np.dtype(getattr(jnp, name))
+
+
+def save_flat(tree: Any, path: str):
+  """ Atomically writes tree to path as a flat checkpoint """
+  leaves = []
+  try:
+    structure = _encode_structure(tree, leaves)
+    treedef = None
+  except _Unstructured:
+    leaves, treedef = tree_util.tree_flatten(tree)
+    structure = None
+    treedef = base64.b64encode(cloudpickle.dumps(treedef)).decode('ascii')
+  scalars = {i: x for i, x in enumerate(leaves) if isinstance(x, _SCALAR_TYPES)}
+  arrays = [np.asarray(x) for i, x in enumerate(leaves) if i not in scalars]
+  for x in arrays:
+    if x.dtype.hasobject:
+      raise TypeError(f'Cannot save an array of dtype {x.dtype} to {path}')
+  layout = FlatLayout(None, [x.shape for x in arrays], [x.dtype for x in arrays])
+  header = json.dumps(dict(
+    structure=structure,
+    treedef=treedef,
+    n_leaves=len(leaves),
+    scalars=list(scalars.items()),
+    shapes=layout.shapes,
+    dtypes=[d.name for d in layout.dtypes],
+  )).encode()
+  data_offset = _align(len(MAGIC) + 8 + len(header))
+
+  dirname = os.path.dirname(path)
+  if dirname:
+    os.makedirs(dirname, exist_ok=True)
+  tmp_path = f'{path}.tmp{os.getpid()}'
+  try:
+    with open(tmp_path, 'wb') as f:
+      f.write(MAGIC)
+      f.write(np.uint64(len(header)).tobytes())
+      f.write(header)
+      for x, offset, dtype in zip(arrays, layout.offsets, layout.dtypes):
+        f.seek(data_offset + offset)
+        f.write(np.ascontiguousarray(x, dtype=dtype).reshape(-1).view(np.uint8).data)
+      f.truncate(data_offset + layout.nbytes)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+
+def is_flat(path: str):
+  with open(path, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+def restore_flat(path: str, use_mmap: bool=True):
+  """ Restores the tree saved at path. Arrays are read-only views into
+  the memory-mapped file if use_mmap, or writable copies otherwise """
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{path} is not a flat checkpoint')
+    header_size = int(np.frombuffer(f.read(8), np.uint64)[0])
+    header = json.loads(f.read(header_size))
+    data_offset = _align(len(MAGIC) + 8 + header_size)
+    f.seek(0, os.SEEK_END)
+    if f.tell() == data_offset:
+      # mmap cannot map the empty data section of a tree without arrays
+      buffer = b''
+    elif use_mmap:
+      buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+      f.seek(0)
+      buffer = bytearray(f.read())
+
+  layout = FlatLayout(None, header['shapes'], [_dtype(d) for d in header['dtypes']])
+  arrays = iter([
+    np.frombuffer(buffer, dtype=dtype, count=size,
+      offset=data_offset + offset).reshape(shape)
+    for shape, dtype, size, offset
+    in zip(layout.shapes, layout.dtypes, layout.sizes, layout.offsets)
+  ])
+  scalars = dict(header['scalars'])
+  leaves = [scalars[i] if i in scalars else next(arrays)
+    for i in range(header['n_leaves'])]
+  if header['structure'] is not None:
+    return _decode_structure(header['structure'], leaves)
+  treedef = cloudpickle.loads(base64.b64decode(header['treedef']))
+  return tree_util.tree_unflatten(treedef, leaves)
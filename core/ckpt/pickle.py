@@ -2,6 +2,8 @@ import os
 import cloudpickle
 
 from tools.log import do_logging
+from core.ckpt.flat import FLAT_SUFFIX, restore_flat, save_flat
+from core.ckpt.writer import get_checkpointer, recover
 from core.names import PATH_SPLIT
 from core.typing import ModelPath
 from tools.file import search_for_all_files
@@ -60,19 +62,39 @@ def get_filedir(model_path: ModelPath, name: str, *args):
   return os.path.join(*model_path, name, *args)
 
 
+def _flat_filename(filedir):
+  return f'{filedir}{FLAT_SUFFIX}'
+
+
+def _write_params(params, filename, out=None):
+  """ Writes params to out, filename if not given, keeping entries of the
+  previous version saved under other keys """
+  out = out or filename
+  prev = out if os.path.exists(out) else filename
+  params = dict(params)
+  if os.path.exists(prev):
+    prev_params = restore_flat(prev)
+    if not set(prev_params).issubset(params):
+      params = {**prev_params, **params}
+  save_flat(params, out)
+
+
 def save_params(params, model_path: ModelPath, name, backtrack=4, to_print=True):
-  filedir = get_filedir(model_path, name)
-  for k, v in params.items():
-    save(v, filedir=filedir, filename=k, backtrack=backtrack, 
-         name='parameters', to_print=to_print)
+  """ Saves params to a flat checkpoint at model_path/name.flat. Entries 
+  previously saved under other keys are kept. Within AsyncCheckpointer.save,
+  params are written in the background """
+  filename = _flat_filename(get_filedir(model_path, name))
+  checkpointer = get_checkpointer()
+  if checkpointer is None:
+    _write_params(params, filename)
+  else:
+    checkpointer.add(os.path.join(*model_path), filename, _write_params, params)
+  if to_print:
+    do_logging(f'Saving parameters in "{filename}"', backtrack=backtrack, level='info')
 
 
-def restore_params(model_path: ModelPath, name, filenames=None, backtrack=4, to_print=True):
-  filedir = get_filedir(model_path, name)
-  if filenames is None:
-    filenames = search_for_all_files(filedir, '.pkl', remove_dir=True)
-  if not isinstance(filenames, (list, tuple)):
-    filenames = [filenames]
+def _restore_legacy_params(filedir, filenames, backtrack, to_print):
+  """ Restores params saved as a pickle file per key """
   params = {}
   for filename in filenames:
     weights = restore(filedir=filedir, filename=filename, backtrack=backtrack, 
@@ -89,6 +111,51 @@ def restore_params(model_path: ModelPath, name, filenames=None, backtrack=4, to_
   return params
 
 
+def restore_params(model_path: ModelPath, name, filenames=None, backtrack=4, to_print=True):
+  """ Restores params from model_path/name.flat and the flat checkpoints 
+  under model_path/name, e.g., name/model.flat is restored to params.model. 
+  Arrays are memory-mapped. Entries without a flat checkpoint are
+  restored from legacy pickle files """
+  filedir = get_filedir(model_path, name)
+  recover(os.path.join(*model_path))
+  if filenames is not None and not isinstance(filenames, (list, tuple)):
+    filenames = [filenames]
+  paths = search_for_all_files(filedir, FLAT_SUFFIX, remove_dir=True)
+  paths = [(p.replace(FLAT_SUFFIX, ''), os.path.join(filedir, p)) for p in paths
+    if filenames is None or p.split(PATH_SPLIT)[0].replace(FLAT_SUFFIX, '') in filenames]
+  if os.path.exists(_flat_filename(filedir)):
+    paths.insert(0, (None, _flat_filename(filedir)))
+
+  params = {}
+  for key, path in paths:
+    try:
+      weights = restore_flat(path)
+    except Exception as e:
+      do_logging(f'Failing restoring parameters from {path}: {e}', 
+                 backtrack=backtrack, level='info')
+      continue
+    if key is None:
+      params.update(weights)
+    else:
+      d = params
+      for k in key.split(PATH_SPLIT)[:-1]:
+        d = d.setdefault(k, {})
+      d[key.split(PATH_SPLIT)[-1]] = weights
+    if to_print:
+      do_logging(f'Restoring parameters from "{path}"', backtrack=backtrack, level='info')
+  if filenames is not None:
+    params = {k: v for k, v in params.items() if k in filenames}
+
+  # legacy pickles of entries without a flat checkpoint
+  legacy = search_for_all_files(filedir, '.pkl', remove_dir=True)
+  legacy = [f for f in legacy
+    if f.replace('.pkl', '').split(PATH_SPLIT)[0] not in params
+    and (filenames is None or f.replace('.pkl', '') in filenames)]
+  if legacy:
+    params.update(_restore_legacy_params(filedir, legacy, backtrack, to_print))
+  return params
+
+
 class Checkpoint:
   def __init__(self, config, name='ckpt'):
     if 'root_dir' in config and 'model_name' in config:
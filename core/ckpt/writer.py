@@ -0,0 +1,139 @@
+""" Asynchronous checkpointing
+
+Within AsyncCheckpointer.save(), save_params snapshots parameters to host
+memory and defers writing them to a background thread, so training only
+blocks for the device-to-host copy and, if the previous checkpoint is
+still being written, for its completion; at most one write is in flight.
+
+The files of a checkpoint are first written next to their destinations
+with the STAGED_SUFFIX. Once all are staged, a journal listing them is
+recorded in the model directory, the staged files are renamed to their
+destinations, and the journal is marked complete. A checkpoint
+interrupted while renaming is completed by recover before the next
+restore, so restores never see a mix of old and new files.
+"""
+import collections
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List
+import numpy as np
+import jax
+from jax import tree_util
+
+from tools import yaml_op
+from tools.log import do_logging
+from tools.timer import Timer
+
+
+JOURNAL = 'checkpoint.yaml'
+STAGED_SUFFIX = '.staged'
+_local = threading.local()
+
+
+def get_checkpointer():
+  """ Returns the checkpointer collecting writes in this thread, if any """
+  return getattr(_local, 'checkpointer', None)
+
+
+def snapshot(tree: Any):
+  """ Copies tree to host memory, so that it can be written while the
+  original arrays are updated """
+  tree = tree_util.tree_map(
+    lambda x: x.copy() if isinstance(x, np.ndarray) and x.flags.writeable else x,
+    tree)
+  return jax.device_get(tree)
+
+
+def _dump_journal(model_dir: str, files: List[str], complete: bool):
+  path = os.path.join(model_dir, JOURNAL)
+  tmp_path = f'{path}.tmp'
+  yaml_op.dump(tmp_path, complete=complete, files=files, time=time.time())
+  os.replace(tmp_path, path)
+
+
+def recover(model_dir: str):
+  """ Completes the checkpoint in model_dir interrupted after all of its
+  files have been staged """
+  journal = yaml_op.load(os.path.join(model_dir, JOURNAL))
+  if not journal or journal['complete']:
+    return
+  for f in journal['files']:
+    staged = os.path.join(model_dir, f'{f}{STAGED_SUFFIX}')
+    if os.path.exists(staged):
+      os.replace(staged, os.path.join(model_dir, f))
+  _dump_journal(model_dir, journal['files'], True)
+  do_logging(f'Recovering the interrupted checkpoint in "{model_dir}"', level='warning')
+
+
+class _Write:
+  def __init__(self, model_dir: str, path: str, fn: Callable, data: Any):
+    self.model_dir = model_dir
+    self.path = path
+    self.fn = fn
+    self.data = data
+
+
+class AsyncCheckpointer:
+  def __init__(self, name: str='ckpt'):
+    self.name = name
+    self._writes: List[_Write] = None
+    self._thread: threading.Thread = None
+    self._error: Exception = None
+
+  @contextlib.contextmanager
+  def save(self):
+    """ Defers the writes of save_params called within this context """
+    with Timer(f'{self.name}_blocked'):
+      self.wait()
+      self._writes = []
+      _local.checkpointer = self
+      try:
+        yield self
+      finally:
+        _local.checkpointer = None
+        writes, self._writes = self._writes, None
+    if writes:
+      # a non-daemon thread, so that pending writes complete at exit
+      self._thread = threading.Thread(target=self._run, args=(writes,))
+      self._thread.start()
+
+  def add(self, model_dir: str, path: str, fn: Callable, data: Any):
+    """ Schedules fn(data, path, out), which writes data to out and is
+    expected to read the previous version from out if present, or from
+    path otherwise """
+    self._writes.append(_Write(model_dir, path, fn, snapshot(data)))
+
+  def wait(self):
+    """ Blocks until the write in flight completes """
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def _run(self, writes: List[_Write]):
+    try:
+      with Timer(f'{self.name}_write'):
+        staged: Dict[str, _Write] = {}
+        for w in writes:
+          out = f'{w.path}{STAGED_SUFFIX}'
+          if out not in staged and os.path.exists(out):
+            # left by an interrupted checkpoint
+            os.remove(out)
+          staged[out] = w
+          w.fn(w.data, w.path, out)
+        files = collections.defaultdict(list)
+        for w in staged.values():
+          files[w.model_dir].append(os.path.relpath(w.path, w.model_dir))
+        for model_dir, fs in files.items():
+          _dump_journal(model_dir, fs, False)
+        for out, w in staged.items():
+          os.replace(out, w.path)
+        for model_dir, fs in files.items():
+          _dump_journal(model_dir, fs, True)
+    except Exception as e:
+      do_logging(f'Failing writing checkpoints: {e}', level='error')
+      self._error = e
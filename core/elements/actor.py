@@ -30,6 +30,8 @@ class Actor:
       self._model_path = None
     self.config = config
     self.model = model
+    # the function computing actions, model.action unless set_inference is called
+    self._inference = None
 
     self.rms: RMS = self.config.rms
     self.setup_checkpoint()
@@ -56,6 +58,11 @@ class Actor:
     self.config.rms.print_for_debug = self.config.get('print_for_debug', True)
     self.rms = RMS(self.config.rms, n_obs=self.model.n_groups)
 
+  def set_inference(self, fn):
+    """ Computes actions with fn(inp, evaluation) instead of model.action, 
+    e.g., on an inference server. None restores model.action """
+    self._inference = fn
+
   def get_raw_rms(self):
     return RMS(self.config.rms, n_obs=self.model.n_groups)
 
@@ -84,7 +91,10 @@ class Actor:
     """
     inp = dict2AttrDict(inp)
     inp = self._process_input(inp, evaluation)
-    out = self.model.action(inp, evaluation)
+    if self._inference is None:
+      out = self.model.action(inp, evaluation)
+    else:
+      out = self._inference(inp, evaluation)
     out = self._process_output(inp, out, evaluation)
 
     return out
@@ -7,6 +7,7 @@ from tools.log import do_logging
 from core.names import MODEL
 from core.ckpt.base import ParamsCheckpointBase
 from core.ensemble import Ensemble, constructor
+from core.jit import jit
 from core.typing import AttrDict, dict2AttrDict
 from nn.func import create_network
 from tools.display import print_dict_info, summarize_arrays, int2str
@@ -84,13 +85,24 @@ class Model(ParamsCheckpointBase):
     return self.params
 
   def compile_model(self):
-    self.jit_action = jax.jit(self.raw_action, static_argnames=('evaluation'))
-    # self.jit_action = jax.jit(self.raw_action, static_argnums=(3))
+    # model.jit configures the batch buckets of jit_action, e.g., max_batch_size: 64
+    self.jit_action = jit(
+      self.raw_action, 
+      name=f'{self.name}_action', 
+      config=self.config.get('jit'), 
+      static_argnames='evaluation', 
+      pad_argnames=('data',)
+    )
+
+  def process_action_input(self, data):
+    """ Prepares data for jit_action, shared by action and the inference server """
+    return data
 
   def action(self, data, evaluation):
+    data = self.process_action_input(data)
     self.act_rng, act_rng = jax.random.split(self.act_rng)
     action, stats, state = self.jit_action(self.params, act_rng, data, evaluation)
-    action, stats = jax.tree_map(np.asarray, (action, stats))
+    action, stats = jax.tree_util.tree_map(np.asarray, (action, stats))
     return action, stats, state
 
   def raw_action(self, params, rng, data, evaluation=False):
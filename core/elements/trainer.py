@@ -4,11 +4,11 @@ import optax
 
 from core.ckpt.base import ParamsCheckpointBase
 from core.elements.loss import LossBase
+from core.jit import jit
 from core.ensemble import Ensemble
 from core.optimizer import build_optimizer
 from core.typing import AttrDict, ModelPath, dict2AttrDict
 from core.names import MODEL, OPTIMIZER
-from tools.timer import Timer
 from tools.utils import set_path
 
 
@@ -49,14 +49,24 @@ class TrainerBase(ParamsCheckpointBase):
     )
 
   def compile_train(self):
-    with Timer(f'{self.name}_jit_train', 1):
-      _jit_train = jax.jit(self.theta_train, static_argnames='return_stats')
+    _jit_train = jit(
+      self.theta_train, 
+      name=f'{self.name}_train', 
+      static_argnames='return_stats', 
+      max_traces=self.config.get('max_traces')
+    )
     def jit_train(*args, return_stats=True, **kwargs):
       self.rng, rng = jax.random.split(self.rng)
       return _jit_train(*args, rng=rng, return_stats=return_stats, **kwargs)
     self.jit_train = jit_train
+    self._jit_train = _jit_train
     self.haiku_tabulate()
 
+  def warmup(self, data=None):
+    """ Compiles jit_train ahead of time, returning the compile time. 
+    Trainers that can construct a batch of data override it """
+    return 0
+
   def haiku_tabulate(self, data=None):
     pass
 
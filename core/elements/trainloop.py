@@ -1,5 +1,9 @@
+import jax
+
+from core.elements.dataset import process_with_env
 from core.elements.trainer import TrainerBase
 from core.typing import AttrDict, dict2AttrDict
+from tools.prefetch import Prefetcher
 from tools.timer import Timer
 
 
@@ -19,6 +23,14 @@ class TrainingLoop:
     for k, v in kwargs.items():
       setattr(self, k, v)
 
+    # samples, processes and puts the next n_prefetch batches on device 
+    # in the background while the current batch trains. Meant for 
+    # replays that support concurrent sampling and insertion
+    n_prefetch = self.config.get('n_prefetch', 0)
+    self._prefetcher = Prefetcher(
+      self._prefetch_data, n_prefetch, name='prefetch'
+    ) if n_prefetch else None
+
     self.post_init()
 
   def post_init(self):
@@ -44,6 +56,12 @@ class TrainingLoop:
       train_step, stats = self._train(step=step, **kwargs)
     if train_step != 0:
       stats = self._after_train(stats)
+      if self._prefetcher is not None:
+        stats.update(self._prefetcher.get_stats())
+      get_prefetch_stats = getattr(self.buffer, 'get_prefetch_stats', None)
+      replay_stats = get_prefetch_stats() if get_prefetch_stats else None
+      if replay_stats:
+        stats.update(replay_stats)
     return train_step, stats
 
   def _before_train(self, step):
@@ -72,16 +90,47 @@ class TrainingLoop:
     return stats
 
   def sample_data(self, batch_size=None, record_data=True):
+    if self._prefetcher is not None and batch_size is None:
+      ready_to_sample = getattr(self.buffer, 'ready_to_sample', None)
+      if ready_to_sample is not None and not ready_to_sample():
+        return None
+      # only the time blocked on an empty queue is recorded
+      with Timer('sample_data'):
+        data = self._prefetcher.get()
+      if record_data:
+        self.training_data = data
+      return data
+
     with Timer('sample_data'):
       data = self.buffer.sample(batch_size=batch_size)
     if record_data:
       self.training_data = data
     if data is None:
       return None
+    data = self._process_data(data)
+
+    return data
+
+  def _process_data(self, data):
     data.setdefault('global_state', data.obs)
     if 'next_obs' in data:
       data.setdefault('next_global_state', data.next_obs)
+    if self.config.obs_range or self.config.one_hot_action:
+      data = process_with_env(
+        data, 
+        self.trainer.env_stats, 
+        obs_range=self.config.obs_range, 
+        one_hot_action=self.config.one_hot_action
+      )
+    return data
 
+  def _prefetch_data(self):
+    data = self.buffer.sample()
+    if data is None:
+      return None
+    data = self._process_data(data)
+    if self.config.get('device_put', True):
+      data = jax.device_put(data)
     return data
 
   def _train_with_data(self, data, **kwargs):
@@ -91,6 +140,9 @@ class TrainingLoop:
     return stats
 
   def change_buffer(self, buffer):
+    if self._prefetcher is not None:
+      # batches queued from the old buffer are dropped
+      self._prefetcher.stop()
     old_buffer = self.buffer
     self.buffer = buffer
     return old_buffer
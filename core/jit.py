@@ -0,0 +1,282 @@
+""" Jitted functions with shape buckets and compile telemetry
+
+jax.jit silently traces and compiles a function again for every new
+input shape, e.g., when the number of environments changes during
+evaluation or turn-based batches vary in size. A JitFunction pads
+selected arguments along the batch axis to the smallest of a few bucket
+sizes and slices the batched outputs back, so that the function is compiled
+once per bucket. It counts traces and compile seconds, warns when the
+function is traced after warmup or more often than expected, and
+supports ahead-of-time compilation for all buckets at startup.
+"""
+import functools
+import inspect
+import itertools
+import threading
+import time
+import weakref
+from typing import Callable, Dict, Sequence, Union
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax import tree_util
+
+from tools.log import do_logging
+from core.typing import AttrDict
+
+
+def default_buckets(max_size: int):
+  """ Powers of two up to max_size """
+  buckets = []
+  size = 1
+  while size < max_size:
+    buckets.append(size)
+    size *= 2
+  buckets.append(max_size)
+  return buckets
+
+
+def bucket_size(n: int, buckets: Sequence[int]):
+  """ Returns the smallest bucket no less than n. Sizes beyond the largest
+  bucket are rounded up to its multiples """
+  for b in buckets:
+    if b >= n:
+      return b
+  return -(-n // buckets[-1]) * buckets[-1]
+
+
+def pad(x, size: int, axis: int=0):
+  """ Pads x to size along axis by repeating the last entry """
+  if np.ndim(x) <= axis or x.shape[axis] == size:
+    return x
+  n = x.shape[axis]
+  lib = np if isinstance(x, np.ndarray) else jnp
+  last = lib.take(x, lib.arange(n-1, n), axis=axis)
+  return lib.concatenate(
+    [x, lib.repeat(last, size - n, axis=axis)], axis=axis)
+
+
+# ids of the JitFunctions traced by the current call in each thread
+_local = threading.local()
+
+
+def _traced_ids():
+  if not hasattr(_local, 'ids'):
+    _local.ids = set()
+  return _local.ids
+
+
+def slice_batch(out, start: int, end: int, out_axes=0):
+  """ Slices the batched leaves of out to [start, end)
+
+  Args:
+    out_axes: the batch axes of out as in jax.vmap, i.e., an int or a
+      prefix tree of out whose None entries mark unbatched subtrees
+  """
+  def slice_fn(axis, x):
+    if axis is None:
+      return x
+    idx = (slice(None),) * axis + (slice(start, end),)
+    return tree_util.tree_map(lambda v: v[idx], x)
+  return tree_util.tree_map(
+    slice_fn, out_axes, out, is_leaf=lambda x: x is None)
+
+
+def _abstractify(x, axis=None, size=None):
+  if hasattr(x, 'shape') and hasattr(x, 'dtype'):
+    shape, dtype = list(x.shape), x.dtype
+  else:
+    shape, dtype = list(np.shape(x)), jnp.result_type(x)
+  if axis is not None and len(shape) > axis:
+    shape[axis] = size
+  return jax.ShapeDtypeStruct(tuple(shape), dtype)
+
+
+class JitFunction:
+  # all live jitted functions by id, used for reporting
+  instances: 'weakref.WeakValueDictionary[int, JitFunction]' = \
+    weakref.WeakValueDictionary()
+  _ids = itertools.count()
+
+  def __init__(
+    self,
+    fn: Callable,
+    *,
+    name: str=None,
+    static_argnames: Union[str, Sequence[str]]=(),
+    buckets: Sequence[int]=None,
+    pad_argnames: Sequence[str]=(),
+    axis: int=0,
+    out_axes=0,
+    max_traces: int=None,
+  ):
+    """
+    Args:
+      fn: the function to jit
+      name: the name used in logs and stats
+      static_argnames: static arguments passed to jax.jit
+      buckets: the sizes arguments in pad_argnames are padded to
+      pad_argnames: arguments whose leaves are padded along axis
+      axis: the batch axis
+      out_axes: the batch axes of outputs as in jax.vmap, i.e., an int 
+        or a prefix tree of the outputs whose None entries mark 
+        unbatched outputs. Only batched outputs are sliced back
+      max_traces: the number of traces expected, e.g., one per bucket
+        and static argument value
+    """
+    self.fn = fn
+    self.name = name or fn.__name__
+    if isinstance(static_argnames, str):
+      static_argnames = (static_argnames,)
+    self.static_argnames = tuple(static_argnames)
+    self.buckets = sorted(buckets) if buckets else None
+    self._pad_argnames = tuple(pad_argnames)
+    self.pad_argnames = self._pad_argnames if self.buckets else ()
+    self.axis = axis
+    self.out_axes = out_axes
+    self.max_traces = max_traces
+    self._signature = inspect.signature(fn)
+
+    self.n_traces = 0
+    self.n_calls = 0
+    self.compile_time = 0.
+    self._warmed_up = False
+    # abstract arguments of the first call, used by warmup
+    self._example: Dict = None
+
+    self._id = next(self._ids)
+    fn_id = self._id
+    @functools.wraps(fn)
+    def traced(*args, **kwargs):
+      # jax traces in the calling thread, which recognizes its own traces
+      _traced_ids().add(fn_id)
+      return fn(*args, **kwargs)
+    self._jit = jax.jit(traced, static_argnames=self.static_argnames)
+    self.instances[self._id] = self
+
+  def __call__(self, *args, **kwargs):
+    # binds arguments in a canonical form, so that positional and keyword
+    # arguments share the compiled functions
+    bound = self._signature.bind(*args, **kwargs)
+    n = size = None
+    if self.pad_argnames:
+      n, size = self._pad_inputs(bound)
+    self._pop_trace()
+    start = time.time()
+    out = self._jit(*bound.args, **bound.kwargs)
+    if self._pop_trace():
+      self.n_traces += 1
+      self._record_trace(time.time() - start)
+      if self._example is None:
+        self._example = self._abstract_arguments(bound.arguments)
+    self.n_calls += 1
+    if n != size:
+      out = slice_batch(out, 0, n, self.out_axes)
+    return out
+
+  def set_buckets(self, buckets: Sequence[int]):
+    """ Pads arguments in pad_argnames to buckets from now on """
+    self.buckets = sorted(buckets)
+    self.pad_argnames = self._pad_argnames
+
+  def lower(self, *args, **kwargs):
+    return self._jit.lower(*args, **kwargs)
+
+  def warmup(self, *args, **kwargs):
+    """ Compiles ahead of time for example arguments, which can be
+    arrays or jax.ShapeDtypeStruct, or for those of the first call if
+    none is given. Arguments in pad_argnames are compiled for every
+    bucket. Traces afterwards are unexpected.
+    """
+    if args or kwargs:
+      bound = self._signature.bind(*args, **kwargs)
+    else:
+      assert self._example is not None, f'No example arguments for {self.name}'
+      bound = self._signature.bind(**self._example)
+    arguments = dict(bound.arguments)
+    sizes = self.buckets if self.pad_argnames else [None]
+    start = time.time()
+    for size in sizes:
+      for k, v in arguments.items():
+        if k not in self.static_argnames:
+          bound.arguments[k] = tree_util.tree_map(functools.partial(
+            _abstractify,
+            axis=self.axis if k in self.pad_argnames else None,
+            size=size), v)
+      self._pop_trace()
+      self._jit.lower(*bound.args, **bound.kwargs).compile()
+      self.n_traces += self._pop_trace()
+    duration = time.time() - start
+    self.compile_time += duration
+    self._warmed_up = True
+    do_logging(
+      f'{self.name} is compiled ahead of time for {len(sizes)} shapes '
+      f'in {duration:.3g}s', level='info')
+    return duration
+
+  def get_stats(self):
+    stats = AttrDict()
+    stats[f'jit/{self.name}/n_traces'] = self.n_traces
+    stats[f'jit/{self.name}/compile_time'] = self.compile_time
+    return stats
+
+  @classmethod
+  def all_stats(cls):
+    """ Stats of all live functions, summed over those sharing a name """
+    stats = AttrDict()
+    for f in list(cls.instances.values()):
+      for k, v in f.get_stats().items():
+        stats[k] = stats.get(k, 0) + v
+    return stats
+
+  def _abstract_arguments(self, arguments: Dict):
+    return {
+      k: v if k in self.static_argnames else tree_util.tree_map(_abstractify, v)
+      for k, v in arguments.items()
+    }
+
+  def _pad_inputs(self, bound: inspect.BoundArguments):
+    """ Pads arguments in pad_argnames in place, returning the batch size
+    and the padded size """
+    n = None
+    for k in self.pad_argnames:
+      leaves = tree_util.tree_leaves(bound.arguments.get(k))
+      if leaves:
+        n = leaves[0].shape[self.axis]
+        break
+    if n is None:
+      return None, None
+    size = bucket_size(n, self.buckets)
+    if size != n:
+      for k in self.pad_argnames:
+        if k in bound.arguments:
+          bound.arguments[k] = tree_util.tree_map(
+            lambda x: pad(x, size, self.axis), bound.arguments[k])
+    return n, size
+
+  def _pop_trace(self):
+    """ Returns if the current thread has traced the function since the
+    last pop """
+    traced_ids = _traced_ids()
+    traced = self._id in traced_ids
+    traced_ids.discard(self._id)
+    return traced
+
+  def _record_trace(self, duration: float):
+    self.compile_time += duration
+    if self._warmed_up or (
+        self.max_traces is not None and self.n_traces > self.max_traces):
+      do_logging(
+        f'{self.name} is retraced ({self.n_traces} traces) '
+        f'in {duration:.3g}s', level='warning')
+
+
+def jit(fn: Callable, *, name: str=None, config: dict=None, **kwargs):
+  """ Jits fn with options in config, i.e., buckets, pad_argnames,
+  axis, out_axes, and max_traces. Without buckets, arguments are not padded """
+  config = dict(config or {})
+  if config.get('max_batch_size') and not config.get('buckets'):
+    config['buckets'] = default_buckets(config.pop('max_batch_size'))
+  config.pop('max_batch_size', None)
+  kwargs.update(config)
+  return JitFunction(fn, name=name, **kwargs)
@@ -98,7 +98,7 @@ class Memory:
     if state is None:
       return
     reset = np.expand_dims(reset, -1)
-    state = jax.tree_map(lambda x: x*(1-reset), state)
+    state = jax.tree_util.tree_map(lambda x: x*(1-reset), state)
     return state
 
   def reset_states(self):
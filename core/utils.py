@@ -1,10 +1,12 @@
 import os, shutil
+import hashlib
+import json
 import random
 import numpy as np
 import jax
 
 from tools.log import do_logging
-from core.typing import ModelPath, get_basic_model_name
+from core.typing import AttrDict2dict, ModelPath, get_basic_model_name
 from tools import yaml_op
 
 
@@ -42,6 +44,59 @@ def configure_jax_gpu(idx=-1):
       do_logging(e, level='info')
     return True
 
+# entries irrelevant to compilation, which are excluded from the config hash
+_NON_COMPILATION_KEYS = set([
+  'root_dir', 'model_name', 'seed', 'info', 'model_info', 
+  'date', 'launch_time', 'aid', 'print_params', 
+])
+
+
+def _strip_config(config):
+  if isinstance(config, dict):
+    return {k: _strip_config(v) for k, v in config.items() 
+      if k not in _NON_COMPILATION_KEYS}
+  if isinstance(config, (list, tuple)):
+    return [_strip_config(v) for v in config]
+  return config
+
+
+def config_hash(config, n=12):
+  """ Hashes the entries of config that affect compiled functions """
+  config = _strip_config(AttrDict2dict(config))
+  s = json.dumps(config, sort_keys=True, default=str)
+  return hashlib.md5(s.encode()).hexdigest()[:n]
+
+
+def get_jax_cache_dir(config):
+  return os.path.join(config.root_dir, 'jax_cache', config_hash(config))
+
+
+def configure_jax_cache(cache_dir, min_compile_time=None, min_entry_size=None):
+  """ Enables the persistent compilation cache of JAX. Processes 
+  launched afterwards, e.g., ray actors, inherit the cache through 
+  JAX_COMPILATION_CACHE_DIR, which JAX reads on import
+  
+  Args:
+    cache_dir: the cache directory
+    min_compile_time: computations compiled faster are not cached. 
+      JAX's default is kept if None
+    min_entry_size: entries with fewer bytes are not cached. JAX's 
+      default is kept if None
+  Returns:
+    The cache directory
+  """
+  cache_dir = os.path.abspath(cache_dir)
+  os.makedirs(cache_dir, exist_ok=True)
+  os.environ['JAX_COMPILATION_CACHE_DIR'] = cache_dir
+  jax.config.update('jax_compilation_cache_dir', cache_dir)
+  if min_compile_time is not None:
+    jax.config.update('jax_persistent_cache_min_compile_time_secs', min_compile_time)
+  if min_entry_size is not None:
+    jax.config.update('jax_persistent_cache_min_entry_size_bytes', min_entry_size)
+  do_logging(f'JAX compilation cache: {cache_dir}', backtrack=3, level='info')
+  return cache_dir
+
+
 def set_seed(seed: int=None):
   if seed is not None:
     random.seed(seed)
@@ -53,8 +53,9 @@ class AgentManager(ManagerBase):
       self.agents, 'set_model_weights', model_weights, wait=wait)
 
   """ Communications with Parameter Server """
-  def publish_weights(self, wait=False):
-    self._remote_call(self.agents, 'publish_weights', wait=wait)
+  def publish_weights(self, wait=False, with_optimizer=False):
+    self._remote_call_with_args(
+      self.agents, 'publish_weights', wait=wait, with_optimizer=with_optimizer)
 
   """ Training """
   def start_training(self, wait=False):
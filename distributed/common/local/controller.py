@@ -13,6 +13,7 @@ from core.typing import ModelPath, AttrDict, dict2AttrDict, \
 from core.utils import save_code
 from env.func import get_env_stats
 from game.alpharank import AlphaRank
+from game.scheduler import EvaluationScheduler
 from run.utils import search_for_all_configs, search_for_config
 from tools.process import run_ray_process
 from tools.schedule import PiecewiseSchedule
@@ -88,6 +89,8 @@ class Controller(YAMLCheckpointBase):
     self._pids = []
 
     self._status = None
+    # kept across evaluations to warm start from the previous ranking
+    self._alpha_rank = AlphaRank(1000, 5, 0)
 
     if to_restore:
       self.restore()
@@ -283,6 +286,7 @@ class Controller(YAMLCheckpointBase):
   @timeit
   def cleanup(self):
     do_logging(f'Cleaning up for Training Iteration {self._iteration}...', color='blue')
+    self.agent_manager.publish_weights(wait=True, with_optimizer=True)
     oids = [
       self.parameter_server.archive_training_strategies.remote(status=self._status),
       self.monitor.clear_iteration_stats.remote()
@@ -334,6 +338,8 @@ class Controller(YAMLCheckpointBase):
       )
     if periods['store'](self._steps):
       self.monitor.save_all.remote(self._steps)
+      # optimizer states are only sent to the parameter server for checkpoints
+      self.agent_manager.publish_weights(wait=True, with_optimizer=True)
       self.parameter_server.save_active_models.remote(
         env_step=self._steps, to_print=False)
       self.save()
@@ -445,9 +451,14 @@ class Controller(YAMLCheckpointBase):
 
   """ Evaluation """
   @timeit
-  def evaluate_all(self, total_episodes, filename):
+  def evaluate_all(self, total_episodes, filename, target_ci=None):
+    """ Evaluates all strategy profiles for total_episodes, or adaptively 
+    until the confidence intervals of payoffs are within target_ci """
     ray.get(self.parameter_server.reset_payoffs.remote(from_scratch=False))
-    self.runner_manager.evaluate_all(total_episodes)
+    if target_ci is None:
+      self.runner_manager.evaluate_all(total_episodes)
+    else:
+      self.evaluate_adaptively(total_episodes, target_ci)
     payoffs = self.parameter_server.get_payoffs.remote()
     counts = self.parameter_server.get_counts.remote()
     payoffs = ray.get(payoffs)
@@ -460,8 +471,7 @@ class Controller(YAMLCheckpointBase):
     for i in range(len(payoffs)):
       print(payoffs[i])
     do_logging(f'Final Counts: {np.mean(counts)}, {np.std(counts)}', color='blue')
-    alpha_rank = AlphaRank(1000, 5, 0)
-    ranks, mass = alpha_rank.compute_rank(
+    ranks, mass = self._alpha_rank.compute_rank(
       payoffs, is_single_population=self.self_play, return_mass=True)
     print('Alpha Rank Results:\n', ranks)
     print('Mass at Stationary Point:\n', mass)
@@ -470,6 +480,35 @@ class Controller(YAMLCheckpointBase):
       cloudpickle.dump((payoffs, counts), f)
     do_logging(f'Payoffs have been saved at {path}', color='blue')
 
+  def evaluate_adaptively(self, max_episodes, target_ci):
+    """ Evaluates strategy profiles in rounds, each allocating episodes to 
+    the profiles with the least precise payoffs, until all are within 
+    target_ci or evaluated for max_episodes """
+    scheduler = EvaluationScheduler(
+      target_ci, 
+      max_episodes=max_episodes, 
+      **(self.config.evaluation_scheduler or {})
+    )
+    n_runners = len(self.runner_manager.runners)
+    n_episodes = 0
+    while True:
+      stats = ray.get(
+        self.parameter_server.get_evaluation_statistics.remote(scheduler.z))
+      sids = scheduler.schedule(
+        stats.payoffs, stats.counts, stats.cis, n_runners, self.self_play)
+      if len(sids) == 0:
+        break
+      if self.self_play:
+        strategies = [[stats.strategies[i] for i in sid] for sid in sids]
+      else:
+        strategies = [[ss[i] for ss, i in zip(stats.strategies, sid)] for sid in sids]
+      self.runner_manager.evaluate_strategies(strategies, scheduler.episodes_per_task)
+      n_episodes += len(sids) * scheduler.episodes_per_task
+    n_profiles = np.prod(np.shape(stats.counts if self.self_play else stats.counts[0]))
+    do_logging(f'Adaptive evaluation scheduled {n_episodes} episodes, '
+      f'{n_episodes / max_episodes / n_profiles:.2%} of evaluating all '
+      f'{n_profiles} profiles for {max_episodes} episodes', color='blue')
+
   def _eval(self, step):
     if self.suite == 'spiel':
       pid = self.compute_nash_conv(
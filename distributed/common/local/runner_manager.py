@@ -3,6 +3,7 @@ from typing import List, Union
 import numpy as np
 import ray
 
+from ..remote.inference_server import InferenceServer
 from ..remote.parameter_server import ParameterServer
 from ..remote.runner import MultiAgentRunner
 from tools.log import do_logging
@@ -23,6 +24,7 @@ class RunnerManager(ManagerBase):
     self.monitor = monitor
     self.RemoteRunner = MultiAgentRunner.as_remote(**ray_config)
     self.runners = None
+    self.inference_server = None
 
   """ Runner Management """
   def build_runners(
@@ -42,6 +44,8 @@ class RunnerManager(ManagerBase):
     else:
       config = configs
       configs = AttrDict2dict(configs)
+    if config.runner.get('inference_server'):
+      self.build_inference_server(configs, config.runner)
     self.runners: List[MultiAgentRunner] = [
       self.RemoteRunner.remote(
         i,
@@ -50,9 +54,22 @@ class RunnerManager(ManagerBase):
         parameter_server=self.parameter_server, 
         remote_buffers=remote_buffers, 
         active_models=active_models, 
-        monitor=self.monitor)
+        monitor=self.monitor, 
+        inference_server=self.inference_server)
       for i in range(config.runner.n_runners)
     ]
+
+  def build_inference_server(self, configs: Union[List[dict], dict], runner_config: AttrDict):
+    ray_config = dict(runner_config.inference_server.get('ray_config', {}))
+    # every runner keeps one request in flight
+    ray_config.setdefault('max_concurrency', runner_config.n_runners + 2)
+    RemoteServer = InferenceServer.as_remote(**ray_config)
+    self.inference_server = RemoteServer.remote(configs)
+
+  def get_inference_stats(self):
+    if self.inference_server is None:
+      return {}
+    return ray.get(self.inference_server.get_stats.remote())
   
   @property
   def n_runners(self):
@@ -62,6 +79,9 @@ class RunnerManager(ManagerBase):
     for r in self.runners:
       ray.kill(r)
     self.runners = None
+    if self.inference_server is not None:
+      ray.kill(self.inference_server)
+      self.inference_server = None
 
   def get_total_steps(self):
     return self._remote_call(self.runners, 'get_total_steps', wait=True)
@@ -90,6 +110,11 @@ class RunnerManager(ManagerBase):
     )
 
     do_logging(f'The total number of strategy tuples: {len(strategies)}', level='info')
+    self.evaluate_strategies(strategies, total_episodes)
+
+  def evaluate_strategies(self, strategies: List[List[ModelPath]], total_episodes):
+    """ Evaluates each strategy tuple for total_episodes, distributing 
+    them over runners in turn """
     eids = []
     rid = 0
     for s in strategies:
@@ -0,0 +1,167 @@
+""" Weight publication from agents to the parameter server
+
+An agent publishes its acting parameters after training under
+monotonically increasing versions. Parameters are optionally quantized
+to a lower precision, or sent as the top-k entries of their difference
+from the version last received by the parameter server. Both sides
+decode with the same function, so the publisher tracks exactly the
+parameters held by the parameter server, and entries left out of a
+delta are carried over to the following ones.
+"""
+import collections
+from typing import Dict, List
+import numpy as np
+import jax.numpy as jnp
+from jax import tree_util
+
+from core.names import MODEL
+from core.typing import ModelPath, ModelWeights
+
+
+EncodedParams = collections.namedtuple(
+  'EncodedParams', 'version base_version treedef dtypes leaves')
+
+
+def _is_float(dtype):
+  return jnp.issubdtype(dtype, jnp.floating)
+
+
+def _nbytes(leaves: List):
+  return sum(
+    sum(x.nbytes for x in l) if isinstance(l, tuple) else l.nbytes
+    for l in leaves
+  )
+
+
+def _decode_leaves(encoded: EncodedParams, base: List[np.ndarray]=None):
+  if encoded.base_version is None:
+    return [np.asarray(x, dtype=d) for x, d in zip(encoded.leaves, encoded.dtypes)]
+  assert len(base) == len(encoded.leaves), (len(base), len(encoded.leaves))
+  leaves = []
+  for b, (idx, val), d in zip(base, encoded.leaves, encoded.dtypes):
+    x = np.array(b, dtype=d)
+    if _is_float(d):
+      x.reshape(-1)[idx] += val.astype(d)
+    else:
+      x.reshape(-1)[idx] = val
+    leaves.append(x)
+  return leaves
+
+
+def decode_params(encoded: EncodedParams, base=None):
+  """ Decodes params, applying a delta to base, the previous version """
+  if encoded.base_version is not None:
+    base = tree_util.tree_leaves(base)
+  leaves = _decode_leaves(encoded, base)
+  return tree_util.tree_unflatten(encoded.treedef, leaves)
+
+
+def receive_weights(
+  model_weights: ModelWeights,
+  params: Dict,
+  versions: Dict[ModelPath, int]
+):
+  """ Decodes published model weights in place
+
+  Args:
+    model_weights: weights received from an agent
+    params: weights held for model_weights.model
+    versions: versions of the model parameters held
+  Returns:
+    False if a delta is based on a version not held, True otherwise
+  """
+  encoded = model_weights.weights[MODEL]
+  if not isinstance(encoded, EncodedParams):
+    return True
+  model = model_weights.model
+  if encoded.base_version is not None \
+      and encoded.base_version != versions.get(model):
+    return False
+  model_weights.weights[MODEL] = decode_params(encoded, params.get(MODEL))
+  versions[model] = encoded.version
+  return True
+
+
+class WeightPublisher:
+  def __init__(self, config: dict):
+    # the precision of floating parameters sent, None for no quantization
+    self.dtype = config.get('dtype')
+    if self.dtype is not None:
+      self.dtype = np.dtype(getattr(jnp, self.dtype))
+    # the fraction of entries of each parameter sent by delta encoding
+    self.topk = config.get('topk')
+    # full parameters are sent every full_interval versions
+    self.full_interval = config.get('full_interval', 100)
+
+    self.version = 0
+    self._base: List[np.ndarray] = None
+    self._base_version: int = None
+    self._full_version: int = None
+    self._stats = collections.defaultdict(list)
+
+  def reset(self):
+    """ Sends full parameters next time, e.g., when a delta is rejected """
+    self._base = None
+    self._base_version = None
+
+  def encode(self, params, lossless=False):
+    """ Encodes params as a new version
+
+    Args:
+      params: the parameter tree
+      lossless: whether to send full parameters without quantization
+    """
+    self.version += 1
+    leaves, treedef = tree_util.tree_flatten(params)
+    leaves = [np.asarray(x) for x in leaves]
+    dtypes = [x.dtype for x in leaves]
+    use_delta = not lossless and bool(self.topk) \
+      and self._base is not None and len(self._base) == len(leaves) \
+      and self.version - self._full_version < self.full_interval
+    if use_delta:
+      encoded = EncodedParams(
+        self.version, self._base_version, treedef, dtypes,
+        [self._encode_delta(x, b) for x, b in zip(leaves, self._base)]
+      )
+    else:
+      encoded = EncodedParams(
+        self.version, None, treedef, dtypes,
+        leaves if lossless else [self._quantize(x) for x in leaves]
+      )
+      self._full_version = self.version
+    self._base = _decode_leaves(encoded, self._base)
+    self._base_version = self.version
+
+    self._stats['publish/bytes'].append(_nbytes(encoded.leaves))
+    self._stats['publish/raw_bytes'].append(_nbytes(leaves))
+    self._stats['publish/is_delta'].append(use_delta)
+    return encoded
+
+  def get_stats(self, reset=True):
+    stats = {k: np.mean(v) for k, v in self._stats.items()}
+    if stats:
+      stats['publish/bytes_ratio'] = \
+        stats['publish/bytes'] / stats['publish/raw_bytes']
+      stats['publish/version'] = self.version
+    if reset:
+      self._stats.clear()
+    return stats
+
+  def _quantize(self, x: np.ndarray):
+    if self.dtype is not None and _is_float(x.dtype) \
+        and x.dtype.itemsize > self.dtype.itemsize:
+      return x.astype(self.dtype)
+    return x
+
+  def _encode_delta(self, x: np.ndarray, base: np.ndarray):
+    if not _is_float(x.dtype):
+      # changed entries are sent as they are
+      idx = np.flatnonzero(x != base).astype(np.int32)
+      return idx, x.reshape(-1)[idx]
+    delta = (x - base).reshape(-1)
+    k = min(delta.size, max(1, int(np.ceil(self.topk * delta.size))))
+    if k == delta.size:
+      idx = np.arange(delta.size, dtype=np.int32)
+    else:
+      idx = np.argpartition(np.abs(delta), -k)[-k:].astype(np.int32)
+    return idx, self._quantize(delta[idx])
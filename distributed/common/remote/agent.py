@@ -2,10 +2,12 @@ import threading
 import ray
 
 from core.elements.builder import ElementsBuilder
+from core.jit import JitFunction
 from core.elements.strategy import Strategy
 from tools.log import do_logging
 from core.names import *
 from distributed.common.remote.base import RayBase
+from distributed.common.publication import WeightPublisher
 from core.typing import ModelStats, ModelWeights
 from tools.timer import Timer
 from .monitor import Monitor
@@ -38,12 +40,16 @@ class Agent(RayBase):
     )
     self.strategy: Strategy = elements.strategy
     self.buffer = elements.buffer
+    self.publisher = WeightPublisher(
+      (self.config.get('agent') or {}).get('publication', {}))
+    self._publish_lock = threading.Lock()
 
   """ Model Management """
   def get_model_path(self):
     return self.strategy.get_model_path()
 
   def set_model_weights(self, model_weights: ModelWeights):
+    self.publisher.reset()
     self.strategy.reset_model_path(model_weights.model)
     if model_weights.weights:
       self.strategy.set_weights(model_weights.weights)
@@ -51,17 +57,24 @@ class Agent(RayBase):
       f'{None if model_weights.weights is None else list(model_weights.weights)}')
 
   """ Communications with Parameter Server """
-  def publish_weights(self, wait=True):
-    model_weights = ModelWeights(
-      self.get_model_path(), 
-      self.strategy.get_weights(aux_stats=False, train_step=True, env_step=False)
-    )
-    assert set(model_weights.weights) == set([MODEL, OPTIMIZER, TRAIN_STEP]), list(model_weights.weights)
-    ids = self.parameter_server.update_and_prepare_strategy.remote(
-      self.aid, model_weights, model_weights.weights[TRAIN_STEP]
-    )
-    if wait:
-      ray.get(ids)
+  def publish_weights(self, wait=True, with_optimizer=False):
+    """ Publishes the acting parameters as a new version. Optimizer
+    states, along with lossless parameters, are only sent if with_optimizer,
+    e.g., before the parameter server saves a checkpoint
+    """
+    with self._publish_lock:
+      weights = self.strategy.get_weights(
+        opt_weights=with_optimizer, aux_stats=False, train_step=True, env_step=False)
+      weights[MODEL] = self.publisher.encode(weights[MODEL], lossless=with_optimizer)
+      model_weights = ModelWeights(self.get_model_path(), weights)
+      assert set(model_weights.weights) == set([MODEL, OPTIMIZER, TRAIN_STEP]) \
+        or set(model_weights.weights) == set([MODEL, TRAIN_STEP]), list(model_weights.weights)
+      ids = self.parameter_server.update_and_prepare_strategy.remote(
+        self.aid, model_weights, model_weights.weights[TRAIN_STEP]
+      )
+      if wait and not ray.get(ids):
+        # the next publication sends full parameters
+        self.publisher.reset()
       # do_logging(f'Weights published with train step {model_weights.weights["train_step"]}', flush=True)
 
   """ Training """
@@ -86,6 +99,8 @@ class Agent(RayBase):
   def _send_train_stats(self, stats):
     stats[TRAIN_STEP] = self.strategy.get_train_step()
     stats.update(Timer.all_stats())
+    stats.update(JitFunction.all_stats())
+    stats.update(self.publisher.get_stats())
     model_stats = ModelStats(self.get_model_path(), stats)
     self.monitor.store_train_stats.remote(model_stats)
 
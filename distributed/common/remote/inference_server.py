@@ -0,0 +1,240 @@
+""" Centralized inference for runners
+
+Runners send their processed observations to an inference server, which
+gathers requests for the same model version, concatenates them along
+the batch dimension, and runs a single jitted action call for all of
+them. Batches are padded to a few bucketed sizes so that the action
+function is compiled once per bucket rather than once per batch size.
+A batch is dispatched once it reaches max_batch_size or once its first
+request has waited for max_latency seconds. Outputs are split back to
+requests along the batch axes declared by out_axes.
+"""
+import collections
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Sequence, Union
+import numpy as np
+import jax
+from jax import tree_util
+import ray
+
+from core.ckpt.flat import FlatParams
+from core.elements.builder import ElementsBuilder
+from core.elements.model import Model
+from core.jit import bucket_size, default_buckets, pad, slice_batch
+from core.names import MODEL
+from core.typing import ModelWeights, dict2AttrDict
+from distributed.common.remote.base import RayBase
+
+
+class _Request:
+  def __init__(self, key, leaves: List[np.ndarray], treedef):
+    self.key = key
+    self.leaves = leaves
+    self.treedef = treedef
+    self.n = leaves[0].shape[0]
+    self.time = time.time()
+    self.event = threading.Event()
+    self.result = None
+
+
+class InferenceBatcher:
+  """ Batches concurrent calls of fn(key, data) sharing the same key
+
+  Args:
+    fn: a function of key and a padded batch of data
+    max_batch_size: the number of rows at which a batch is dispatched
+    max_latency: the maximum time in seconds a request waits for others
+    buckets: the batch sizes data are padded to
+    out_axes: the batch axes of outputs as in jax.vmap, or a function 
+      of key returning them. Unbatched outputs are returned as they are
+  """
+  def __init__(
+    self,
+    fn: Callable,
+    max_batch_size: int=256,
+    max_latency: float=.002,
+    buckets: Sequence[int]=None, 
+    out_axes: Union[Any, Callable]=0, 
+  ):
+    self.fn = fn
+    self.out_axes = out_axes
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency
+    self.buckets = sorted(buckets or default_buckets(max_batch_size))
+    self._stats = collections.defaultdict(list)
+
+    self._queue = queue.Queue()
+    self._thread = threading.Thread(target=self._serve, daemon=True)
+    self._thread.start()
+
+  def __call__(self, key, data):
+    leaves, treedef = tree_util.tree_flatten(data)
+    leaves = [np.asarray(x) for x in leaves]
+    request = _Request((key, treedef), leaves, treedef)
+    self._queue.put(request)
+    request.event.wait()
+    if isinstance(request.result, Exception):
+      raise request.result
+    return request.result
+
+  def bucket(self, n: int):
+    return bucket_size(n, self.buckets)
+
+  def get_stats(self, reset=True):
+    stats = {k: np.mean(v) for k, v in self._stats.items()}
+    if reset:
+      self._stats.clear()
+    return stats
+
+  def _serve(self):
+    pending: Dict[Any, List[_Request]] = collections.OrderedDict()
+    while True:
+      if pending:
+        deadline = min(rs[0].time for rs in pending.values()) + self.max_latency
+        timeout = max(deadline - time.time(), 0)
+      else:
+        timeout = None
+      try:
+        request = self._queue.get(timeout=timeout)
+        pending.setdefault(request.key, []).append(request)
+      except queue.Empty:
+        pass
+      now = time.time()
+      for key in list(pending):
+        requests = pending[key]
+        if sum(r.n for r in requests) >= self.max_batch_size \
+            or now - requests[0].time >= self.max_latency:
+          del pending[key]
+          self._run_batch(key[0], requests)
+
+  def _run_batch(self, key, requests: List[_Request]):
+    n = sum(r.n for r in requests)
+    size = self.bucket(n)
+    try:
+      leaves = [pad(np.concatenate(xs), size)
+        for xs in zip(*[r.leaves for r in requests])]
+      data = tree_util.tree_unflatten(requests[0].treedef, leaves)
+      outs = tree_util.tree_map(np.asarray, self.fn(key, data))
+      out_axes = self.out_axes(key) if callable(self.out_axes) else self.out_axes
+      start = 0
+      for r in requests:
+        end = start + r.n
+        r.result = slice_batch(outs, start, end, out_axes)
+        start = end
+    except Exception as e:
+      for r in requests:
+        r.result = e
+    self._stats['infer/batch_size'].append(n)
+    self._stats['infer/padded_size'].append(size)
+    self._stats['infer/n_requests'].append(len(requests))
+    self._stats['infer/wait_time'].append(time.time() - requests[0].time)
+    for r in requests:
+      r.event.set()
+
+
+class InferenceServer(RayBase):
+  """ Serves model.action for all runners, SEED-RL style """
+  def __init__(self, configs: Union[List[dict], dict], env_stats: dict=None):
+    if isinstance(configs, list):
+      configs = [dict2AttrDict(c) for c in configs]
+    else:
+      configs = [dict2AttrDict(configs)]
+    config = configs[0]
+    super().__init__(seed=config.get('seed'))
+    self.config = config.runner.inference_server
+
+    builder = ElementsBuilder(config, env_stats)
+    if config.self_play:
+      configs = [config for _ in range(builder.env_stats.n_agents)]
+    self.models: List[Model] = [
+      builder.build_model(c, constructors=builder.get_constructors(c))
+      for c in configs
+    ]
+    self._rngs = [m.act_rng for m in self.models]
+    # params of recent versions, keyed by the object refs of their weights
+    self._params: List[Dict[ray.ObjectRef, Any]] = [
+      collections.OrderedDict() for _ in self.models]
+    self._n_cached_versions = self.config.get('n_cached_versions', 2)
+
+    self.batcher = InferenceBatcher(
+      self._action,
+      max_batch_size=self.config.get('max_batch_size', 256),
+      max_latency=self.config.get('max_latency', .002),
+      buckets=self.config.get('batch_buckets'),
+      out_axes=self._out_axes, 
+    )
+
+  def infer(self, aid: int, mid: List[ray.ObjectRef], data: Dict, evaluation: bool=False):
+    """ Returns the action, stats and state of model aid for data
+
+    Args:
+      aid: the agent id
+      mid: a singleton list of the object ref of the weights, which
+        prevents Ray from resolving the ref
+      data: the processed input to the model
+      evaluation: whether to act in the evaluation mode
+    """
+    mid, = mid
+    return self.batcher((aid, mid, evaluation), data)
+
+  def get_strategy(self, mid: List[ray.ObjectRef]):
+    """ Returns the model weights of mid without the params, which 
+    stay on the server. Runners set the rest, e.g., RMS, to their agents
+    """
+    mid, = mid
+    model_weights = ray.get(mid)
+    weights = {k: v for k, v in model_weights.weights.items() if k != MODEL}
+    return ModelWeights(model_weights.model, weights)
+
+  def get_stats(self, reset=True):
+    return self.batcher.get_stats(reset)
+
+  def _out_axes(self, key):
+    aid = key[0]
+    return getattr(self.models[aid].jit_action, 'out_axes', 0)
+
+  def _action(self, key, data):
+    aid, mid, evaluation = key
+    model = self.models[aid]
+    params = self._get_params(aid, mid)
+    data = model.process_action_input(data)
+    self._rngs[aid], rng = jax.random.split(self._rngs[aid])
+    return model.jit_action(params, rng, data, evaluation)
+
+  def _get_params(self, aid: int, mid: ray.ObjectRef):
+    cache = self._params[aid]
+    if mid in cache:
+      cache.move_to_end(mid)
+      return cache[mid]
+    params = ray.get(mid).weights[MODEL]
+    if isinstance(params, FlatParams):
+      params = params.unpack()
+    cache[mid] = jax.device_put(params)
+    while len(cache) > self._n_cached_versions:
+      cache.popitem(last=False)
+    return cache[mid]
+
+
+class RemoteInference:
+  """ Computes model.action on the inference server
+
+  Args:
+    server: the remote InferenceServer
+    aid: the agent id
+    model: the local model, which acts for weights unknown to the server
+    get_mid: a function returning the object ref of the current weights, 
+      or None if they are not retrieved from the parameter server
+  """
+  def __init__(self, server, aid: int, model: Model, get_mid: Callable):
+    self.server = server
+    self.aid = aid
+    self.model = model
+    self.get_mid = get_mid
+
+  def __call__(self, data, evaluation: bool=False):
+    mid = self.get_mid()
+    if mid is None:
+      return self.model.action(data, evaluation)
+    return ray.get(self.server.infer.remote(self.aid, [mid], data, evaluation))
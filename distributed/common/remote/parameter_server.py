@@ -1,4 +1,5 @@
 import collections
+import functools
 import itertools
 import os
 import filelock
@@ -10,6 +11,8 @@ import jax
 import ray
 
 from core.ckpt import pickle
+from core.ckpt.flat import FlatPacker
+from core.ckpt.writer import AsyncCheckpointer
 from core.elements.builder import ElementsBuilderVC
 from tools.log import do_logging
 from core.mixin.actor import RMSStats, combine_rms_stats, rms2dict
@@ -24,7 +27,9 @@ from tools.timer import Every
 from tools.utils import config_attr, dict2AttrDict
 from tools import yaml_op
 from distributed.common.typing import Status, ScoreMetrics
+from distributed.common.publication import receive_weights
 from distributed.common.remote.payoff import PayoffManager
+from distributed.common.strategy_pool import StrategyPool
 from distributed.common.utils import divide_runners, reset_policy_head
 
 
@@ -74,10 +79,34 @@ class ParameterServer(RayBase):
     date = get_date(config.model_name)
     self._pool_path = os.path.join(config.root_dir, f'{date}', f'{self._pool_name}.yaml')
 
-    self._params: List[Dict[ModelPath, Dict]] = [{} for _ in range(self.n_agents)]
+    # parameters of historical strategies are loaded on demand and the
+    # least recently used ones are evicted beyond max_pool_size_mb
+    self._params: List[StrategyPool] = [
+      StrategyPool(
+        self._load_params, 
+        self.config.get('max_pool_size_mb', 4096), 
+        # the object store copy goes with the evicted parameters
+        on_evict=functools.partial(self._release_weights, aid), 
+      )
+      for aid in range(self.n_agents)
+    ]
+    # the number of most likely opponents loaded ahead of sampling
+    self._n_prefetches = self.config.get('n_prefetches', 4)
     self._prepared_strategies: List[List[ModelWeights]] = \
       [[None for _ in range(self.n_agents)] for _ in range(self.n_runners)]
     self._reset_ready()
+    # model parameters are packed into flat buffers for runners
+    self._flat_weights = self.config.get('flat_weights', True)
+    self._packers = [FlatPacker() for _ in range(self.n_agents)]
+    # object refs of the latest version put in the object store, kept for
+    # active models and the max_weight_refs most recently used others
+    self._max_weight_refs = self.config.get('max_weight_refs', 32)
+    self._weight_refs: List[Dict[ModelPath, tuple]] = \
+      [collections.OrderedDict() for _ in range(self.n_agents)]
+    # publication versions of the model parameters held
+    self._param_versions: Dict[ModelPath, int] = {}
+    # writes checkpoints of active models in the background
+    self._checkpointer = AsyncCheckpointer('ps_save')
 
     self._rule_strategies = set()
 
@@ -187,6 +216,9 @@ class ParameterServer(RayBase):
 
     return dists
 
+  def get_strategy_pool_stats(self):
+    return [p.get_stats() for p in self._params]
+
   def get_runner_stats(self):
     self._update_runner_distribution()
     if self._iteration == 1 and not self._rule_strategies:
@@ -234,10 +266,14 @@ class ParameterServer(RayBase):
 
   def _update_active_model(self, aid, model: ModelPath):
     self._models['active'][aid] = model
+    if model is not None:
+      # active models are updated in memory and never evicted
+      self._params[aid].pin(model)
 
   def _update_active_models(self, models: List[ModelPath]):
     assert len(models) == self.n_agents, models
-    self._models['active'] = models
+    for aid, model in enumerate(models):
+      self._update_active_model(aid, model)
 
   def _reset_prepared_strategy(self, rid: int=-1):
     raise NotImplementedError
@@ -279,7 +315,7 @@ class ParameterServer(RayBase):
               for k in [MODEL, TRAIN_STEP, ANCILLARY]
               if k in self._params[i][m]
             }
-          mids.append(ray.put(ModelWeights(m, weights)))
+          mids.append(self._put_weights(i, ModelWeights(m, weights)))
       return mids
 
     def get_historical_mids(aid, mid, model_weights: ModelWeights):
@@ -310,10 +346,10 @@ class ParameterServer(RayBase):
         self._ready[rid] = True
 
     def prepare_models(aid, model_weights: ModelWeights):
-      model_weights.weights.pop(OPTIMIZER)
+      model_weights.weights.pop(OPTIMIZER, None)
       model_weights.weights[ANCILLARY] = \
         self._params[aid][model_weights.model].get(ANCILLARY, RMSStats({}, None))
-      mid = ray.put(model_weights)
+      mid = self._put_weights(aid, model_weights, use_cache=False)
 
       # prepare the most recent model for online runners
       prepare_recent_models(aid, mid, self.n_online_runners)
@@ -322,13 +358,19 @@ class ParameterServer(RayBase):
         prepare_historical_models(aid, mid, model_weights)
 
     assert self._models['active'][aid] == model_weights.model, (self._models['active'], model_weights.model)
-    assert set(model_weights.weights) == set([MODEL, OPTIMIZER, TRAIN_STEP]), list(model_weights.weights)
+    assert set(model_weights.weights) in (set([MODEL, TRAIN_STEP]), set([MODEL, OPTIMIZER, TRAIN_STEP])), list(model_weights.weights)
     assert aid == get_aid(model_weights.model.model_name), (aid, model_weights.model)
     
+    if not receive_weights(
+        model_weights, self._params[aid][model_weights.model], self._param_versions):
+      do_logging(f'Rejecting weights of {model_weights.model} encoded against an unknown version', color='red')
+      return False
     self._params[aid][model_weights.model].update(model_weights.weights)
+    self._params[aid].update_size(model_weights.model)
     model_weights = ModelWeights(model_weights.model, model_weights.weights.copy())
     prepare_models(aid, model_weights)
     # do_logging(f'Receiving weights of train step {model_weights.weights["train_step"]}')
+    return True
 
   def update_aux_stats(self, aid, model_weights: ModelWeights):
     assert len(model_weights.weights) == 1, list(model_weights.weights)
@@ -342,6 +384,41 @@ class ParameterServer(RayBase):
       )
     else:
       self._params[aid][model_weights.model][ANCILLARY] = model_weights.weights[ANCILLARY]
+    self._params[aid].update_size(model_weights.model)
+    self._release_weights(aid, model_weights.model)
+
+  def _put_weights(self, aid, model_weights: ModelWeights, use_cache=True):
+    """ Puts model_weights in the object store once per train step,
+    returning the same object ref for unchanged weights so that runners 
+    can skip fetching them
+    """
+    model = model_weights.model
+    version = model_weights.weights.get(TRAIN_STEP)
+    if use_cache and model in self._weight_refs[aid]:
+      cached_version, mid = self._weight_refs[aid][model]
+      if cached_version == version:
+        self._weight_refs[aid].move_to_end(model)
+        return mid
+    weights = model_weights.weights
+    if self._flat_weights and MODEL in weights:
+      weights = weights.copy()
+      weights[MODEL] = self._packers[aid].pack(weights[MODEL])
+    mid = ray.put(ModelWeights(model, weights))
+    self._weight_refs[aid][model] = (version, mid)
+    self._weight_refs[aid].move_to_end(model)
+    self._evict_weight_refs(aid)
+    return mid
+
+  def _evict_weight_refs(self, aid):
+    refs = self._weight_refs[aid]
+    inactive = [m for m in refs if m != self._models['active'][aid]]
+    for m in inactive[:max(len(inactive) - self._max_weight_refs, 0)]:
+      del refs[m]
+
+  def _release_weights(self, aid, model: ModelPath):
+    """ Drops the object ref of the model, freeing the object store copy
+    once runners release it """
+    self._weight_refs[aid].pop(model, None)
 
   def _update_runner_distribution(self):
     if self._iteration == 1 and not self._rule_strategies:
@@ -455,9 +532,12 @@ class ParameterServer(RayBase):
       config.update(kwargs)
       b.save_config(config)
     self._models['former'] = self._models['active'].copy()
+    # archived models are written after the checkpoint in flight
+    self._checkpointer.wait()
     for aid, model in enumerate(self._models['active']):
       self.save_params(model)
       self._update_active_model(aid, None)
+      self._params[aid].unpin(model)
       if model in self._opp_dist:
         del self._opp_dist[model]
     self._iteration += 1
@@ -524,16 +604,44 @@ class ParameterServer(RayBase):
   def get_counts(self):
     return self.payoff_manager.get_counts()
 
+  def get_evaluation_statistics(self, z=1.96):
+    return self.payoff_manager.get_evaluation_statistics(z)
+
+  def compute_meta_strategies(self):
+    return self.payoff_manager.compute_meta_strategies()
+
   def update_payoffs(self, models: List[ModelPath], scores: List[List[float]]):
     self.payoff_manager.update_payoffs(models, scores)
     self.payoff_manager.save(to_print=False)
 
+  def update_payoffs_many(
+    self, 
+    models: List[List[ModelPath]], 
+    score_sums: List[List[float]], 
+    counts: List[List[int]], 
+    score_m2s: List[List[float]]=None
+  ):
+    self.payoff_manager.update_payoffs_many(models, score_sums, counts, score_m2s)
+    self.payoff_manager.save(to_print=False)
+
   def _update_opp_distributions(self, aid, model: ModelPath):
     assert isinstance(model, ModelPath), model
     payoffs, weights, self._opp_dist[model] = self.payoff_manager.\
       compute_opponent_distribution(aid, model)
     do_logging(f'Updating opponent distributions ({self._opp_dist[model]}) '
                f'with weights ({weights}) and payoffs ({payoffs})', color='green')
+    self._prefetch_opponents(aid, self._opp_dist[model])
+
+  def _prefetch_opponents(self, aid, opp_dists: List[np.ndarray]):
+    """ Loads the most likely opponents of agent aid in the background """
+    sid2model = self.payoff_manager.get_sid2model()
+    for i in range(self.n_agents):
+      if i == aid or len(sid2model[i]) <= 1:
+        continue
+      probs = np.nan_to_num(opp_dists[i if i < aid else i-1][:-1])
+      idxes = np.argsort(-probs)[:self._n_prefetches]
+      self._params[i].prefetch(
+        [sid2model[i][j] for j in idxes if probs[j] > 0])
 
   """ Checkpoints """
   def save_active_model(self, model: ModelPath, train_step: int=None, 
@@ -550,8 +658,9 @@ class ParameterServer(RayBase):
     self.save_params(model)
 
   def save_active_models(self, train_step: int=None, env_step: int=None, to_print=True):
-    for m in self._models['active']:
-      self.save_active_model(m, train_step, env_step, to_print=to_print)
+    with self._checkpointer.save():
+      for m in self._models['active']:
+        self.save_active_model(m, train_step, env_step, to_print=to_print)
 
   def save_params(self, model: ModelPath, name='params'):
     assert model in self._models['active'], (model, self._models['active'])
@@ -566,10 +675,16 @@ class ParameterServer(RayBase):
     if rest_params:
       pickle.save_params(rest_params, model, name)
 
+  def _load_params(self, model: ModelPath, name='params'):
+    return pickle.restore_params(model, name, to_print=False)
+
   def restore_params(self, model: ModelPath, name='params'):
+    """ Adds model to the strategy pool, loading it on demand """
+    self._checkpointer.wait()
     aid = get_aid(model.model_name)
-    params = pickle.restore_params(model, name)
-    self._params[aid][model] = params
+    self._params[aid].add(model)
+    self._release_weights(aid, model)
+    self._param_versions.pop(model, None)
 
   def save(self):
     self.payoff_manager.save()
@@ -10,6 +10,7 @@ import numpy as np
 import ray
 
 from core.ckpt import pickle
+from core.ckpt.writer import AsyncCheckpointer
 from core.elements.builder import ElementsBuilderVC
 from tools.log import do_logging
 from core.mixin.actor import RMSStats, combine_rms_stats, rms2dict
@@ -27,6 +28,7 @@ from tools import yaml_op
 from distributed.common.names import *
 from distributed.common.typing import *
 from distributed.common.remote.payoff import PayoffManager
+from distributed.common.publication import receive_weights
 from distributed.common.utils import *
 
 
@@ -83,6 +85,10 @@ class SPParameterServer(RayBase):
     self._pool_path = os.path.join(self._pool_dir, f'{self._pool_name}.yaml')
 
     self._params: Dict[ModelPath, Dict] = {}
+    # publication versions of the model parameters held
+    self._param_versions: Dict[ModelPath, int] = {}
+    # writes checkpoints of the active model in the background
+    self._checkpointer = AsyncCheckpointer('ps_save')
     self._prepared_strategies: List[List[ModelWeights]] = \
       [[None for _ in range(2)] for _ in range(self.n_runners)]
     self._reset_ready()
@@ -267,14 +273,19 @@ class SPParameterServer(RayBase):
   ):
     assert aid == 0, aid
     assert self._models[ModelType.ACTIVE] == model_weights.model, (self._models[ModelType.ACTIVE], model_weights.model)
-    assert set(model_weights.weights) == set([MODEL, OPTIMIZER, TRAIN_STEP]), list(model_weights.weights)
+    assert set(model_weights.weights) in (set([MODEL, TRAIN_STEP]), set([MODEL, OPTIMIZER, TRAIN_STEP])), list(model_weights.weights)
     assert aid == get_aid(model_weights.model.model_name), (aid, model_weights.model)
     
+    if not receive_weights(
+        model_weights, self._params[model_weights.model], self._param_versions):
+      do_logging(f'Rejecting weights of {model_weights.model} encoded against an unknown version', color='red')
+      return False
     self._params[model_weights.model].update(model_weights.weights)
     # self.save_params(model_weights.model, to_print=False)
     model_weights = ModelWeights(model_weights.model, model_weights.weights.copy())
     self._prepare_models(model_weights)
     assert all(self._ready), self._ready
+    return True
 
   def _put_model_weights(self, model):
     if model in self._rule_strategies:
@@ -313,7 +324,7 @@ class SPParameterServer(RayBase):
       self._ready[rid] = True
 
   def _prepare_models(self, model_weights: ModelWeights):
-    model_weights.weights.pop(OPTIMIZER)
+    model_weights.weights.pop(OPTIMIZER, None)
     model_weights.weights[ANCILLARY] = \
       self._params[model_weights.model].get(ANCILLARY, RMSStats([], None))
     mid = ray.put(model_weights)
@@ -457,6 +468,8 @@ class SPParameterServer(RayBase):
     self.builder.save_config(config)
     self._models[ModelType.FORMER] = copy.copy(self._models[ModelType.ACTIVE])
     self._params[self._models[ModelType.FORMER]][STATUS] = status
+    # archived models are written after the checkpoint in flight
+    self._checkpointer.wait()
     self.save_params(self._models[ModelType.ACTIVE])
     self._update_active_model(None)
     if self._models[ModelType.ACTIVE] in self._opp_dist:
@@ -511,10 +524,26 @@ class SPParameterServer(RayBase):
   def get_counts(self):
     return self.payoff_manager.get_counts()
 
+  def get_evaluation_statistics(self, z=1.96):
+    return self.payoff_manager.get_evaluation_statistics(z)
+
+  def compute_meta_strategies(self):
+    return self.payoff_manager.compute_meta_strategies()
+
   def update_payoffs(self, models: List[ModelPath], scores: List[List[float]]):
     self.payoff_manager.update_payoffs(models, scores)
     self.payoff_manager.save(to_print=False)
 
+  def update_payoffs_many(
+    self, 
+    models: List[List[ModelPath]], 
+    score_sums: List[List[float]], 
+    counts: List[List[int]], 
+    score_m2s: List[List[float]]=None
+  ):
+    self.payoff_manager.update_payoffs_many(models, score_sums, counts, score_m2s)
+    self.payoff_manager.save(to_print=False)
+
   def _compute_opp_distributions(self, model: ModelPath):
     assert isinstance(model, ModelPath), model
     payoffs, weights, opp_dists = self.payoff_manager.\
@@ -550,8 +579,9 @@ class SPParameterServer(RayBase):
     self.save_params(model, to_print=to_print)
 
   def save_active_models(self, train_step: int=None, env_step: int=None, to_print=True):
-    self.save_active_model(self._models[ModelType.ACTIVE], train_step, 
-                           env_step, to_print=to_print)
+    with self._checkpointer.save():
+      self.save_active_model(self._models[ModelType.ACTIVE], train_step, 
+                             env_step, to_print=to_print)
 
   def save_params(self, model: ModelPath, name='params', to_print=True):
     assert model == self._models[ModelType.ACTIVE], (model, self._models[ModelType.ACTIVE])
@@ -569,7 +599,9 @@ class SPParameterServer(RayBase):
     if force or model not in self._params \
         or STATUS not in self._params[model] \
         or self._params[model][STATUS] == Status.TRAINING:
+      self._checkpointer.wait()
       self._params[model] = pickle.restore_params(model, name, backtrack=6)
+      self._param_versions.pop(model, None)
 
   def save(self):
     self.payoff_manager.save()
@@ -3,6 +3,7 @@ from typing import List, Union
 from tools.log import do_logging
 from core.typing import ModelPath, AttrDict
 from game.func import select_sampling_strategy
+from game.meta_solver import MetaSolver
 from game.payoff import PayoffTableWithModel, SelfPlayPayoffTableWithModel
 from tools.utils import dict2AttrDict
 
@@ -41,6 +42,7 @@ class PayoffManager:
     self.sampling_strategy = select_sampling_strategy(
       **self.config.sampling_strategy,
     )
+    self.meta_solver = MetaSolver(**self.config.get('meta_solver', {}))
 
   def size(self, aid: int=0):
     if self.self_play:
@@ -90,6 +92,28 @@ class PayoffManager:
     assert len(models) == self.n_agents, (models, self.n_agents)
     self.payoff_table.update(models, scores)
 
+  def update_payoffs_many(
+    self, 
+    models: List[List[ModelPath]], 
+    score_sums: List[List[float]], 
+    counts: List[List[int]], 
+    score_m2s: List[List[float]]=None
+  ):
+    """ Updates payoffs with the score sums and counts of many strategy 
+    profiles, and the sums of squared deviations of their scores """
+    assert all(len(ms) == self.n_agents for ms in models), (models, self.n_agents)
+    self.payoff_table.update_many(models, score_sums, counts, score_m2s)
+
+  def get_evaluation_statistics(self, z=1.96):
+    """ Returns the strategies, and the payoffs, counts and half widths 
+    of the confidence intervals of all strategy profiles """
+    return AttrDict(
+      strategies=self.get_all_strategies(), 
+      payoffs=self.payoff_table.get_payoffs(), 
+      counts=self.payoff_table.get_counts(), 
+      cis=self.payoff_table.get_confidence_intervals(z), 
+    )
+
   def get_payoffs_for_model(self, aid: int, model: ModelPath):
     if self.self_play:
       assert aid == 0, aid
@@ -123,3 +147,16 @@ class PayoffManager:
         filter_recent=True
       )
     return payoffs, weights, dists
+
+  def compute_meta_strategies(self):
+    """ Solve for the meta-strategies of all agents over the payoff 
+    tables, treating unmet strategy profiles as draws """
+    if self.self_play:
+      payoff = self.payoff_table.get_payoffs(fill_nan=0)
+      payoffs = [payoff, payoff.T]
+    else:
+      payoffs = self.payoff_table.get_payoffs(fill_nan=0)
+    strategies, nash_conv = self.meta_solver.compute(payoffs)
+    if self.self_play:
+      strategies = strategies[:1]
+    return strategies, nash_conv
@@ -2,14 +2,18 @@ from typing import Any, Dict, List, Set, Tuple, Union, Callable
 import collections
 import threading
 import numpy as np
+import jax
 import ray
 
 from .parameter_server import ParameterServer
 from .monitor import Monitor
+from .inference_server import RemoteInference
+from core.ckpt.flat import FlatPacker, FlatParams
 from core.ckpt.pickle import set_weights_for_agent
 from core.elements.agent import Agent
 from core.elements.buffer import Buffer
 from core.elements.builder import ElementsBuilder
+from core.jit import default_buckets
 from core.mixin.actor import RMS
 from core.names import ANCILLARY, MODEL, TRAIN_STEP
 from distributed.common.remote.base import RayBase
@@ -17,6 +21,8 @@ from core.typing import ModelStats, ModelWeights, ModelPath, dict2AttrDict
 from env.func import create_env
 from env.typing import EnvOutput
 from env.utils import divide_env_output
+from game.payoff import batch_m2
+from tools.log import do_logging
 from tools.timer import Timer, timeit
 
 
@@ -33,6 +39,7 @@ class MultiAgentRunner(RayBase):
     remote_buffers: List[RayBase]=None, 
     active_models: List[ModelPath]=None, 
     monitor: Monitor=None,
+    inference_server: RayBase=None,
   ):
     if isinstance(configs, list):
       configs = [dict2AttrDict(c) for c in configs]
@@ -71,8 +78,11 @@ class MultiAgentRunner(RayBase):
     #     (len(self.remote_buffers), self.n_agents)
     self.active_models: Set[ModelPath] = set(active_models) if active_models else set()
     self.current_models: List[ModelPath] = [None for _ in range(self.n_agents)]
+    # object refs of the weights currently set to agents
+    self._current_mids: List[ray.ObjectRef] = [None for _ in range(self.n_agents)]
     self.is_agent_active: List[bool] = [False for _ in range(self.n_agents)]
     self.monitor: Monitor = monitor
+    self.inference_server: RayBase = inference_server
 
     self.env_output = self.env.output()
     if self.self_play:
@@ -102,6 +112,8 @@ class MultiAgentRunner(RayBase):
     
     self.n_steps = self.config.n_steps
     self.steps_per_run = self.n_envs * self.n_steps
+    self._rollout_packers = [FlatPacker() for _ in range(self.n_agents)] \
+      if self.config.get('flat_rollout', True) else None
     self._steps = 0
     self._total_steps = 0
 
@@ -123,6 +135,12 @@ class MultiAgentRunner(RayBase):
         to_restore=False
       )
       self.agents.append(elements.agent)
+      if self.config.get('min_ready') and not elements.model.jit_action.buckets:
+        # batches of ready environments vary in size, which are padded to 
+        # buckets to avoid tracing jit_action for every size
+        elements.model.jit_action.set_buckets(default_buckets(self.n_envs))
+      if self.inference_server is not None:
+        self._serve_model(aid, elements)
 
       self.rms.append(elements.actor.get_raw_rms())
 
@@ -137,6 +155,14 @@ class MultiAgentRunner(RayBase):
     assert len(self.agents) == len(self.rms) == self.n_agents, (
       len(self.agents), len(self.rms), self.n_agents)
 
+  def _serve_model(self, aid: int, elements):
+    """ Routes the inference of the actor to the inference server """
+    # weights not retrieved from the parameter server are unknown to 
+    # the server, for which the local model acts
+    elements.actor.set_inference(RemoteInference(
+      self.inference_server, aid, elements.model, 
+      lambda: self._current_mids[aid]))
+
   def get_total_steps(self):
     return self._total_steps
 
@@ -190,11 +216,25 @@ class MultiAgentRunner(RayBase):
     @timeit
     def set_strategies(mids):
       for aid, mid in enumerate(mids):
-        model_weights = ray.get(mid)
+        if mid == self._current_mids[aid]:
+          # the parameter server puts each version once
+          self.is_agent_active[aid] = self.current_models[aid] in self.active_models
+          continue
+        if self.inference_server is None:
+          model_weights = ray.get(mid)
+        else:
+          # params stay on the inference server, which acts for mid
+          model_weights = ray.get(self.inference_server.get_strategy.remote([mid]))
         self.is_agent_active[aid] = model_weights.model in self.active_models
         self.current_models[aid] = model_weights.model
         assert set(model_weights.weights).issubset(set([MODEL, ANCILLARY, TRAIN_STEP])) or set(model_weights.weights) == set(['aid', 'iid', 'path']), set(model_weights.weights)
+        if isinstance(model_weights.weights.get(MODEL), FlatParams):
+          # copies once from the object store instead of at every inference
+          weights = model_weights.weights.copy()
+          weights[MODEL] = jax.device_put(weights[MODEL].unpack())
+          model_weights = ModelWeights(model_weights.model, weights)
         self.agents[aid].set_strategy(model_weights, env=self.env)
+        self._current_mids[aid] = mid
         # do_logging(f'Runner {self.id} receives weights of train step {model_weights.weights["train_step"]}')
       if self.self_play:
         self.is_agent_active = [True, False]
@@ -230,7 +270,10 @@ class MultiAgentRunner(RayBase):
       assert b.is_empty(), b.size()
 
     if self.is_simultaneous_move:
-      run_func = self._run_impl_ma
+      if self.config.get('min_ready') and hasattr(self.env, 'step_async'):
+        run_func = self._run_impl_ma_async
+      else:
+        run_func = self._run_impl_ma
     else:
       run_func = self._run_impl_ma_tb
     steps, n_episodes = run_func(stop_fn, to_store_data=to_store_data)
@@ -284,12 +327,14 @@ class MultiAgentRunner(RayBase):
       model = ModelPath(config['root_dir'], config['model_name'])
       set_weights_for_agent(agent, model, name=name)
       self.current_models[aid] = model
+      self._current_mids[aid] = None
 
   def set_weights_from_model_paths(self, model_paths: List[ModelPath], name='params'):
     assert len(model_paths) == len(self.current_models) == self.n_agents, (model_paths, self.current_models)
     for aid, (model, agent) in enumerate(zip(model_paths, self.agents)):
       set_weights_for_agent(agent, model, name=name)
       self.current_models[aid] = model
+      self._current_mids[aid] = None
 
   def set_running_steps(self, n_steps):
     self.n_steps = n_steps
@@ -356,36 +401,6 @@ class MultiAgentRunner(RayBase):
             stats.update(agent_terms[aid])
             buffer.collect(**stats)
 
-    def send_data(env_outs: List[Tuple]):
-      if to_store_data:
-        sent = False
-        prev_env_output = self.env.prev_output()
-        prev_agent_env_output = divide_env_output(prev_env_output)
-        for aid in range(self.n_agents):
-          agent = self.agents[aid]
-          out = env_outs[aid]
-          buffer = self.buffers[aid]
-          if self.is_agent_active[aid]:
-            assert buffer.is_full(), len(buffer)
-            if self.algo_type == 'onpolicy':
-              value = agent.compute_value(prev_agent_env_output[aid])
-              rid, data, n = buffer.retrieve_all_data({
-                'value': value,
-                'state_reset': out.reset
-              })
-            else:
-              rid, data, n = buffer.retrieve_all_data()
-            self._update_rms_from_batch(aid, data)
-            data = self._normalize_data(agent.actor, data)
-            if self.self_play:
-              self.remote_buffers[0].merge_data.remote(rid, data, n)
-            else:
-              self.remote_buffers[aid].merge_data.remote(rid, data, n)
-            sent = True
-      else:
-        sent = True
-      return sent
-
     step = 0
     n_episodes = 0
     agent_env_outs = divide_env_output(self.env_output)
@@ -397,10 +412,133 @@ class MultiAgentRunner(RayBase):
       n_episodes += self._log_for_done(agent_env_outs[0].reset)
       step += 1
 
-    send_data(agent_env_outs)
+    self._send_data(agent_env_outs, to_store_data)
 
     return step * self.n_envs, n_episodes
 
+  def _run_impl_ma_async(self, stop_fn, to_store_data: bool=False):
+    """ Runs as _run_impl_ma, but infers for and steps whichever
+    min_ready environments finish first instead of waiting for all.
+    Transitions are kept per environment and passed to buffers step
+    by step once every environment has collected n_steps of them
+    """
+    take = lambda x, i: jax.tree_util.tree_map(lambda v: v[i], x)
+
+    @timeit
+    def agents_infer(idxes: List[int], agent_env_outs: List[EnvOutput]):
+      action, terms = [], []
+      for aid, agent in enumerate(self.agents):
+        # run the memory state of the inferred environments only
+        state = agent.get_states()
+        if state is not None:
+          agent.set_states(take(state, idxes))
+        a, t = agent(agent_env_outs[aid], evaluation=self.evaluation)
+        if state is not None:
+          new_state = jax.tree_util.tree_map(np.array, state)
+          for x, v in zip(jax.tree_util.tree_leaves(new_state), 
+              jax.tree_util.tree_leaves(agent.get_states())):
+            x[idxes] = v
+          agent.set_states(new_state)
+        action.append(a)
+        terms.append(t)
+      return action, terms
+
+    @timeit
+    def step_env():
+      out, idxes = self.env.step_wait(self.config.min_ready)
+      return divide_env_output(out), idxes
+
+    @timeit
+    def record_data(
+      idxes: List[int], 
+      agent_env_outs: List[EnvOutput], 
+      agent_actions: List, 
+      agent_terms: List[dict]
+    ):
+      for j, i in enumerate(idxes):
+        inflight[i] = []
+        for aid, agent in enumerate(self.agents):
+          if self.is_agent_active[aid]:
+            env_out = agent_env_outs[aid]
+            stats = {
+              'obs': env_out.obs, 
+              'action': agent_actions[aid], 
+              TRAIN_STEP: agent.get_train_step() * np.ones_like(env_out.reset)
+            }
+            stats.update(agent_terms[aid])
+            inflight[i].append(take(stats, j))
+          else:
+            inflight[i].append(None)
+
+    @timeit
+    def store_data(idxes: List[int], next_agent_env_outs: List[EnvOutput]):
+      next_obs = self.env.prev_obs(idxes)
+      for aid, agent in enumerate(self.agents):
+        if self.is_agent_active[aid]:
+          next_env_out = next_agent_env_outs[aid]
+          stats = {
+            'reward': agent.actor.normalize_reward(next_env_out.reward),
+            'discount': next_env_out.discount,
+            'reset': next_env_out.reset,
+            'next_obs': next_obs[aid],
+          }
+          for j, i in enumerate(idxes):
+            inflight[i][aid].update(take(stats, j))
+      for i in idxes:
+        trajs[i].append(inflight.pop(i))
+
+    def send_data():
+      if to_store_data:
+        # steps are collected across environments; those beyond the
+        # shortest trajectory, if stopped early, cannot be aligned
+        n_steps = min(len(traj) for traj in trajs)
+        if any(len(traj) > n_steps for traj in trajs):
+          do_logging(f'Discarding {sum(len(traj) for traj in trajs) - n_steps * len(trajs)} '
+            f'transitions beyond the shortest trajectory of {n_steps} steps', level='warning')
+        for t in range(n_steps):
+          for aid, buffer in enumerate(self.buffers):
+            if self.is_agent_active[aid]:
+              buffer.collect(**jax.tree_util.tree_map(
+                lambda *xs: np.stack(xs), *[traj[t][aid] for traj in trajs]))
+      self._send_data(divide_env_output(self.env_output), to_store_data)
+
+    env_steps = np.zeros(self.n_envs, dtype=np.int32)
+    n_episodes = 0
+    trajs = [[] for _ in range(self.n_envs)]
+    inflight = {}
+    idxes = list(range(self.n_envs))
+    agent_env_outs = divide_env_output(self.env_output)
+    while not stop_fn(step=env_steps.min(), n_episodes=n_episodes):
+      if to_store_data:
+        # environments with a full trajectory wait for the others
+        ready = [j for j, i in enumerate(idxes) if env_steps[i] < self.n_steps]
+        if len(ready) < len(idxes):
+          idxes = [idxes[j] for j in ready]
+          agent_env_outs = [take(o, ready) for o in agent_env_outs]
+      if idxes:
+        action, terms = agents_infer(idxes, agent_env_outs)
+        if to_store_data:
+          record_data(idxes, agent_env_outs, action, terms)
+        self.env.step_async(action, idxes)
+      agent_env_outs, idxes = step_env()
+      if to_store_data:
+        store_data(idxes, agent_env_outs)
+      env_steps[idxes] += 1
+      n_episodes += self._log_for_done(agent_env_outs[0].reset, idxes)
+
+    if self.env.pending_idxes():
+      # finishes the steps in flight, keeping their transitions
+      out, idxes = self.env.step_wait()
+      agent_env_outs = divide_env_output(out)
+      if to_store_data:
+        store_data(idxes, agent_env_outs)
+      env_steps[idxes] += 1
+      n_episodes += self._log_for_done(agent_env_outs[0].reset, idxes)
+    self.env_output = self.env.output()
+    send_data()
+
+    return int(env_steps.sum()), n_episodes
+
   def _run_impl_ma_tb(self, stop_fn, to_store_data: bool=False):
     @timeit
     def agents_infer(agents: List[Agent], agent_env_outs: List[EnvOutput]):
@@ -531,10 +669,7 @@ class MultiAgentRunner(RayBase):
             rid, data, n = buffer.retrieve_all_data()
             self._update_rms_from_batch(aid, data)
             data = self._normalize_data(self.agents[aid].actor, data)
-            if self.self_play:
-              self.remote_buffers[0].merge_data.remote(rid, data, n)
-            else:
-              self.remote_buffers[aid].merge_data.remote(rid, data, n)
+            self._merge_to_remote_buffer(aid, rid, data, n)
             # assert np.all(np.any(data.action_mask, -1))
 
     step = 0
@@ -556,6 +691,43 @@ class MultiAgentRunner(RayBase):
 
     return step * self.n_envs, n_episodes
 
+  def _send_data(self, env_outs: List[Tuple], to_store_data: bool):
+    if to_store_data:
+      sent = False
+      prev_env_output = self.env.prev_output()
+      prev_agent_env_output = divide_env_output(prev_env_output)
+      for aid in range(self.n_agents):
+        agent = self.agents[aid]
+        out = env_outs[aid]
+        buffer = self.buffers[aid]
+        if self.is_agent_active[aid]:
+          assert buffer.is_full(), len(buffer)
+          if self.algo_type == 'onpolicy':
+            value = agent.compute_value(prev_agent_env_output[aid])
+            rid, data, n = buffer.retrieve_all_data({
+              'value': value,
+              'state_reset': out.reset
+            })
+          else:
+            rid, data, n = buffer.retrieve_all_data()
+          self._update_rms_from_batch(aid, data)
+          data = self._normalize_data(agent.actor, data)
+          self._merge_to_remote_buffer(aid, rid, data, n)
+          sent = True
+    else:
+      sent = True
+    return sent
+
+  def _merge_to_remote_buffer(self, aid, rid, data, n):
+    if self._rollout_packers is not None:
+      # one contiguous buffer is sent instead of many small arrays
+      with Timer('rollout_pack'):
+        data = self._rollout_packers[aid].pack(data)
+    if self.self_play:
+      self.remote_buffers[0].merge_data.remote(rid, data, n)
+    else:
+      self.remote_buffers[aid].merge_data.remote(rid, data, n)
+
   @timeit
   def _update_rms(self, agent_env_outs: Union[EnvOutput, List[EnvOutput]]):
     assert len(self.rms) == len(agent_env_outs), (len(self.rms), len(agent_env_outs))
@@ -588,9 +760,11 @@ class MultiAgentRunner(RayBase):
     return data
   
   @timeit
-  def _log_for_done(self, reset):
-    # logging when any env is reset 
-    done_env_ids = [i for i, r in enumerate(reset) if np.all(r)]
+  def _log_for_done(self, reset, idxes=None):
+    # logging when any env is reset, idxes are the env ids of reset
+    if idxes is None:
+      idxes = range(len(reset))
+    done_env_ids = [i for i, r in zip(idxes, reset) if np.all(r)]
     if done_env_ids:
       info = self.env.info(done_env_ids)
       stats = collections.defaultdict(list)
@@ -658,16 +832,23 @@ class MultiAgentRunner(RayBase):
     return config
 
   def _update_payoffs(self):
+    # sends the score sums, counts and sums of squared deviations 
+    # rather than the raw scores
     pid = None
     if self.self_play:
       if len(self.scores) > 0:
-        pid = self.parameter_server.update_payoffs.remote(
-          self.current_models, self.scores)
+        pid = self.parameter_server.update_payoffs_many.remote(
+          [self.current_models], [sum(self.scores)], [len(self.scores)], 
+          [batch_m2(self.scores)])
         self.scores = []
     else:
       if sum([len(s) for s in self.scores]) > 0:
-        pid = self.parameter_server.update_payoffs.remote(
-          self.current_models, self.scores)
+        pid = self.parameter_server.update_payoffs_many.remote(
+          [self.current_models], 
+          [[sum(s) for s in self.scores]], 
+          [[len(s) for s in self.scores]], 
+          [[batch_m2(s) for s in self.scores]]
+        )
         self.scores = [[] for _ in range(self.n_agents)]
     return pid
 
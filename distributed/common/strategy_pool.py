@@ -0,0 +1,180 @@
+""" A memory-bounded store of the strategies in the pool
+
+PBT runs accumulate hundreds of historical strategies, of which only the
+active ones and the opponents sampled for them are needed at a time. A
+StrategyPool knows every strategy but keeps the parameters of only the
+most recently used ones resident, up to max_size_mb; the others are
+loaded from their checkpoints when accessed. Strategies that are not
+checkpointed, i.e., active and rule-based ones, are pinned and never
+evicted; since active parameters are updated in place, their owner
+reports their sizes through update_size. Likely opponents are loaded
+ahead of time by a background thread.
+"""
+import collections
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Set
+from jax import tree_util
+
+from core.typing import ModelPath
+from tools.log import do_logging
+
+
+def _nbytes(params: Dict):
+  return sum(getattr(x, 'nbytes', 0) for x in tree_util.tree_leaves(params))
+
+
+class StrategyPool:
+  """ A mapping from model paths to their parameters
+
+  Args:
+    load_fn: a function returning the checkpointed parameters of a model
+    max_size_mb: the size of resident parameters beyond which the least
+      recently used unpinned ones are evicted. Unbounded if None
+    on_evict: a function called with every model whose parameters are
+      evicted, e.g., to release copies of them held elsewhere
+  """
+  def __init__(
+    self, 
+    load_fn: Callable[[ModelPath], Dict], 
+    max_size_mb: float=None, 
+    on_evict: Callable[[ModelPath], None]=None, 
+  ):
+    self._load_fn = load_fn
+    self._on_evict = on_evict
+    self._max_bytes = None if max_size_mb is None else max_size_mb * 2**20
+    # all models, mapped to their resident parameters or None
+    self._models: Dict[ModelPath, Dict] = {}
+    self._resident: Dict[ModelPath, int] = collections.OrderedDict()
+    self._pinned: Set[ModelPath] = set()
+    self._nbytes = 0
+    self._warned = False
+    self._lock = threading.RLock()
+    self._loading: Dict[ModelPath, Future] = {}
+    self._executor = ThreadPoolExecutor(1)
+    self.n_loads = 0
+    self.n_hits = 0
+
+  def __contains__(self, model: ModelPath):
+    return model in self._models
+
+  def __iter__(self):
+    return iter(list(self._models))
+
+  def __len__(self):
+    return len(self._models)
+
+  def __getitem__(self, model: ModelPath):
+    with self._lock:
+      if model not in self._models:
+        raise KeyError(model)
+      if model in self._resident:
+        self._resident.move_to_end(model)
+        self.n_hits += 1
+        return self._models[model]
+      future = self._loading.get(model)
+    params = future.result() if future is not None else self._load(model)
+    with self._lock:
+      if model in self._resident:
+        return self._models[model]
+      self._insert(model, params)
+      return params
+
+  def __setitem__(self, model: ModelPath, params: Dict):
+    """ Sets the parameters of a model not checkpointed yet, which stay
+    resident until unpinned """
+    with self._lock:
+      self._pinned.add(model)
+      self._insert(model, params)
+
+  def add(self, model: ModelPath):
+    """ Adds a checkpointed model, loaded when first accessed. The
+    resident parameters are discarded if the model is known """
+    with self._lock:
+      if model in self._resident:
+        self._nbytes -= self._resident.pop(model)
+      self._models[model] = None
+
+  def pin(self, model: ModelPath):
+    with self._lock:
+      self._pinned.add(model)
+
+  def unpin(self, model: ModelPath):
+    """ Allows evicting the model, whose parameters have been saved """
+    with self._lock:
+      self._pinned.discard(model)
+      self.update_size(model)
+
+  def update_size(self, model: ModelPath):
+    """ Recomputes the size of the model's parameters after they are
+    modified in place """
+    with self._lock:
+      if model in self._resident:
+        self._nbytes -= self._resident[model]
+        self._resident[model] = _nbytes(self._models[model])
+        self._nbytes += self._resident[model]
+      self._evict()
+
+  def is_resident(self, model: ModelPath):
+    return model in self._resident
+
+  def prefetch(self, models: Iterable[ModelPath]):
+    """ Loads models in the background, returning the futures of the
+    loads in flight """
+    futures = []
+    with self._lock:
+      for m in models:
+        if m in self._models and m not in self._resident and m not in self._loading:
+          self._loading[m] = self._executor.submit(self._prefetch, m)
+        if m in self._loading:
+          futures.append(self._loading[m])
+    return futures
+
+  def get_stats(self):
+    return dict(
+      n_models=len(self._models),
+      n_resident=len(self._resident),
+      resident_mb=self._nbytes / 2**20,
+      n_loads=self.n_loads,
+      n_hits=self.n_hits,
+    )
+
+  def _load(self, model: ModelPath):
+    params = self._load_fn(model)
+    self.n_loads += 1
+    return params
+
+  def _prefetch(self, model: ModelPath):
+    try:
+      params = self._load(model)
+      with self._lock:
+        if model in self._models and model not in self._resident:
+          self._insert(model, params)
+      return params
+    finally:
+      with self._lock:
+        self._loading.pop(model, None)
+
+  def _insert(self, model: ModelPath, params: Dict):
+    if model in self._resident:
+      self._nbytes -= self._resident.pop(model)
+    self._models[model] = params
+    self._resident[model] = _nbytes(params)
+    self._nbytes += self._resident[model]
+    self._evict()
+
+  def _evict(self):
+    if self._max_bytes is None:
+      return
+    for m in list(self._resident):
+      if self._nbytes <= self._max_bytes:
+        break
+      if m not in self._pinned:
+        self._nbytes -= self._resident.pop(m)
+        self._models[m] = None
+        if self._on_evict is not None:
+          self._on_evict(m)
+    if self._nbytes > self._max_bytes and not self._warned:
+      self._warned = True
+      do_logging(f'Pinned strategies take {self._nbytes / 2**20:.3g}MB, '
+        f'exceeding the limit of {self._max_bytes / 2**20:.3g}MB', level='warning')
@@ -5,7 +5,7 @@ from tools.ray_setup import sigint_shutdown_ray
 from tools import pkg
 
 
-def main(config, payoff_name, n):
+def main(config, payoff_name, n, target_ci=None):
   ray.init()
   sigint_shutdown_ray()
 
@@ -21,6 +21,6 @@ def main(config, payoff_name, n):
   controller = Controller(config, to_restore=False)
   controller.build_managers_for_evaluation(config)
 
-  controller.evaluate_all(n, payoff_name)
+  controller.evaluate_all(n, payoff_name, target_ci)
 
   ray.shutdown()
@@ -140,10 +140,10 @@ class VecEnvBase:
     new_actions = [batch_dicts(a) for a in zip(*actions)]
     return new_actions
 
-  def divide_actions(self, actions):
+  def divide_actions(self, actions, n=None):
     new_actions = [
       [{k: v if v.shape == () else v[i] for k, v in action.items()} for action in actions]
-      for i in range(self.n_envs)
+      for i in range(self.n_envs if n is None else n)
     ]
     return new_actions
 
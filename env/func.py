@@ -50,6 +50,11 @@ def create_env(
         EnvType = VecEnv
     else:
       EnvType = Env
+    if config.get('vec_env') == 'subproc':
+      # runs envs in worker processes that share outputs via shared memory
+      assert EnvType == VecEnv, f'{EnvType.__name__} does not support subproc'
+      from env.subproc_env import SubprocVecEnv
+      EnvType = SubprocVecEnv
     env = EnvType(config, env_fn, agents=agents)
   else:
     from env.ray_env import RayVecEnv
@@ -4,6 +4,7 @@ import gym
 
 from open_spiel.python import rl_environment
 from env.utils import *
+from game.cfr import GameTree
 
 
 class OpenSpiel:
@@ -109,6 +110,10 @@ class OpenSpiel:
 
     return obs
 
+  def build_game_tree(self):
+    """ Enumerates the game tree into flat arrays for CFR and exploitability """
+    return GameTree.from_game(self.game)
+
   def close(self):
     return
 
@@ -0,0 +1,401 @@
+import multiprocessing as mp
+from multiprocessing import connection, shared_memory
+import traceback
+import cloudpickle
+import numpy as np
+from jax import tree_util
+
+from core.typing import AttrDict, dict2AttrDict
+from env import make_env
+from env.cls import VecEnvBase
+from env.typing import EnvOutput
+from tools.utils import batch_dicts
+
+
+ALIGNMENT = 64
+# commands whose outputs are written to the shared buffer
+OUTPUT_COMMANDS = ('step', 'reset', 'output', 'prev_output')
+
+
+def _to_batch_type(x):
+  """ Matches the container types produced by batch_env_output """
+  if isinstance(x, dict):
+    res = AttrDict()
+    for k, v in x.items():
+      res[k] = _to_batch_type(v)
+    return res
+  elif isinstance(x, (list, tuple)) and not hasattr(x, '_fields'):
+    return [_to_batch_type(v) for v in x]
+  return x
+
+
+class SharedEnvOutput:
+  """ EnvOutputs of n_envs environments in a single shared memory block
+
+  Every leaf of an EnvOutput gets an array of shape (n_envs, *leaf_shape)
+  in the block, laid out from the output of a single environment.
+  """
+  def __init__(self, n_envs, template, name=None):
+    leaves, self._treedef = tree_util.tree_flatten(template)
+    leaves = [np.asarray(x) for x in leaves]
+    for x in leaves:
+      if x.dtype.kind in ('U', 'S', 'O'):
+        raise ValueError(f'Cannot share non-numeric env output of dtype {x.dtype}')
+    self._specs = []
+    offset = 0
+    for x in leaves:
+      self._specs.append(((n_envs, *x.shape), x.dtype, offset))
+      nbytes = n_envs * x.nbytes
+      offset += (nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    self._is_owner = name is None
+    self._shm = shared_memory.SharedMemory(
+      name=name, create=self._is_owner, size=max(offset, 1))
+    self._arrays = [np.ndarray(shape, dtype, buffer=self._shm.buf, offset=offset)
+      for shape, dtype, offset in self._specs]
+
+  @property
+  def name(self):
+    return self._shm.name
+
+  def write(self, eid, out):
+    leaves = tree_util.tree_leaves(out)
+    if len(leaves) != len(self._arrays):
+      raise ValueError(f'Env output of {len(leaves)} leaves does not match '
+        f'the shared layout of {len(self._arrays)} leaves')
+    for v, x in zip(self._arrays, leaves):
+      v[eid] = x
+
+  def read(self, idxes):
+    """ Copies batched outputs of environments idxes out of the block """
+    out = tree_util.tree_unflatten(
+      self._treedef, [v[idxes] for v in self._arrays])
+    return EnvOutput(*[_to_batch_type(x) for x in out])
+
+  def close(self):
+    self._arrays = []
+    self._shm.close()
+    if self._is_owner:
+      self._shm.unlink()
+
+
+def _worker(remote, parent_remote, env_fn, config, eids):
+  """ Runs environments eids, writing their outputs into the shared block """
+  parent_remote.close()
+  env_fn = cloudpickle.loads(env_fn)
+  envs = []
+  for eid in eids:
+    config_i = config.copy()
+    config_i['eid'] += eid
+    config_i['seed'] += eid
+    envs.append(env_fn(config_i, config_i['eid']))
+  buffer = None
+
+  while True:
+    cmd, data = remote.recv()
+    try:
+      if cmd in OUTPUT_COMMANDS:
+        if cmd == 'step':
+          idxes, actions = data
+          outs = [envs[i].step(a) for i, a in zip(idxes, actions)]
+        else:
+          idxes = data
+          outs = [getattr(envs[i], cmd)() for i in idxes]
+        if buffer is None:
+          # the main process lays out the shared block from these outputs
+          remote.send(('ok', outs))
+        else:
+          for i, out in zip(idxes, outs):
+            buffer.write(eids[i], out)
+          remote.send(('ok', None))
+      elif cmd == 'call':
+        name, idxes, args = data
+        remote.send(('ok', [getattr(envs[i], name)(*a)
+          for i, a in zip(idxes, args)]))
+      elif cmd == 'getattr':
+        attr = getattr(envs[0], data)
+        remote.send(('ok', (True, None) if callable(attr) else (False, attr)))
+      elif cmd == 'hasattr':
+        remote.send(('ok', hasattr(envs[0], data)))
+      elif cmd == 'init':
+        remote.send(('ok', (envs[0].stats(), envs[0].max_episode_steps)))
+      elif cmd == 'attach':
+        buffer = SharedEnvOutput(*data)
+        remote.send(('ok', None))
+      elif cmd == 'close':
+        for env in envs:
+          if hasattr(env, 'close'):
+            env.close()
+        if buffer is not None:
+          buffer.close()
+        remote.send(('ok', None))
+        break
+      else:
+        raise ValueError(f'Unknown command: {cmd}')
+    except Exception:
+      remote.send(('error', traceback.format_exc()))
+  remote.close()
+
+
+class SubprocVecEnv(VecEnvBase):
+  """ A VecEnv whose environments run in worker processes
+
+  Environments are sharded into n_workers processes. Observations,
+  rewards, discounts and resets are written by workers into a shared
+  memory block and copied out by the main process, so only actions and
+  commands go through the pipes. The interface follows VecEnv.
+
+  Besides the synchronous step, step_async sends actions to a subset
+  of environments and step_wait returns as soon as min_ready of those
+  in flight have finished, along with their indices. Each worker runs
+  one request at a time, so workers of the returned environments are
+  idle and can serve other calls while the rest keep stepping.
+  Environments reset themselves at the end of episodes as in VecEnv.
+  """
+  def __init__(self, config, env_fn=make_env, agents={}):
+    config = dict2AttrDict(config, to_copy=True)
+    self.n_envs = n_envs = config.pop('n_envs', 1)
+    n_workers = min(config.pop('n_workers', n_envs) or n_envs, n_envs)
+    start_method = config.pop('start_method', 'spawn')
+    self.name = config['env_name']
+    config.setdefault('eid', 0)
+    self.env_type = 'VecEnv'
+
+    ctx = mp.get_context(start_method)
+    self._worker_eids = [s.tolist()
+      for s in np.array_split(np.arange(n_envs), n_workers)]
+    self._eid2worker = [(wid, i)
+      for wid, eids in enumerate(self._worker_eids) for i in range(len(eids))]
+    self._remotes, self._processes = [], []
+    env_fn = cloudpickle.dumps(env_fn)
+    for eids in self._worker_eids:
+      remote, worker_remote = ctx.Pipe()
+      p = ctx.Process(target=_worker,
+        args=(worker_remote, remote, env_fn, config, eids), daemon=True)
+      p.start()
+      worker_remote.close()
+      self._remotes.append(remote)
+      self._processes.append(p)
+
+    # envs stepped by each worker since the last step_async
+    self._pending = [None for _ in self._remotes]
+    self._stats, self.max_episode_steps = self._send_and_recv(
+      [(0, ('init', None))])[0]
+    # the shared block is laid out from the first outputs, which workers 
+    # send through the pipes until they are attached to it
+    self._template = None
+    self._buffer = None
+    self._attached = [False for _ in self._remotes]
+    self._stats['n_runners'] = 1
+    self._stats['n_envs'] = self.n_envs
+    self._closed = False
+
+  def __getattr__(self, name):
+    if name.startswith("_"):
+      raise AttributeError(
+        "attempted to get missing private attribute '{}'".format(name)
+      )
+    is_callable, attr = self._send_and_recv([(0, ('getattr', name))])[0]
+    if is_callable:
+      # as VecEnv, methods not defined here are called on the first env
+      return lambda *args: self._call(name, [0], [args])[0]
+    return attr
+
+  def random_action(self, *args, **kwargs):
+    actions = self._call('random_action')
+    return self.combine_actions(actions)
+
+  def reset(self, idxes=None, convert_batch=True, **kwargs):
+    return self._output_op('reset', idxes, convert_batch)
+
+  def step(self, actions, convert_batch=True, **kwargs):
+    self.step_async(actions)
+    out, _ = self.step_wait(self.n_envs, convert_batch=convert_batch)
+    return out
+
+  def step_async(self, actions, idxes=None):
+    """ Starts stepping environments idxes with batched actions """
+    idxes = self._get_idxes(idxes)
+    actions = self.divide_actions(actions, len(idxes))
+    assert len(idxes) == len(actions), (len(idxes), len(actions))
+    eid2action = dict(zip(idxes, actions))
+    groups = self._group_by_worker(idxes)
+    assert all(self._pending[wid] is None for wid in groups), \
+      f'Environments {self.pending_idxes()} are still running'
+    for wid, js in groups.items():
+      eids = [self._worker_eids[wid][j] for j in js]
+      self._remotes[wid].send(('step', (js, [eid2action[i] for i in eids])))
+      self._pending[wid] = eids
+
+  def step_wait(self, min_ready=None, timeout=None, convert_batch=True):
+    """ Waits until at least min_ready environments in flight finish
+    or timeout expires, returning their outputs and indices
+    """
+    n_pending = len(self.pending_idxes())
+    min_ready = n_pending if min_ready is None else min(min_ready, n_pending)
+    idxes = []
+    while True:
+      remotes = [r for r, p in zip(self._remotes, self._pending) if p is not None]
+      if not remotes:
+        break
+      ready = connection.wait(remotes, 0 if len(idxes) >= min_ready else timeout)
+      if not ready:
+        break
+      errors = []
+      for r in ready:
+        wid = self._remotes.index(r)
+        status, result = r.recv()
+        eids = self._pending[wid]
+        self._pending[wid] = None
+        if status == 'error':
+          errors.append(f'Env worker {wid} failed:\n{result}')
+        else:
+          self._store(eids, result)
+          idxes.extend(eids)
+      if errors:
+        raise RuntimeError('\n'.join(errors))
+    idxes = sorted(idxes)
+    self._attach_idle_workers()
+    return self._read(idxes, convert_batch), idxes
+
+  def pending_idxes(self):
+    return [i for eids in self._pending if eids is not None for i in eids]
+
+  def manual_reset(self):
+    self._call('manual_reset')
+
+  def score(self, idxes=None, **kwargs):
+    return self._call('score', idxes)
+
+  def epslen(self, idxes=None, **kwargs):
+    return self._call('epslen', idxes)
+
+  def mask(self, idxes=None):
+    return np.stack(self._call('mask', idxes))
+
+  def game_over(self):
+    return np.stack(self._call('game_over'))
+
+  def prev_obs(self, idxes=None, convert_batch=True):
+    obs = self._call('prev_obs', idxes)
+    if convert_batch:
+      obs = [batch_dicts(o) if isinstance(o[0], dict) else np.stack(o)
+        for o in zip(*obs)]
+    return obs
+
+  def info(self, idxes=None, convert_batch=False):
+    info = self._call('info', idxes)
+    if convert_batch:
+      info = batch_dicts(info)
+    return info
+
+  def prev_output(self, idxes=None, convert_batch=True):
+    return self._output_op('prev_output', idxes, convert_batch)
+
+  def output(self, idxes=None, convert_batch=True):
+    return self._output_op('output', idxes, convert_batch)
+
+  def get_screen(self, size=None, convert_batch=True):
+    has_screen = self._send_and_recv([(0, ('hasattr', 'get_screen'))])[0]
+    imgs = self._call('get_screen' if has_screen else 'render')
+    if size is not None:
+      import cv2
+      # cv2 receive size of form (width, height)
+      imgs = [cv2.resize(i, size[::-1], interpolation=cv2.INTER_AREA)
+              for i in imgs]
+    if convert_batch:
+      imgs = np.stack(imgs)
+    return imgs
+
+  def record_default_state(self, aids, states):
+    state_type = type(states)
+    states = [state_type(*s) for s in zip(*states)]
+    self._call('record_default_state', args=list(zip(aids, states)))
+
+  def close(self):
+    if self._closed:
+      return
+    self._send_and_recv([(wid, ('close', None))
+      for wid in range(len(self._remotes))])
+    for p in self._processes:
+      p.join()
+    if self._buffer is not None:
+      self._buffer.close()
+    self._closed = True
+
+  """ Implementation """
+  def _send_and_recv(self, cmds):
+    """ Sends (wid, cmd) pairs and returns the replies in order """
+    assert all(self._pending[wid] is None for wid, _ in cmds), \
+      'Call step_wait before sending other commands to stepping workers'
+    for wid, cmd in cmds:
+      self._remotes[wid].send(cmd)
+    # reads every reply before raising, keeping the pipes in sync
+    results, errors = [], []
+    for wid, _ in cmds:
+      status, result = self._remotes[wid].recv()
+      if status == 'error':
+        errors.append(f'Env worker {wid} failed:\n{result}')
+      results.append(result)
+    if errors:
+      raise RuntimeError('\n'.join(errors))
+    return results
+
+  def _store(self, eids, outs):
+    """ Writes outputs sent through the pipe by a worker not attached to
+    the shared block yet """
+    if outs is None:
+      return
+    if self._buffer is None:
+      self._template = outs[0]
+      self._buffer = SharedEnvOutput(self.n_envs, self._template)
+    for i, out in zip(eids, outs):
+      self._buffer.write(i, out)
+
+  def _attach_idle_workers(self):
+    wids = [wid for wid, (attached, pending) in enumerate(zip(self._attached, self._pending))
+      if not attached and pending is None]
+    if self._buffer is None or not wids:
+      return
+    self._send_and_recv([(wid, ('attach', (self.n_envs, self._template, self._buffer.name)))
+      for wid in wids])
+    for wid in wids:
+      self._attached[wid] = True
+
+  def _group_by_worker(self, idxes):
+    groups = {}
+    for i in idxes:
+      wid, j = self._eid2worker[i]
+      groups.setdefault(wid, []).append(j)
+    return groups
+
+  def _call(self, name, idxes=None, args=None):
+    """ Calls method name of environments idxes with per-env args """
+    idxes = self._get_idxes(idxes)
+    if args is None:
+      args = [() for _ in idxes]
+    eid2args = dict(zip(idxes, args))
+    groups = self._group_by_worker(idxes)
+    results = self._send_and_recv([
+      (wid, ('call', (name, js, [eid2args[self._worker_eids[wid][j]] for j in js])))
+      for wid, js in groups.items()
+    ])
+    outs = {}
+    for (wid, js), res in zip(groups.items(), results):
+      for j, r in zip(js, res):
+        outs[self._worker_eids[wid][j]] = r
+    return [outs[i] for i in idxes]
+
+  def _output_op(self, name, idxes, convert_batch):
+    idxes = self._get_idxes(idxes)
+    groups = self._group_by_worker(idxes)
+    results = self._send_and_recv([(wid, (name, js)) for wid, js in groups.items()])
+    for (wid, js), outs in zip(groups.items(), results):
+      self._store([self._worker_eids[wid][j] for j in js], outs)
+    self._attach_idle_workers()
+    return self._read(idxes, convert_batch)
+
+  def _read(self, idxes, convert_batch):
+    out = self._buffer.read(idxes)
+    if not convert_batch:
+      out = [tree_util.tree_map(lambda x: x[i], out) for i in range(len(idxes))]
+    return out
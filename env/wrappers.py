@@ -812,7 +812,7 @@ class MultiAgentUnitsDivision(gym.Wrapper):
       assert len(obs) == self.n_agents, (len(obs), self.n_agents)
       return obs
     else:
-      return [jax.tree_map(lambda x: x[uids], obs) for uids in self.aid2uids]
+      return [jax.tree_util.tree_map(lambda x: x[uids], obs) for uids in self.aid2uids]
 
 
 class PopulationSelection(gym.Wrapper):
@@ -897,7 +897,7 @@ class DataProcess(gym.Wrapper):
         self.obs_dtype = {'obs': infer_dtype(self.observation_space.dtype, precision)}
 
   def observation(self, observation):
-    observation = jax.tree_map(lambda x: convert_dtype(x, self.precision), observation)
+    observation = jax.tree_util.tree_map(lambda x: convert_dtype(x, self.precision), observation)
     return observation
 
   def reset(self):
@@ -905,7 +905,7 @@ class DataProcess(gym.Wrapper):
     return self.observation(obs)
 
   def step(self, action, **kwargs):
-    action = jax.tree_map(np.asarray, action)
+    action = jax.tree_util.tree_map(np.asarray, action)
     if not isinstance(action, (list, tuple)):
       action = [action]
     action = [a if isinstance(a, dict) else {DEFAULT_ACTION: a} for a in action]
@@ -1,13 +1,46 @@
-from typing import List
+from typing import List, Tuple
 import numpy as np
 from scipy import linalg as la
+from scipy import sparse
+from scipy.sparse import linalg as sla
 
 
 class AlphaRank:
-  def __init__(self, alpha, m=5, epsilon=1e-5):
+  """ AlphaRank with vectorized transition matrices
+
+  A strategy profile only transitions to the profiles in which a single
+  agent deviates, so the transition matrix of a multi-population game
+  is kept sparse. Small chains are solved exactly with a dense eigen
+  decomposition; larger ones with sparse eigs, or power iteration if it
+  fails, warm-started from the previous stationary distribution, which
+  is embedded into the new profile space as strategies are added.
+
+  Args:
+    alpha: the ranking-intensity
+    m: the population size
+    epsilon: the perturbation added to fixation probabilities
+    max_dense_size: the number of profiles up to which the dense solver
+      is used
+    tol: the tolerance of the iterative solvers
+    max_iterations: the number of power iterations
+  """
+  def __init__(
+    self, 
+    alpha, 
+    m=5, 
+    epsilon=1e-5, 
+    max_dense_size=200, 
+    tol=1e-10, 
+    max_iterations=100000, 
+  ):
     self.alpha = alpha
     self.m = m
     self.epsilon = epsilon
+    self.max_dense_size = max_dense_size
+    self.tol = tol
+    self.max_iterations = max_iterations
+    # the latest stationary distribution over the strategy profiles
+    self._pi: np.ndarray = None
 
   """ Rank """
   def compute_rank(
@@ -37,11 +70,11 @@ class AlphaRank:
     pi = self.compute_stationary_distribution(payoffs, False)
 
     ns = payoffs[0].shape
-    strategy_masses = [np.zeros(n) for n in ns]
-    for si, p in enumerate(pi):
-      sp = self._idx2sp(si, ns)
-      for a, s in zip(strategy_masses, sp):
-        a[s] += p
+    pi = pi.reshape(ns)
+    strategy_masses = [
+      pi.sum(axis=tuple(j for j in range(len(ns)) if j != i)) 
+      for i in range(len(ns))
+    ]
 
     agent_ranks = [np.argsort(s)[::-1] for s in strategy_masses]
     if return_mass:
@@ -56,103 +89,127 @@ class AlphaRank:
     is_single_population=False
   ):
     """ Compute the stationary distribution from given payoffs """
-    # print('payoff', *payoffs, sep='\n')
-    transition = self.compute_transition_matrix(payoffs, is_single_population)
-    # print('transition', transition, sep='\n')
+    transition = self.compute_transition_matrix(
+      payoffs, is_single_population, to_sparse=True)
+    shape = payoffs[0].shape[:1] if is_single_population else payoffs[0].shape
+    if transition.shape[0] <= self.max_dense_size:
+      pi = self._solve_dense(transition.toarray())
+    else:
+      pi = self._solve_sparse(transition, self._warm_start(shape))
+    self._pi = pi.reshape(shape)
+    return pi
+
+  def _solve_dense(self, transition: np.ndarray):
     eig_vals, eig_vecs = la.eig(transition, left=True, right=False)
-    # print('eigen values', np.real(eig_vals))
     mask = np.abs(1-eig_vals) < 1e-10
     if np.sum(mask) != 1:
       raise ValueError(
         f'Expected 1 stationary distribution, but found {np.sum(mask)}')
-    # print('eigen vectors', eig_vecs)
     eig_vec = eig_vecs[:, mask]
-    # print('eigen vector', eig_vec)
     pi = eig_vec / np.sum(eig_vec)
     pi = pi.real.flatten()
     return pi
+
+  def _solve_sparse(self, transition: sparse.csr_matrix, pi: np.ndarray=None):
+    """ Solves pi = pi @ transition from the initial guess pi """
+    transition_t = transition.T.tocsr()
+    try:
+      _, eig_vecs = sla.eigs(
+        transition_t, k=1, which='LM', v0=pi, tol=self.tol)
+      pi = np.abs(eig_vecs[:, 0].real)
+      pi = pi / np.sum(pi)
+    except sla.ArpackNoConvergence:
+      pi = self._power_iteration(transition_t, pi)
+    return pi
+
+  def _power_iteration(self, transition_t: sparse.csr_matrix, pi: np.ndarray=None):
+    if pi is None:
+      pi = np.full(transition_t.shape[0], 1 / transition_t.shape[0])
+    next_pi = pi
+    for _ in range(self.max_iterations):
+      next_pi = transition_t @ pi
+      next_pi = next_pi / np.sum(next_pi)
+      # the residual of pi = pi @ transition
+      if np.abs(next_pi - pi).sum() < self.tol:
+        break
+      pi = next_pi
+    return next_pi
+
+  def _warm_start(self, shape: Tuple[int]):
+    """ Embeds the previous stationary distribution into the profiles of 
+    shape, spreading a uniform mass over the new ones """
+    if self._pi is None or self._pi.ndim != len(shape) \
+        or any(o > n for o, n in zip(self._pi.shape, shape)):
+      return None
+    pi = np.full(shape, 1 / np.prod(shape))
+    pi[tuple(slice(0, n) for n in self._pi.shape)] += self._pi
+    pi = pi.reshape(-1)
+    return pi / np.sum(pi)
   
   """ Transition Matrix """
   def compute_transition_matrix(
     self, 
     payoffs: List[np.ndarray], 
-    is_single_population=False
+    is_single_population=False, 
+    to_sparse=False
   ):
-    """ Compute the Markov transition matrix from given payoffs """
+    """ Compute the Markov transition matrix from given payoffs, as a 
+    scipy sparse matrix if to_sparse """
     if is_single_population:
-      return self._compute_transition_matrix_sp(payoffs)
+      assert len(payoffs) == 1, len(payoffs)
+      n_strategies = payoffs[0].shape[0]
+      rows, cols, delta_f = self._deviations_sp(payoffs[0])
+      eta = 1 / (n_strategies - 1)
     else:
       assert len(payoffs) == payoffs[0].ndim, (len(payoffs), payoffs[0].ndim)
-      return self._compute_transition_matrix_mp(payoffs)
-    
-  def _compute_transition_matrix_sp(self, payoffs: List[np.ndarray]):
-    assert len(payoffs) == 1, len(payoffs)
-    # for p in payoffs:
-    #   assert p.ndim == 2, p.shape
-    #   np.testing.assert_allclose(p.T, -p)
-    payoff = payoffs[0]
+      n_strategies = np.prod(payoffs[0].shape)
+      rows, cols, delta_f = self._deviations_mp(payoffs)
+      eta = 1 / np.sum([n-1 for n in payoffs[0].shape])
+    trans_prob = self._compute_transition_probability(delta_f, eta)
+    stay_prob = 1 - np.bincount(rows, trans_prob, minlength=n_strategies)
+    assert np.all(stay_prob >= -1e-8), np.min(stay_prob)
+    diag = np.arange(n_strategies)
+    transition_matrix = sparse.csr_matrix(
+      (np.concatenate([trans_prob, stay_prob]), 
+       (np.concatenate([rows, diag]), np.concatenate([cols, diag]))), 
+      shape=(n_strategies, n_strategies)
+    )
+    if to_sparse:
+      return transition_matrix
+    return transition_matrix.toarray()
+
+  def _deviations_sp(self, payoff: np.ndarray):
+    """ Returns the indices of the strategies before and after each 
+    mutation, and the payoff difference between them """
     n_strategies = payoff.shape[0]
-    eta = 1 / (n_strategies - 1)
-    transition_matrix = np.zeros_like(payoff, dtype=np.float64)
-
-    for s1 in range(n_strategies):
-      for s2 in range(n_strategies):
-        if s1 != s2:
-          transition_matrix[s1, s2] = self._compute_transition_probability(
-            payoff[s2, s1] - payoff[s1, s2], eta)
-      pair_transition = np.sum(transition_matrix[s1])
-      assert pair_transition <= 1, (s1, transition_matrix[s1])
-      transition_matrix[s1, s1] = 1 - pair_transition
-    
-    return transition_matrix
-
-  def _compute_transition_matrix_mp(self, payoffs: List[np.ndarray]):
+    rows, cols = np.nonzero(~np.eye(n_strategies, dtype=bool))
+    delta_f = payoff[cols, rows] - payoff[rows, cols]
+    return rows, cols, delta_f
+
+  def _deviations_mp(self, payoffs: List[np.ndarray]):
+    """ Returns the indices of the profiles before and after each 
+    single-agent deviation, and the payoff difference of the deviating 
+    agent between them """
     n_agent_strategies = payoffs[0].shape
     for p in payoffs:
       assert n_agent_strategies == p.shape
-    
-    eta = 1 / np.sum([n-1 for n in n_agent_strategies])
-
     n_strategy_profiles = np.prod(n_agent_strategies)
-    transition_matrix = np.zeros((n_strategy_profiles, n_strategy_profiles), dtype=np.float64)
-
-    def compute_strategy_profile_from_id(idx):
-      n_agents = len(n_agent_strategies)
-      sp = np.zeros(n_agents, dtype=np.int32)
-      for i in range(n_agents - 1, -1, -1):
-        sp[i] = idx % n_agent_strategies[i]
-        idx //= n_agent_strategies[i]
-      return tuple(sp)
-
-    def yield_next_profile(current_profile):
-      for k in range(len(n_agent_strategies)):
-        for s in range(n_agent_strategies[k]):
-          if s != current_profile[k]:
-            new_profile = list(current_profile)
-            new_profile[k] = s
-            yield k, tuple(new_profile)
-    
-    def compute_id_from_strategy_profile(sp, n_sp):
-      if len(sp) == 1:
-        return sp[0]
-      
-      return sp[-1] + n_sp[-1] * compute_id_from_strategy_profile(sp[:-1], n_sp[:-1])
-    
-    def compute_transition_probability(payoff, row_sp, col_sp):
-      row_f = payoff[row_sp]
-      col_f = payoff[col_sp]
-      return self._compute_transition_probability(col_f - row_f, eta)
-      
-    for row_sp_id in range(n_strategy_profiles):
-      row_sp = compute_strategy_profile_from_id(row_sp_id)
-      for i, col_sp in yield_next_profile(row_sp):
-        assert row_sp[i] != col_sp[i], (row_sp[i], col_sp[i])
-        col_sp_id = compute_id_from_strategy_profile(col_sp, n_agent_strategies)
-        transition_matrix[row_sp_id, col_sp_id] = \
-          compute_transition_probability(payoffs[i], row_sp, col_sp)
-      transition_matrix[row_sp_id, row_sp_id] = 1 - sum(transition_matrix[row_sp_id, :])
-
-    return transition_matrix
+    profiles = np.arange(n_strategy_profiles)
+    all_rows, all_cols, all_delta_f = [], [], []
+    for k, n in enumerate(n_agent_strategies):
+      stride = np.prod(n_agent_strategies[k+1:], dtype=np.int64)
+      strategy = profiles // stride % n
+      base = profiles - strategy * stride
+      cols = base[:, None] + np.arange(n)[None] * stride
+      rows = np.broadcast_to(profiles[:, None], cols.shape)
+      mask = cols != rows
+      rows, cols = rows[mask], cols[mask]
+      payoff = payoffs[k].reshape(-1).astype(np.float64)
+      all_rows.append(rows)
+      all_cols.append(cols)
+      all_delta_f.append(payoff[cols] - payoff[rows])
+    return np.concatenate(all_rows), np.concatenate(all_cols), \
+      np.concatenate(all_delta_f)
 
   def _compute_transition_probability(self, delta_f, eta):
     """ Compute the Markov transition probability
@@ -163,7 +220,7 @@ class AlphaRank:
       eta: 1/(\sum_k |S_k|)
     """
     fix_prob = self._compute_fixation_probability(delta_f)
-    fix_prob = min(fix_prob + self.epsilon, 1)
+    fix_prob = np.minimum(fix_prob + self.epsilon, 1)
     trans_prob = eta * fix_prob
     return trans_prob
 
@@ -175,93 +232,29 @@ class AlphaRank:
   ):
     if is_single_population:
       assert len(payoffs) == 1, len(payoffs)
-      return self._compute_fixation_matrix_sp(payoffs)
+      n_strategies = payoffs[0].shape[0]
+      rows, cols, delta_f = self._deviations_sp(payoffs[0])
     else:
       assert len(payoffs) == payoffs[0].ndim, (len(payoffs), payoffs[0].ndim)
-      return self._compute_fixation_matrix_mp(payoffs)
-
-  def _compute_fixation_matrix_sp(self, payoffs: List[np.ndarray]):
-    assert len(payoffs) == 1, len(payoffs)
-    # for p in payoffs:
-    #   assert p.ndim == 2, p.shape
-    #   np.testing.assert_allclose(p.T, -p)
-    payoff = payoffs[0]
-    n_strategies = payoff.shape[0]
-    fixation_matrix = np.zeros_like(payoff)
-
-    for s1 in range(n_strategies):
-      for s2 in range(n_strategies):
-        if s1 != s2:
-          fixation_matrix[s1, s2] = self._compute_fixation_probability(
-            payoff[s2, s1] - payoff[s1, s2])
-
-    return fixation_matrix
-
-  def _compute_fixation_matrix_mp(self, payoffs: List[np.ndarray]):
-    n_agent_strategies = payoffs[0].shape
-    for p in payoffs:
-      assert n_agent_strategies == p.shape
-    
-    n_strategy_profiles = np.prod(n_agent_strategies)
-    rho = np.zeros((n_strategy_profiles, n_strategy_profiles), dtype=np.float64)
-
-    def compute_strategy_profile_from_id(idx):
-      n_agents = len(n_agent_strategies)
-      sp = np.zeros(len(n_agents), dtype=np.int32)
-      for i in range(n_agents - 1, -1, -1):
-        sp[i] = idx % n_agent_strategies[i]
-        idx //= n_agent_strategies[i]
-      return sp
-
-    def yield_next_profile(current_profile):
-      for k in range(len(n_agent_strategies)):
-        for s in range(n_agent_strategies[k]):
-          if s != current_profile[k]:
-            new_profile = current_profile.copy()
-            new_profile[k] = s
-            yield k, new_profile
-    
-    def compute_id_from_strategy_profile(sp, n_sp):
-      if len(sp) == 1:
-        return sp[0]
-      
-      return sp[-1] + n_sp[-1] * compute_id_from_strategy_profile(sp[:-1], n_sp[:-1])
-    
-    def compute_fixation_probability(payoff, row_sp, col_sp):
-      row_f = payoff[row_sp]
-      col_f = payoff[col_sp]
-      return self._compute_fixation_probability(col_f - row_f)
-      
-    for row_sp_id in range(n_strategy_profiles):
-      row_sp = compute_strategy_profile_from_id(row_sp_id)
-      for i, col_sp in yield_next_profile(row_sp):
-        assert row_sp[i] != col_sp[i], (row_sp[i], col_sp[i])
-        col_sp_id = compute_id_from_strategy_profile(col_sp, n_agent_strategies)
-        rho[row_sp_id, col_sp_id] = \
-          compute_fixation_probability(payoffs[i], row_sp, col_sp)
-
+      n_strategies = np.prod(payoffs[0].shape)
+      rows, cols, delta_f = self._deviations_mp(payoffs)
+    rho = np.zeros((n_strategies, n_strategies), dtype=np.float64)
+    rho[rows, cols] = self._compute_fixation_probability(delta_f)
     return rho
 
   def _compute_fixation_probability(self, delta_f):
-    if np.isclose(delta_f, 0):
-      return 1 / self.m
-    delta_f = delta_f.astype(np.float64)
-    e1 = np.exp(-self.alpha * delta_f)
-    e2 = e1**self.m
-    if np.isinf(e2):
-      return 0
-    rho = (1 - e1) / (1 - e2)
+    delta_f = np.asarray(delta_f, dtype=np.float64)
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+      e1 = np.exp(-self.alpha * delta_f)
+      e2 = e1**self.m
+      rho = (1 - e1) / (1 - e2)
+    rho = np.where(np.isinf(e2), 0, rho)
+    rho = np.where(np.isclose(delta_f, 0), 1 / self.m, rho)
     return rho
 
   def _idx2sp(self, si, ns):
     """ Convert strategy profile index (si) to a strategy profile """
-    sp = []
-    for k, _ in enumerate(ns):
-      n = np.prod(ns[k+1:], dtype=np.int32)
-      i = si // n
-      si -= i * n
-      sp.append(i)
-    return sp
+    return list(np.unravel_index(si, ns))
 
 
 if __name__ == '__main__':
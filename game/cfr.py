@@ -0,0 +1,506 @@
+""" Array-based counterfactual regret minimization
+
+The game tree of a two-or-more-player, turn-based game with perfect
+recall is enumerated once, breadth first, into flat arrays indexed by
+node: the acting player, the parent, the action leading to the node, the
+chance probability of that action, the information set and the terminal
+returns. Since nodes are ordered by depth and children of a node are
+contiguous, every depth level is a slice of the arrays, and an iteration
+of CFR amounts to
+  1. a forward pass propagating reach probabilities level by level,
+  2. a backward pass summing children values into their parents level
+     by level with np.add.reduceat,
+  3. scattering the instantaneous regrets and the reach-weighted
+     strategies of all edges into infoset-action tables with np.bincount.
+Chance-sampling MCCFR samples an outcome at every chance node while
+walking down the levels and restricts all passes to the sampled subtree.
+
+Games are given by their initial state following the OpenSpiel state
+interface, e.g., pyspiel states or game.kuhn_poker.KuhnPokerState.
+Subtrees below the outcomes of a chance root may be processed by
+multiple processes, each computing the updates within its subtree.
+Workers are spawned rather than forked, since forking a process with
+JAX or other threaded libraries loaded may deadlock, and receive their
+subtrees once through the pool initializer.
+"""
+import multiprocessing
+from typing import Dict, List
+import numpy as np
+
+from tools.log import do_logging
+
+
+CHANCE = -1
+TERMINAL = -4
+ALGORITHMS = ('cfr', 'cfr+', 'mccfr')
+
+
+class GameTree:
+  def __init__(
+    self,
+    n_players: int,
+    n_actions: int,
+    player: np.ndarray,
+    parent: np.ndarray,
+    action: np.ndarray,
+    chance_prob: np.ndarray,
+    infoset: np.ndarray,
+    returns: np.ndarray,
+    infoset_player: np.ndarray,
+    legal_actions: np.ndarray,
+    infoset_keys: List[str],
+  ):
+    self.n_players = n_players
+    self.n_actions = n_actions
+    self.player = player
+    self.parent = parent
+    self.action = action
+    self.chance_prob = chance_prob
+    self.infoset = infoset
+    self.returns = returns
+    self.infoset_player = infoset_player
+    self.legal_actions = legal_actions
+    self.infoset_keys = infoset_keys
+    self.infoset_index: Dict[str, int] = {k: i for i, k in enumerate(infoset_keys)}
+    self._build_index()
+
+  @property
+  def n_nodes(self):
+    return self.player.size
+
+  @property
+  def n_infosets(self):
+    return self.infoset_player.size
+
+  @classmethod
+  def from_state(cls, state, n_players: int, n_actions: int):
+    """ Enumerates the tree below state breadth first """
+    player, parent, action, chance_prob, infoset, returns = [], [], [], [], [], []
+    infoset_index, infoset_player, legal_actions = {}, [], []
+    states = [state]
+    parent.append(-1)
+    action.append(-1)
+    chance_prob.append(1.)
+    i = 0
+    while i < len(states):
+      s = states[i]
+      # drops the expanded states
+      states[i] = None
+      if s.is_terminal():
+        player.append(TERMINAL)
+        infoset.append(-1)
+        returns.append(s.returns())
+        i += 1
+        continue
+      returns.append([0.] * n_players)
+      if s.is_chance_node():
+        player.append(CHANCE)
+        infoset.append(-1)
+        children = s.chance_outcomes()
+      else:
+        p = s.current_player()
+        assert p >= 0, f'Simultaneous-move games are not supported: {p}'
+        player.append(p)
+        key = s.information_state_string(p)
+        actions = s.legal_actions(p)
+        if key not in infoset_index:
+          infoset_index[key] = len(infoset_player)
+          infoset_player.append(p)
+          mask = np.zeros(n_actions, bool)
+          mask[actions] = True
+          legal_actions.append(mask)
+        infoset.append(infoset_index[key])
+        children = [(a, 1.) for a in actions]
+      for a, prob in children:
+        states.append(s.child(a))
+        parent.append(i)
+        action.append(a)
+        chance_prob.append(prob)
+      i += 1
+
+    return cls(
+      n_players=n_players,
+      n_actions=n_actions,
+      player=np.array(player, np.int32),
+      parent=np.array(parent, np.int64),
+      action=np.array(action, np.int64),
+      chance_prob=np.array(chance_prob, np.float64),
+      infoset=np.array(infoset, np.int64),
+      returns=np.array(returns, np.float64),
+      infoset_player=np.array(infoset_player, np.int32),
+      legal_actions=np.array(legal_actions, bool).reshape(-1, n_actions),
+      infoset_keys=list(infoset_index),
+    )
+
+  @classmethod
+  def from_game(cls, game):
+    """ Builds the tree of an OpenSpiel game """
+    return cls.from_state(
+      game.new_initial_state(), game.num_players(), game.num_distinct_actions())
+
+  def subtree(self, nodes: np.ndarray):
+    """ Returns the tree induced by nodes, which must be closed under
+    taking parents, sharing the information sets of this tree """
+    nodes = np.sort(nodes)
+    new_index = np.full(self.n_nodes, -1, np.int64)
+    new_index[nodes] = np.arange(nodes.size)
+    parent = self.parent[nodes]
+    return GameTree(
+      n_players=self.n_players,
+      n_actions=self.n_actions,
+      player=self.player[nodes],
+      parent=np.where(parent >= 0, new_index[parent], -1),
+      action=self.action[nodes],
+      chance_prob=self.chance_prob[nodes],
+      infoset=self.infoset[nodes],
+      returns=self.returns[nodes],
+      infoset_player=self.infoset_player,
+      legal_actions=self.legal_actions,
+      infoset_keys=self.infoset_keys,
+    )
+
+  def split(self, n: int):
+    """ Splits the tree into up to n subtrees, each below a group of the
+    outcomes of the chance root """
+    if self.player[0] != CHANCE or n <= 1:
+      return [self]
+    root_children = self.parent == 0
+    group = np.full(self.n_nodes, -1, np.int64)
+    group[root_children] = np.arange(np.sum(root_children)) % n
+    for level in self.levels[2:]:
+      group[level] = group[self.parent[level]]
+    return [
+      self.subtree(np.concatenate([[0], np.flatnonzero(group == g)]))
+      for g in range(min(n, np.sum(root_children)))
+    ]
+
+  def _build_index(self):
+    assert np.all(self.parent[1:] < np.arange(1, self.n_nodes)), \
+      'Nodes must be in breadth-first order'
+    depth = np.zeros(self.n_nodes, np.int64)
+    while True:
+      new_depth = depth.copy()
+      new_depth[1:] = depth[self.parent[1:]] + 1
+      if np.array_equal(new_depth, depth):
+        break
+      depth = new_depth
+    assert np.all(np.diff(depth) >= 0), 'Nodes must be in breadth-first order'
+    self.depth = depth
+    bounds = np.flatnonzero(np.diff(depth)) + 1
+    self.levels = [np.arange(s, e) for s, e in zip(
+      np.concatenate([[0], bounds]), np.concatenate([bounds, [self.n_nodes]]))]
+    # segments of children sharing a parent at each level
+    self.segments = [self._segments(level) for level in self.levels[1:]]
+    self.is_chance_edge = np.zeros(self.n_nodes, bool)
+    self.is_chance_edge[1:] = self.player[self.parent[1:]] == CHANCE
+    self.edges = [
+      np.flatnonzero((self.parent >= 0) & (self.player[np.maximum(self.parent, 0)] == p))
+      for p in range(self.n_players)
+    ]
+    for p, edges in enumerate(self.edges):
+      infosets = self.infoset[self.parent[edges]]
+      depths = self.depth[self.parent[edges]]
+      first = np.full(self.n_infosets, -1)
+      first[infosets] = depths
+      assert np.all(first[infosets] == depths), \
+        'The nodes of an information set must be at the same depth'
+
+  def _segments(self, level: np.ndarray):
+    """ Returns the starts of the runs of nodes in level sharing a parent,
+    and their parents """
+    p = self.parent[level]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(p)) + 1])
+    return starts, p[starts]
+
+  def uniform_policy(self):
+    return self.legal_actions / np.sum(self.legal_actions, -1, keepdims=True)
+
+  def edge_weights(
+    self, 
+    policy: np.ndarray, 
+    chance_weights: np.ndarray=None, 
+    nodes: np.ndarray=None
+  ):
+    """ Returns the probability of taking the action leading to each node,
+    computed for non-root nodes if given and one elsewhere """
+    weights = np.ones(self.n_nodes)
+    if nodes is None:
+      nodes = np.arange(1, self.n_nodes)
+    is_chance = self.is_chance_edge[nodes]
+    decision = nodes[~is_chance]
+    weights[decision] = policy[
+      self.infoset[self.parent[decision]], self.action[decision]]
+    chance = nodes[is_chance]
+    weights[chance] = self.chance_prob[chance] \
+      if chance_weights is None else chance_weights[chance]
+    return weights
+
+  def compute_reaches(self, weights: np.ndarray, levels: List[np.ndarray]=None):
+    """ Returns the reach probabilities of all players, the chance reach
+    being the last column. Only nodes in levels are computed if given """
+    reach = np.ones((self.n_nodes, self.n_players + 1))
+    actor = np.where(self.player == CHANCE, self.n_players, self.player)
+    for level in (self.levels if levels is None else levels)[1:]:
+      parent = self.parent[level]
+      reach[level] = reach[parent]
+      reach[level, actor[parent]] *= weights[level]
+    return reach
+
+  def compute_values(
+    self, 
+    weights: np.ndarray, 
+    br_player: int=None, 
+    reach=None, 
+    levels: List[np.ndarray]=None
+  ):
+    """ Returns the expected returns of all nodes. Player br_player best
+    responds if given, in which case reach is required. Only nodes in 
+    levels are computed if given """
+    values = self.returns.copy()
+    if levels is None:
+      levels, segments = self.levels, self.segments
+    else:
+      segments = [self._segments(level) for level in levels[1:]]
+    for level, (starts, parents) in zip(levels[:0:-1], segments[::-1]):
+      w = weights[level]
+      if br_player is not None:
+        w = self._best_response_weights(level, values, reach, br_player, w)
+      values[parents] = np.add.reduceat(w[:, None] * values[level], starts)
+    return values
+
+  def _best_response_weights(self, level, values, reach, p, weights):
+    parents = self.parent[level]
+    is_br = self.player[parents] == p
+    if not np.any(is_br):
+      return weights
+    edges = level[is_br]
+    infosets = self.infoset[parents[is_br]]
+    cf_reach = np.prod(np.delete(reach[parents[is_br]], p, -1), -1)
+    q = np.bincount(
+      infosets * self.n_actions + self.action[edges],
+      cf_reach * values[edges, p],
+      minlength=self.n_infosets * self.n_actions
+    ).reshape(self.n_infosets, self.n_actions)
+    q = np.where(self.legal_actions, q, -np.inf)
+    best = np.argmax(q, -1)
+    weights = weights.copy()
+    weights[is_br] = (self.action[edges] == best[infosets]).astype(np.float64)
+    return weights
+
+  def compute_updates(self, policy: np.ndarray, player: int, rng=None):
+    """ Returns the instantaneous regrets and the reach-weighted policies
+    of player, and the values of the root. Chance outcomes are sampled
+    if rng is given, in which case only the sampled subtree is traversed """
+    if rng is None:
+      levels = self.levels
+      edges = self.edges[player]
+      weights = self.edge_weights(policy)
+    else:
+      levels, chance_weights = self._sample_levels(rng)
+      nodes = np.concatenate(levels)[1:]
+      edges = nodes[self.player[self.parent[nodes]] == player]
+      weights = self.edge_weights(policy, chance_weights, nodes)
+    reach = self.compute_reaches(weights, levels)
+    values = self.compute_values(weights, levels=levels)
+    parents = self.parent[edges]
+    cf_reach = np.prod(np.delete(reach[parents], player, -1), -1)
+    flat_idxes = self.infoset[parents] * self.n_actions + self.action[edges]
+    size = self.n_infosets * self.n_actions
+    regrets = np.bincount(
+      flat_idxes, cf_reach * (values[edges, player] - values[parents, player]),
+      minlength=size).reshape(self.n_infosets, self.n_actions)
+    strategies = np.bincount(
+      flat_idxes, reach[parents, player] * weights[edges],
+      minlength=size).reshape(self.n_infosets, self.n_actions)
+    return regrets, strategies, values[0]
+
+  def _sample_levels(self, rng):
+    """ Samples one outcome at every chance node of the sampled subtree,
+    returning its levels and the importance weights of chance edges """
+    is_sampled = np.zeros(self.n_nodes, bool)
+    is_sampled[0] = True
+    chance_weights = np.zeros(self.n_nodes)
+    levels = self.levels[:1]
+    for level in self.levels[1:]:
+      level = level[is_sampled[self.parent[level]]]
+      is_chance = self.is_chance_edge[level]
+      if np.any(is_chance):
+        edges = level[is_chance]
+        chance_weights[edges] = self._sample_chance(edges, rng)
+        # drops the outcomes not sampled
+        level = level[~is_chance | (chance_weights[level] > 0)]
+      if level.size == 0:
+        break
+      is_sampled[level] = True
+      levels.append(level)
+    return levels, chance_weights
+
+  def _sample_chance(self, edges: np.ndarray, rng):
+    """ Samples one of the chance edges sharing a parent, returning the 
+    weights of edges, the chance probabilities over the sampling ones for 
+    the sampled outcomes and zero for the others """
+    probs = self.chance_prob[edges]
+    parents = self.parent[edges]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(parents)) + 1])
+    segment = np.cumsum(np.isin(np.arange(edges.size), starts)) - 1
+    # the outcomes of a subtree's root may not sum to one
+    totals = np.add.reduceat(probs, starts)[segment]
+    probs = probs / totals
+    upper = np.cumsum(probs)
+    upper = upper - (upper[starts] - probs[starts])[segment]
+    lower = upper - probs
+    # guards against rounding errors
+    upper[np.concatenate([starts[1:], [edges.size]]) - 1] = np.inf
+    u = rng.random(starts.size)[segment]
+    # importance weights of the sampled outcomes
+    return np.where((lower <= u) & (u < upper), totals, 0.)
+
+
+def compute_best_response_values(tree: GameTree, policy: np.ndarray):
+  """ Returns the values of all players when best responding to the others
+  following policy, and when all players follow policy """
+  weights = tree.edge_weights(policy)
+  reach = tree.compute_reaches(weights)
+  on_policy = tree.compute_values(weights)[0]
+  br_values = np.array([
+    tree.compute_values(weights, br_player=p, reach=reach)[0, p]
+    for p in range(tree.n_players)
+  ])
+  return br_values, on_policy
+
+
+def compute_nash_conv(tree: GameTree, policy: np.ndarray):
+  """ Returns the sum of the gains from best responding of all players """
+  br_values, on_policy = compute_best_response_values(tree, policy)
+  return float(np.sum(br_values - on_policy))
+
+
+def compute_exploitability(tree: GameTree, policy: np.ndarray):
+  return compute_nash_conv(tree, policy) / tree.n_players
+
+
+def aggregate_policies(
+  tree: GameTree,
+  policies: List[List[np.ndarray]],
+  probs: List[np.ndarray]=None
+):
+  """ Returns the behavior policy equivalent to each player p mixing
+  policies[p] with probabilities probs[p] at the start of the game, which
+  weights the policies at an information set by the player's own reach
+  probabilities """
+  mixed = tree.uniform_policy()
+  for p, player_policies in enumerate(policies):
+    if probs is None:
+      player_probs = np.ones(len(player_policies)) / len(player_policies)
+    else:
+      player_probs = np.asarray(probs[p]) / np.sum(probs[p])
+    infosets = tree.infoset_player == p
+    nodes = tree.player == p
+    numerator = np.zeros((tree.n_infosets, tree.n_actions))
+    denominator = np.zeros((tree.n_infosets, 1))
+    for pi, prob in zip(player_policies, player_probs):
+      reach = tree.compute_reaches(tree.edge_weights(pi))[:, p]
+      # own reaches are shared by the nodes of an information set
+      own_reach = np.zeros((tree.n_infosets, 1))
+      own_reach[tree.infoset[nodes], 0] = reach[nodes]
+      numerator += prob * own_reach * pi
+      denominator += prob * own_reach
+    # unreachable information sets take the plain average
+    mixed[infosets] = np.where(
+      denominator > 0, numerator / np.where(denominator > 0, denominator, 1),
+      np.tensordot(player_probs, player_policies, 1))[infosets]
+  return mixed
+
+
+_worker_trees: List[GameTree] = None
+
+
+def _init_worker(trees):
+  global _worker_trees
+  _worker_trees = trees
+
+
+def _compute_worker_updates(args):
+  i, policy, player, seed = args
+  rng = None if seed is None else np.random.default_rng(seed)
+  return _worker_trees[i].compute_updates(policy, player, rng)
+
+
+class CFRSolver:
+  """ CFR, CFR+ and chance-sampling MCCFR with alternating updates
+
+  Args:
+    tree: the game tree
+    algo: one of ALGORITHMS
+    n_workers: the number of processes computing the updates of subtrees
+      below the chance root, or 0 to compute in this process
+    seed: the seed of chance sampling in MCCFR
+  """
+  def __init__(self, tree: GameTree, algo='cfr', n_workers=0, seed=None):
+    assert algo in ALGORITHMS, algo
+    self.tree = tree
+    self.algo = algo
+    self.iteration = 0
+    self.regrets = np.zeros((tree.n_infosets, tree.n_actions))
+    self.strategy_sums = np.zeros((tree.n_infosets, tree.n_actions))
+    self.policy = tree.uniform_policy()
+    self._rng = np.random.default_rng(seed)
+    self._pool = None
+    if n_workers > 1:
+      subtrees = tree.split(n_workers)
+      self._n_subtrees = len(subtrees)
+      self._pool = multiprocessing.get_context('spawn').Pool(
+        self._n_subtrees, initializer=_init_worker, initargs=(subtrees,))
+      do_logging(f'Running {algo} over {self._n_subtrees} subtrees', level='info')
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+
+  def iterate(self, n_iterations=1):
+    for _ in range(n_iterations):
+      self.iteration += 1
+      for p in range(self.tree.n_players):
+        regrets, strategies = self._compute_updates(p)
+        if self.algo == 'cfr+':
+          self.regrets = np.maximum(self.regrets + regrets, 0)
+          # linear averaging
+          self.strategy_sums += self.iteration * strategies
+        else:
+          self.regrets += regrets
+          self.strategy_sums += strategies
+        self.policy = self._regret_matching(self.regrets)
+
+  def average_policy(self):
+    total = np.sum(self.strategy_sums, -1, keepdims=True)
+    return np.where(
+      total > 0, self.strategy_sums / np.where(total > 0, total, 1),
+      self.tree.uniform_policy())
+
+  def policy_dict(self, average=True):
+    """ Returns a map from information states to the action probabilities """
+    policy = self.average_policy() if average else self.policy
+    return {k: policy[i] for i, k in enumerate(self.tree.infoset_keys)}
+
+  def _compute_updates(self, player):
+    sample = self.algo == 'mccfr'
+    if self._pool is None:
+      regrets, strategies, _ = self.tree.compute_updates(
+        self.policy, player, self._rng if sample else None)
+      return regrets, strategies
+    seeds = self._rng.integers(2**31, size=self._n_subtrees) if sample \
+      else [None] * self._n_subtrees
+    results = self._pool.map(_compute_worker_updates, [
+      (i, self.policy, player, s) for i, s in enumerate(seeds)])
+    regrets = sum(r for r, _, _ in results)
+    strategies = sum(s for _, s, _ in results)
+    return regrets, strategies
+
+  def _regret_matching(self, regrets):
+    r_plus = np.where(self.tree.legal_actions, np.maximum(regrets, 0), 0)
+    total = np.sum(r_plus, -1, keepdims=True)
+    return np.where(
+      total > 0, r_plus / np.where(total > 0, total, 1),
+      self.tree.uniform_policy())
@@ -0,0 +1,73 @@
+""" Kuhn poker following the state interface of OpenSpiel
+
+Two players ante 1 and are dealt one of three cards. Player 0 passes
+(0) or bets (1), after which player 1 and, if player 0 passed and player
+1 bet, player 0 again pass or bet. A pass facing a bet folds; otherwise
+the higher card wins the pot at showdown.
+"""
+from typing import List
+
+N_CARDS = 3
+PASS = 0
+BET = 1
+CHANCE = -1
+TERMINAL = -4
+
+
+class KuhnPokerState:
+  def __init__(self, cards: List[int]=None, history: List[int]=None):
+    self.cards = cards or []
+    self.history = history or []
+
+  def is_chance_node(self):
+    return len(self.cards) < 2
+
+  def is_terminal(self):
+    h = self.history
+    return len(h) == 2 and h != [PASS, BET] or len(h) == 3
+
+  def current_player(self):
+    if self.is_terminal():
+      return TERMINAL
+    if self.is_chance_node():
+      return CHANCE
+    return len(self.history) % 2
+
+  def chance_outcomes(self):
+    outcomes = [c for c in range(N_CARDS) if c not in self.cards]
+    return [(c, 1 / len(outcomes)) for c in outcomes]
+
+  def legal_actions(self, player=None):
+    return [PASS, BET]
+
+  def child(self, action: int):
+    if self.is_chance_node():
+      return KuhnPokerState(self.cards + [action], list(self.history))
+    return KuhnPokerState(list(self.cards), self.history + [action])
+
+  def returns(self):
+    h = self.history
+    if h[-2:] == [BET, PASS]:
+      # the last player folds
+      winner = len(h) % 2
+      pot = 1
+    else:
+      winner = 0 if self.cards[0] > self.cards[1] else 1
+      pot = 2 if BET in h else 1
+    return [pot if p == winner else -pot for p in range(2)]
+
+  def information_state_string(self, player: int=None):
+    if player is None:
+      player = self.current_player()
+    return str(self.cards[player]) + ''.join('pb'[a] for a in self.history)
+
+
+class KuhnPoker:
+  def num_players(self):
+    return 2
+
+  def num_distinct_actions(self):
+    return 2
+
+  def new_initial_state(self):
+    return KuhnPokerState()
@@ -0,0 +1,225 @@
+""" Batched meta-strategy solvers
+
+The counterfactual utilities of all strategies of an agent are computed
+with a single einsum contracting its payoff tensor with the strategies of
+the other agents. Strategies carry leading batch dimensions, so that many
+restarts from random initial strategies are solved at once, either by
+NumPy or, with use_jax, by a jitted loop vmapped over the restarts.
+
+Supported algorithms:
+  rm: regret matching
+  rm+: regret matching+ with linear averaging
+  drm: discounted regret matching with parameters (alpha, beta, gamma)
+  fp: fictitious play
+"""
+import functools
+import string
+from typing import List, Sequence
+import numpy as np
+import jax
+import jax.numpy as jnp
+from jax import lax
+
+
+ALGORITHMS = ('rm', 'rm+', 'drm', 'fp')
+
+
+def _einsum_subscripts(n_agents: int, aid: int):
+  axes = string.ascii_letters[:n_agents]
+  inputs = [axes] + [f'...{a}' for i, a in enumerate(axes) if i != aid]
+  return f'{",".join(inputs)}->...{axes[aid]}'
+
+
+def compute_utilities(payoffs: Sequence, strategies: Sequence, xp=np):
+  """ Compute the expected utility of every strategy of each agent
+  against the strategies of the others
+
+  Args:
+    payoffs: the payoff tensors of all agents, each of shape (n_0, ..., n_k)
+    strategies: the strategies of all agents, each of shape (..., n_i)
+  Returns:
+    utilities: the counterfactual utilities, each of shape (..., n_i)
+  """
+  n_agents = len(payoffs)
+  return [
+    xp.einsum(
+      _einsum_subscripts(n_agents, i), payoff,
+      *[s for j, s in enumerate(strategies) if j != i]
+    )
+    for i, payoff in enumerate(payoffs)
+  ]
+
+
+def compute_nash_conv(payoffs: Sequence, strategies: Sequence, xp=np):
+  """ Compute the sum of the gains from best responding of all agents """
+  utilities = compute_utilities(payoffs, strategies, xp)
+  return sum(
+    xp.max(u, -1) - xp.sum(s * u, -1)
+    for u, s in zip(utilities, strategies)
+  )
+
+
+def _normalize_regrets(regrets, xp):
+  r_plus = xp.maximum(regrets, 0)
+  total = xp.sum(r_plus, -1, keepdims=True)
+  uniform = xp.ones_like(regrets) / regrets.shape[-1]
+  return xp.where(total > 0, r_plus / xp.where(total > 0, total, 1), uniform)
+
+
+def _init_state(strategies: Sequence, xp):
+  return (
+    list(strategies),
+    [xp.zeros_like(s) for s in strategies],
+    list(strategies),
+    0.
+  )
+
+
+def _step(payoffs, state, t, algo, alpha, beta, gamma, xp):
+  """ Runs the t-th iteration, t starting from 1 """
+  strategies, regrets, avg_strategies, total_weight = state
+  if algo == 'fp':
+    utilities = compute_utilities(payoffs, avg_strategies, xp)
+    strategies = []
+    for u in utilities:
+      br = xp.asarray(u == xp.max(u, -1, keepdims=True), u.dtype)
+      strategies.append(br / xp.sum(br, -1, keepdims=True))
+    weight = 1.
+    # the initial strategies count as the first iteration
+    total_weight = xp.maximum(total_weight, 1.)
+  else:
+    utilities = compute_utilities(payoffs, strategies, xp)
+    next_regrets = []
+    for s, r, u in zip(strategies, regrets, utilities):
+      r = r + u - xp.sum(s * u, -1, keepdims=True)
+      if algo == 'rm+':
+        r = xp.maximum(r, 0)
+      elif algo == 'drm':
+        pos = t**alpha / (t**alpha + 1)
+        neg = t**beta / (t**beta + 1)
+        r = r * xp.where(r > 0, pos, neg)
+      next_regrets.append(r)
+    regrets = next_regrets
+    if algo == 'rm':
+      weight = 1.
+    elif algo == 'rm+':
+      weight = t
+    else:
+      weight = t**gamma
+  total_weight = total_weight + weight
+  avg_strategies = [
+    a + weight / total_weight * (s - a)
+    for a, s in zip(avg_strategies, strategies)
+  ]
+  if algo != 'fp':
+    strategies = [_normalize_regrets(r, xp) for r in regrets]
+  return strategies, regrets, avg_strategies, total_weight
+
+
+def _solve(payoffs, strategies, n_iterations, algo, alpha, beta, gamma):
+  state = _init_state(strategies, np)
+  for t in range(1, n_iterations+1):
+    state = _step(payoffs, state, float(t), algo, alpha, beta, gamma, np)
+  return state[2]
+
+
+@functools.partial(jax.jit, static_argnames=('n_iterations', 'algo'))
+def _solve_jax(payoffs, strategies, n_iterations, algo, alpha, beta, gamma):
+  def solve(strategies):
+    state = _init_state(strategies, jnp)
+    state = (*state[:3], jnp.zeros((), strategies[0].dtype))
+    state = lax.fori_loop(
+      1, n_iterations+1,
+      lambda t, state: _step(payoffs, state, t.astype(strategies[0].dtype),
+        algo, alpha, beta, gamma, jnp),
+      state
+    )
+    return state[2]
+  return jax.vmap(solve)(strategies)
+
+
+class MetaSolver:
+  """ Solves for the meta-strategies of normal-form games
+
+  Args:
+    algo: one of ALGORITHMS
+    n_iterations: the number of iterations
+    n_restarts: the number of solutions computed in parallel. The first
+      starts from uniform strategies and the others from random ones
+    alpha, beta, gamma: the parameters of discounted regret matching
+    use_jax: whether to run a jitted loop vmapped over the restarts
+    seed: the seed of the random initial strategies
+  """
+  def __init__(
+    self,
+    algo='rm+',
+    n_iterations=1000,
+    n_restarts=1,
+    alpha=1.5,
+    beta=0.,
+    gamma=2.,
+    use_jax=False,
+    seed=None,
+  ):
+    assert algo in ALGORITHMS, algo
+    self.algo = algo
+    self.n_iterations = n_iterations
+    self.n_restarts = n_restarts
+    self.alpha = alpha
+    self.beta = beta
+    self.gamma = gamma
+    self.use_jax = use_jax
+    self._rng = np.random.default_rng(seed)
+
+  def initial_strategies(self, n_strategies: Sequence[int]):
+    strategies = []
+    for n in n_strategies:
+      s = self._rng.dirichlet(np.ones(n), size=self.n_restarts)
+      s[0] = 1 / n
+      strategies.append(s)
+    return strategies
+
+  def compute_all(self, payoffs: List[np.ndarray], strategies: List[np.ndarray]=None):
+    """ Returns the average strategies of all restarts, each of shape
+    (n_restarts, n_i), and their NashConvs """
+    payoffs = [np.asarray(p, np.float64) for p in payoffs]
+    assert len(payoffs) == payoffs[0].ndim, (len(payoffs), payoffs[0].shape)
+    if strategies is None:
+      strategies = self.initial_strategies(payoffs[0].shape)
+    if self.use_jax:
+      dtype = jnp.zeros(()).dtype
+      strategies = _solve_jax(
+        [jnp.asarray(p, dtype) for p in payoffs],
+        [jnp.asarray(s, dtype) for s in strategies],
+        self.n_iterations, self.algo, self.alpha, self.beta, self.gamma
+      )
+      strategies = [np.asarray(s, np.float64) for s in strategies]
+    else:
+      strategies = _solve(
+        payoffs, strategies, self.n_iterations,
+        self.algo, self.alpha, self.beta, self.gamma
+      )
+    nash_conv = compute_nash_conv(payoffs, strategies)
+    return strategies, nash_conv
+
+  def compute(self, payoffs: List[np.ndarray]):
+    """ Returns the meta-strategies of the restart with the least
+    NashConv, and the NashConv """
+    strategies, nash_conv = self.compute_all(payoffs)
+    i = np.argmin(nash_conv)
+    return [s[i] for s in strategies], nash_conv[i]
+
+
+if __name__ == '__main__':
+  import time
+  n = 200
+  payoff = np.random.normal(size=(n, n))
+  payoffs = [payoff, -payoff]
+  for algo in ALGORITHMS:
+    for use_jax in [False, True]:
+      solver = MetaSolver(algo, n_iterations=1000, n_restarts=8, use_jax=use_jax)
+      solver.compute(payoffs)
+      start = time.time()
+      _, nash_conv = solver.compute(payoffs)
+      print(f'{algo} (jax={use_jax}): NashConv {nash_conv:.3g} '
+        f'in {(time.time() - start)*1000:.3g}ms')
@@ -8,6 +8,76 @@ from core.typing import ModelPath, get_aid
 from tools.utils import config_attr
 
 
+def _view(buffer: np.ndarray, shape: Tuple[int]):
+  return buffer[tuple(slice(0, n) for n in shape)]
+
+
+def _grow(buffer: np.ndarray, shape: Tuple[int], fill):
+  """ Returns buffer if it holds an array of shape, or a new buffer 
+  doubling the capacity of the axes that are too short otherwise, so 
+  that adding strategies copies the payoffs amortized O(1) times """
+  if all(n <= c for n, c in zip(shape, buffer.shape)):
+    return buffer
+  capacity = [c if n <= c else max(n, 2 * c) for n, c in zip(shape, buffer.shape)]
+  new_buffer = np.full(capacity, fill, dtype=buffer.dtype)
+  _view(new_buffer, buffer.shape)[...] = buffer
+  return new_buffer
+
+
+def batch_m2(scores: List[float]):
+  """ Returns the sum of squared deviations of scores from their mean """
+  return float(np.sum((np.asarray(scores) - np.mean(scores))**2)) if scores else 0.
+
+
+def _merge_moments(count, mean, m2, s_total, s_sum, s_m2):
+  """ Merges the mean and the sum of squared deviations of count scores 
+  with those of a batch of s_total scores summing to s_sum, following 
+  the parallel variant of Welford's algorithm """
+  total = count + s_total
+  delta = s_sum / s_total - mean
+  new_mean = mean + delta * s_total / total
+  new_m2 = m2 + s_m2 + delta**2 * count * s_total / total
+  return new_mean, new_m2
+
+
+def _compute_variance(count, m2):
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(count > 1, m2 / np.maximum(count - 1, 1), np.nan)
+
+
+def _compute_confidence_interval(count, m2, z):
+  """ Returns the half width of the confidence interval of the mean, 
+  infinite for fewer than two scores """
+  with np.errstate(divide='ignore', invalid='ignore'):
+    return np.where(
+      count > 1, z * np.sqrt(_compute_variance(count, m2) / count), np.inf)
+
+
+def _aggregate(flat_idxes: np.ndarray, *values: np.ndarray):
+  """ Sums values sharing the same flat index, returning the unique 
+  indices and the sums """
+  idxes, inverse = np.unique(flat_idxes, return_inverse=True)
+  sums = []
+  for v in values:
+    total = np.zeros(len(idxes), dtype=v.dtype)
+    np.add.at(total, inverse, v)
+    sums.append(total)
+  return idxes, sums
+
+
+def _aggregate_moments(flat_idxes, score_sums, counts, score_m2s):
+  """ Aggregates batches of scores sharing the same flat index, 
+  returning the unique indices, the score sums, the counts and the sums 
+  of squared deviations of the merged batches """
+  with np.errstate(divide='ignore', invalid='ignore'):
+    sq_means = np.where(counts > 0, score_sums**2 / counts, 0)
+  idxes, (s_sum, s_total, s_m2, s_sq_means) = _aggregate(
+    flat_idxes, score_sums, counts, score_m2s, sq_means)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    s_m2 = s_m2 + s_sq_means - np.where(s_total > 0, s_sum**2 / s_total, 0)
+  return idxes, (s_sum, s_total, np.maximum(s_m2, 0))
+
+
 class PayoffTableCheckpoint:
   def __init__(
     self, 
@@ -52,8 +122,20 @@ class PayoffTable(PayoffTableCheckpoint):
 
     self.payoffs = [np.zeros([0] * n_agents, dtype=np.float32) * np.nan for _ in range(n_agents)]
     self.counts = [np.zeros([0] * n_agents, dtype=np.int64) for _ in range(n_agents)]
+    # the sample means and the sums of squared deviations of all scores,
+    # tracked by Welford's algorithm even if payoffs are moving averages
+    self.means = [np.zeros([0] * n_agents, dtype=np.float64) for _ in range(n_agents)]
+    self.m2s = [np.zeros([0] * n_agents, dtype=np.float64) for _ in range(n_agents)]
 
     self.restore()
+
+  def restore(self, to_print=True):
+    super().restore(to_print)
+    if any(m.shape != c.shape for m, c in zip(self.m2s, self.counts)):
+      # checkpoints without moments
+      self.means = [np.nan_to_num(p).astype(np.float64) for p in self.payoffs]
+      self.m2s = [np.zeros_like(c, dtype=np.float64) for c in self.counts]
+    self._reset_buffers()
   
   def size(self, aid: int):
     return self.payoffs[aid].shape[0]
@@ -82,6 +164,15 @@ class PayoffTable(PayoffTableCheckpoint):
   def get_counts(self):
     return self.counts
 
+  def get_variances(self):
+    """ Returns the sample variances of scores, nan for fewer than two scores """
+    return [_compute_variance(c, m2) for c, m2 in zip(self.counts, self.m2s)]
+
+  def get_confidence_intervals(self, z=1.96):
+    """ Returns the half widths of the confidence intervals of payoffs """
+    return [_compute_confidence_interval(c, m2, z) 
+      for c, m2 in zip(self.counts, self.m2s)]
+
   def get_counts_for_agent(self, aid: int, *, sid: int):
     count = self.counts[aid]
     if sid is not None:
@@ -105,6 +196,9 @@ class PayoffTable(PayoffTableCheckpoint):
     else:
       self.payoffs = [np.zeros_like(p) * np.nan for p in self.payoffs]
       self.counts = [np.zeros_like(c) for c in self.counts]
+    self.means = [np.zeros_like(c, dtype=np.float64) for c in self.counts]
+    self.m2s = [np.zeros_like(c, dtype=np.float64) for c in self.counts]
+    self._reset_buffers()
     if name is not None:
       self._name = name
 
@@ -117,7 +211,7 @@ class PayoffTable(PayoffTableCheckpoint):
   def expand_all(self, aids: List[int]):
     assert len(aids) == self._n_agents, aids
     pad_width = [(0, 1) for _ in range(self._n_agents)]
-    for aid in enumerate(aids):
+    for aid in range(self._n_agents):
       self._expand(aid, pad_width)
 
   def update(self, sids: Tuple[int], scores: List[List[float]]):
@@ -126,7 +220,8 @@ class PayoffTable(PayoffTableCheckpoint):
     from the view of the i-th agent
     """
     assert len(sids) == self._n_agents, f'Some models are not specified: {sids}'
-    for payoff, count, s in zip(self.payoffs, self.counts, scores):
+    for payoff, count, mean, m2, s in zip(
+        self.payoffs, self.counts, self.means, self.m2s, scores):
       s_sum = sum(s)
       s_total = len(s)
       if s == []:
@@ -138,12 +233,78 @@ class PayoffTable(PayoffTableCheckpoint):
       else:
         payoff[sids] += self._step_size * (s_sum / s_total - payoff[sids])
       assert not np.isnan(payoff[sids]), (count[sids], payoff[sids])
+      mean[sids], m2[sids] = _merge_moments(
+        count[sids], mean[sids], m2[sids], s_total, s_sum, batch_m2(s))
       count[sids] += s_total
 
+  def update_many(
+    self, 
+    sids_array: np.ndarray, 
+    score_sums: np.ndarray, 
+    counts: np.ndarray, 
+    score_m2s: np.ndarray=None
+  ):
+    """ Updates payoffs with aggregated results, equivalent to calling
+    update once per strategy profile with all of its scores
+
+    Args:
+      sids_array: strategy profiles of shape (m, n_agents)
+      score_sums: score sums of shape (m, n_agents), the i-th column 
+        from the view of the i-th agent
+      counts: the number of scores summed, of shape (m,) or (m, n_agents), 
+        or a scalar
+      score_m2s: the sums of squared deviations of the scores from their 
+        means, of the same shape as score_sums. Zero if not given, as for
+        single scores
+    """
+    sids_array = np.asarray(sids_array, dtype=np.int64).reshape(-1, self._n_agents)
+    m = sids_array.shape[0]
+    score_sums = np.asarray(score_sums, dtype=np.float64).reshape(m, self._n_agents)
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.ndim == 1:
+      counts = counts[:, None]
+    counts = np.broadcast_to(counts, score_sums.shape)
+    score_m2s = np.zeros_like(score_sums) if score_m2s is None \
+      else np.asarray(score_m2s, dtype=np.float64).reshape(m, self._n_agents)
+    shape = self.payoffs[0].shape
+    flat_idxes = np.ravel_multi_index(tuple(sids_array.T), shape)
+    for aid, (payoff, count, mean, m2) in enumerate(
+        zip(self.payoffs, self.counts, self.means, self.m2s)):
+      idxes, (s_sum, s_total, s_m2) = _aggregate_moments(
+        flat_idxes, score_sums[:, aid], counts[:, aid], score_m2s[:, aid])
+      valid = s_total > 0
+      idxes = np.unravel_index(idxes[valid], shape)
+      s_sum, s_total, s_m2 = s_sum[valid], s_total[valid], s_m2[valid]
+      payoff[idxes] = self._merge_payoffs(payoff[idxes], count[idxes], s_sum, s_total)
+      mean[idxes], m2[idxes] = _merge_moments(
+        count[idxes], mean[idxes], m2[idxes], s_total, s_sum, s_m2)
+      count[idxes] += s_total
+
   """ implementations """
+  def _merge_payoffs(self, payoff, count, s_sum, s_total):
+    if self._step_size == 0 or self._step_size is None:
+      new_payoff = (count * np.nan_to_num(payoff) + s_sum) / (count + s_total)
+    else:
+      new_payoff = payoff + self._step_size * (s_sum / s_total - payoff)
+    return np.where(count == 0, s_sum / s_total, new_payoff)
+
+  def _reset_buffers(self):
+    # payoffs, counts and moments are views into buffers with spare capacity
+    self._payoff_buffers = list(self.payoffs)
+    self._count_buffers = list(self.counts)
+    self._mean_buffers = list(self.means)
+    self._m2_buffers = list(self.m2s)
+
   def _expand(self, aid, pad_width):
-    self.payoffs[aid] = np.pad(self.payoffs[aid], pad_width, constant_values=np.nan)
-    self.counts[aid] = np.pad(self.counts[aid], pad_width)
+    shape = [n + p for n, (_, p) in zip(self.payoffs[aid].shape, pad_width)]
+    self._payoff_buffers[aid] = _grow(self._payoff_buffers[aid], shape, np.nan)
+    self._count_buffers[aid] = _grow(self._count_buffers[aid], shape, 0)
+    self._mean_buffers[aid] = _grow(self._mean_buffers[aid], shape, 0)
+    self._m2_buffers[aid] = _grow(self._m2_buffers[aid], shape, 0)
+    self.payoffs[aid] = _view(self._payoff_buffers[aid], shape)
+    self.counts[aid] = _view(self._count_buffers[aid], shape)
+    self.means[aid] = _view(self._mean_buffers[aid], shape)
+    self.m2s[aid] = _view(self._m2_buffers[aid], shape)
 
 
 class PayoffTableWithModel(PayoffTable):
@@ -220,6 +381,17 @@ class PayoffTableWithModel(PayoffTable):
     super().update(sids, scores)
     # print('Payoffs', *self.payoffs, 'Counts', *self.counts, sep='\n')
 
+  def update_many(
+    self, 
+    models: List[List[ModelPath]], 
+    score_sums: np.ndarray, 
+    counts: np.ndarray, 
+    score_m2s: np.ndarray=None
+  ):
+    sids_array = [
+      [m2sid[model] for m2sid, model in zip(self.model2sid, ms)] for ms in models]
+    super().update_many(sids_array, score_sums, counts, score_m2s)
+
   """ Implementations """
   def _expand_mappings(self, aid, model: ModelPath):
     if isinstance(model.model_name, str):
@@ -249,8 +421,20 @@ class SelfPlayPayoffTable(PayoffTableCheckpoint):
     super().__init__(step_size, payoff_dir, name)
     self.payoffs = np.zeros([0] * 2, dtype=np.float32)
     self.counts = np.zeros([0] * 2, dtype=np.int64)
+    # the sample means and the sums of squared deviations of all scores,
+    # tracked by Welford's algorithm even if payoffs are moving averages
+    self.means = np.zeros([0] * 2, dtype=np.float64)
+    self.m2s = np.zeros([0] * 2, dtype=np.float64)
 
     self.restore()
+
+  def restore(self, to_print=True):
+    super().restore(to_print)
+    if self.m2s.shape != self.counts.shape:
+      # checkpoints without moments
+      self.means = np.nan_to_num(self.payoffs).astype(np.float64)
+      self.m2s = np.zeros_like(self.counts, dtype=np.float64)
+    self._reset_buffers()
   
   def size(self):
     return self.payoffs.shape[0]
@@ -281,6 +465,14 @@ class SelfPlayPayoffTable(PayoffTableCheckpoint):
       counts = counts[sid]
     return counts
 
+  def get_variances(self):
+    """ Returns the sample variances of scores, nan for fewer than two scores """
+    return _compute_variance(self.counts, self.m2s)
+
+  def get_confidence_intervals(self, z=1.96):
+    """ Returns the half widths of the confidence intervals of payoffs """
+    return _compute_confidence_interval(self.counts, self.m2s, z)
+
   """ Payoff Management """
   def reset(self, from_scratch=False, name=None):
     if from_scratch:
@@ -289,6 +481,9 @@ class SelfPlayPayoffTable(PayoffTableCheckpoint):
     else:
       self.payoffs = np.zeros_like(self.payoffs) * np.nan
       self.counts = np.zeros_like(self.counts)
+    self.means = np.zeros_like(self.counts, dtype=np.float64)
+    self.m2s = np.zeros_like(self.counts, dtype=np.float64)
+    self._reset_buffers()
     if name is not None:
       self._name = name
 
@@ -322,13 +517,88 @@ class SelfPlayPayoffTable(PayoffTableCheckpoint):
         self.payoffs[rsids] += new_payoff
       # assert self.payoffs[sids] + self.payoffs[rsids] == 1, (sids, self.payoffs[sids], rsids, self.payoffs[rsids])
       assert not np.isnan(self.payoffs[sids]), (self.counts[sids], self.payoffs[sids])
+      self.means[sids], self.m2s[sids] = _merge_moments(
+        self.counts[sids], self.means[sids], self.m2s[sids], 
+        s_total, s_sum, batch_m2(scores))
+      self.means[rsids], self.m2s[rsids] = -self.means[sids], self.m2s[sids]
       self.counts[rsids] += s_total
     self.counts[sids] += s_total
 
+  def update_many(
+    self, 
+    sids_array: np.ndarray, 
+    score_sums: np.ndarray, 
+    counts: np.ndarray, 
+    score_m2s: np.ndarray=None
+  ):
+    """ Updates payoffs with aggregated results, equivalent to calling
+    update once per pair of strategies with all of its scores
+
+    Args:
+      sids_array: pairs of strategies of shape (m, 2)
+      score_sums: score sums of shape (m,) from the view of the first strategy
+      counts: the number of scores summed, of shape (m,) or a scalar
+      score_m2s: the sums of squared deviations of the scores from their 
+        means, of shape (m,). Zero if not given, as for single scores
+    """
+    sids_array = np.asarray(sids_array, dtype=np.int64).reshape(-1, 2)
+    score_sums = np.asarray(score_sums, dtype=np.float64).reshape(-1)
+    counts = np.broadcast_to(np.asarray(counts, dtype=np.int64), score_sums.shape)
+    score_m2s = np.zeros_like(score_sums) if score_m2s is None \
+      else np.asarray(score_m2s, dtype=np.float64).reshape(-1)
+    # results of (j, i) are those of (i, j) from the other side
+    swap = sids_array[:, 0] > sids_array[:, 1]
+    sids_array = np.where(swap[:, None], sids_array[:, ::-1], sids_array)
+    score_sums = np.where(swap, -score_sums, score_sums)
+    shape = self.payoffs.shape
+    idxes, (s_sum, s_total, s_m2) = _aggregate_moments(
+      np.ravel_multi_index(tuple(sids_array.T), shape), score_sums, counts, score_m2s)
+    valid = s_total > 0
+    sids = np.unravel_index(idxes[valid], shape)
+    rsids = sids[::-1]
+    s_sum, s_total, s_m2 = s_sum[valid], s_total[valid], s_m2[valid]
+
+    diag = sids[0] == sids[1]
+    count = self.counts[sids]
+    mean = s_sum / s_total
+    if self._step_size == 0 or self._step_size is None:
+      payoff = (count * np.nan_to_num(self.payoffs[sids]) + s_sum) / (count + s_total)
+      payoff = np.where(count == 0, mean, payoff)
+      rpayoff = -payoff
+    else:
+      payoff = self.payoffs[sids] + self._step_size * (mean - self.payoffs[sids])
+      payoff = np.where(count == 0, mean, payoff)
+      rpayoff = self.payoffs[rsids] + self._step_size * (-mean - self.payoffs[rsids])
+      rpayoff = np.where(count == 0, -mean, rpayoff)
+    self.payoffs[sids] = np.where(diag, 0, payoff)
+    self.payoffs[rsids] = np.where(diag, 0, rpayoff)
+    mean, m2 = _merge_moments(
+      count, self.means[sids], self.m2s[sids], s_total, s_sum, s_m2)
+    self.means[sids] = np.where(diag, 0, mean)
+    self.m2s[sids] = np.where(diag, 0, m2)
+    self.means[rsids] = -self.means[sids]
+    self.m2s[rsids] = self.m2s[sids]
+    self.counts[sids] += s_total
+    self.counts[rsids] += np.where(diag, 0, s_total)
+
   """ implementations """
+  def _reset_buffers(self):
+    # payoffs, counts and moments are views into buffers with spare capacity
+    self._payoff_buffer = self.payoffs
+    self._count_buffer = self.counts
+    self._mean_buffer = self.means
+    self._m2_buffer = self.m2s
+
   def _expand(self, pad_width):
-    self.payoffs = np.pad(self.payoffs, pad_width, constant_values=np.nan)
-    self.counts = np.pad(self.counts, pad_width)
+    shape = [n + pad_width[1] for n in self.payoffs.shape]
+    self._payoff_buffer = _grow(self._payoff_buffer, shape, np.nan)
+    self._count_buffer = _grow(self._count_buffer, shape, 0)
+    self._mean_buffer = _grow(self._mean_buffer, shape, 0)
+    self._m2_buffer = _grow(self._m2_buffer, shape, 0)
+    self.payoffs = _view(self._payoff_buffer, shape)
+    self.counts = _view(self._count_buffer, shape)
+    self.means = _view(self._mean_buffer, shape)
+    self.m2s = _view(self._m2_buffer, shape)
 
 
 class SelfPlayPayoffTableWithModel(SelfPlayPayoffTable):
@@ -403,6 +673,16 @@ class SelfPlayPayoffTableWithModel(SelfPlayPayoffTable):
     super().update(sids, scores)
     # print('Payoffs', *self.payoffs, 'Counts', *self.counts, sep='\n')
 
+  def update_many(
+    self, 
+    models: List[List[ModelPath]], 
+    score_sums: np.ndarray, 
+    counts: np.ndarray, 
+    score_m2s: np.ndarray=None
+  ):
+    sids_array = [[self.model2sid[model] for model in ms] for ms in models]
+    super().update_many(sids_array, score_sums, counts, score_m2s)
+
   """ Implementations """
   def _expand_mappings(self, model: ModelPath):
     assert isinstance(model, ModelPath), model
@@ -1,5 +1,6 @@
 import numpy as np
 
+from game.meta_solver import compute_utilities
 from game.utils import compute_utility
 
 
@@ -41,9 +42,9 @@ class RegretMatching:
     for payoff in payoffs:
       assert payoff.shape == tuple([n_strategies for _ in range(n_agents)]), (payoff.shape, n_agents)
     for t in range(n_iterations):
-      for aid in range(n_agents):
-        for sid in range(n_strategies):
-          self.update_regrets(payoffs[aid], aid, sid)
+      utilities = compute_utilities(payoffs, self.meta_strategies)
+      for aid, u in enumerate(utilities):
+        self.regrets[aid] += u - self.meta_strategies[aid] @ u
       for aid in range(n_agents):
         self.update_meta_strategy(aid)
 
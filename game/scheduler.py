@@ -0,0 +1,123 @@
+""" Adaptive scheduling of evaluation episodes
+
+Rather than running a fixed number of episodes for every strategy
+profile, evaluation proceeds in rounds. Each round allocates episodes to
+the profiles whose payoffs are least certain, i.e., have the widest
+confidence intervals, optionally weighted by how much the profiles matter
+for ranking, i.e., their probability under the meta-strategies. Profiles
+are done once the half widths of their confidence intervals reach
+target_ci, and evaluation stops when all profiles are done.
+"""
+from typing import List, Union
+import numpy as np
+
+from game.meta_solver import MetaSolver
+
+
+class EvaluationScheduler:
+  """ Allocates evaluation episodes to strategy profiles
+
+  Args:
+    target_ci: the half width of confidence intervals at which payoffs
+      are precise enough
+    z: the z-score of confidence intervals
+    min_episodes: the episodes every profile is evaluated for before its
+      confidence interval is trusted
+    max_episodes: the episodes after which a profile is done regardless
+      of its confidence interval
+    episodes_per_task: the episodes of each allocation
+    priority: "ci" to prioritize the widest confidence intervals, or
+      "rank" to further weight them by the probabilities of profiles
+      under the meta-strategies
+    exploration: the weight of uniform strategies mixed into the
+      meta-strategies when priority="rank"
+    meta_solver: the kwargs of the MetaSolver when priority="rank"
+  """
+  def __init__(
+    self,
+    target_ci,
+    z=1.96,
+    min_episodes=10,
+    max_episodes=1000,
+    episodes_per_task=10,
+    priority='ci',
+    exploration=.1,
+    meta_solver={},
+  ):
+    assert priority in ('ci', 'rank'), priority
+    assert min_episodes >= 2, min_episodes
+    self.target_ci = target_ci
+    self.z = z
+    self.min_episodes = min_episodes
+    self.max_episodes = max_episodes
+    self.episodes_per_task = episodes_per_task
+    self.priority = priority
+    self.exploration = exploration
+    self.meta_solver = MetaSolver(**meta_solver)
+
+  def schedule(
+    self,
+    payoffs: Union[np.ndarray, List[np.ndarray]],
+    counts: Union[np.ndarray, List[np.ndarray]],
+    cis: Union[np.ndarray, List[np.ndarray]],
+    n_tasks: int,
+    self_play=False
+  ):
+    """ Returns up to n_tasks strategy profiles to be evaluated for
+    episodes_per_task episodes, none once all profiles are done
+
+    Args:
+      payoffs, counts, cis: the payoffs, counts and the half widths of
+        confidence intervals retrieved from the payoff table, a list
+        of arrays, one per agent, or a single array if self_play
+      n_tasks: the maximum number of profiles
+      self_play: whether the payoff table is a SelfPlayPayoffTable, in
+        which only pairs of distinct strategies are evaluated
+    Returns:
+      sids: the strategy profiles of shape (k, n_agents), k <= n_tasks
+    """
+    counts, cis, mask = self._combine(counts, cis, self_play)
+    candidates = mask & ~self._done(counts, cis)
+    if not np.any(candidates):
+      return np.zeros((0, counts.ndim), dtype=np.int64)
+    # profiles evaluated for fewer than min_episodes go first
+    priorities = np.where(counts < self.min_episodes, np.inf, cis)
+    if self.priority == 'rank':
+      priorities = priorities * self._compute_profile_weights(payoffs, self_play)
+    priorities = np.where(candidates, priorities, -np.inf).reshape(-1)
+    n_tasks = min(n_tasks, int(np.sum(candidates)))
+    idxes = np.argpartition(-priorities, n_tasks - 1)[:n_tasks]
+    idxes = idxes[np.argsort(-priorities[idxes], kind='stable')]
+    return np.stack(np.unravel_index(idxes, counts.shape), -1)
+
+  def _combine(self, counts, cis, self_play):
+    """ Returns the counts and confidence intervals of profiles, the
+    least precise among agents, and the mask of profiles to evaluate """
+    if self_play:
+      counts = np.asarray(counts)
+      cis = np.asarray(cis)
+      mask = np.triu(np.ones(counts.shape, dtype=bool), 1)
+    else:
+      counts = np.min(np.stack(counts), 0)
+      cis = np.max(np.stack(cis), 0)
+      mask = np.ones(counts.shape, dtype=bool)
+    return counts, cis, mask
+
+  def _done(self, counts, cis):
+    return (counts >= self.min_episodes) & (cis <= self.target_ci) \
+      | (counts >= self.max_episodes)
+
+  def _compute_profile_weights(self, payoffs, self_play):
+    if self_play:
+      payoff = np.nan_to_num(payoffs)
+      payoffs = [payoff, payoff.T]
+    else:
+      payoffs = [np.nan_to_num(p) for p in payoffs]
+    strategies, _ = self.meta_solver.compute(payoffs)
+    if self_play:
+      strategies = [strategies[0], strategies[0]]
+    weights = np.ones(payoffs[0].shape)
+    for i, s in enumerate(strategies):
+      s = (1 - self.exploration) * s + self.exploration / s.size
+      weights = weights * s.reshape((-1,) + (1,) * (len(strategies) - i - 1))
+    return weights
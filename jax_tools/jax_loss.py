@@ -102,6 +102,51 @@ def inverse_h(x, epsilon=1e-3):
   return lax.sign(x) * (lax.square(frac_term) - 1.)
 
 
+SCAN_METHODS = ('loop', 'scan', 'associative_scan')
+
+
+def reverse_linear_scan(delta, discount, method='scan'):
+  """ Computes x[t] = delta[t] + discount[t] * x[t+1] backward in time 
+  with x[T] = 0, where the time dimension comes first
+
+  Params:
+    method: 'loop' unrolls a Python loop, so the graph size grows 
+      linearly with the sequence length; 'scan' uses lax.scan, whose 
+      graph size is constant; 'associative_scan' uses 
+      lax.associative_scan, which takes O(log T) sequential steps. 
+      testcases/jax_loss_test.py benchmarks them; 'loop' takes minutes 
+      to compile for hundreds of steps
+  """
+  if method == 'loop':
+    err = 0.
+    errors = []
+    for i in reversed(range(delta.shape[0])):
+      err = delta[i] + discount[i] * err
+      errors.append(err)
+    return jnp.array(errors[::-1])
+  elif method == 'scan':
+    def step(err, x):
+      d, c = x
+      err = d + c * err
+      return err, err
+    _, errors = lax.scan(
+      step, jnp.zeros_like(delta[0]), (delta, discount), reverse=True)
+    return errors
+  elif method == 'associative_scan':
+    discount = jnp.broadcast_to(discount, delta.shape)
+    # each step is an affine map x -> c * x + d; 
+    # later is applied before earlier
+    def compose(later, earlier):
+      c1, d1 = later
+      c2, d2 = earlier
+      return c1 * c2, c2 * d1 + d2
+    _, errors = lax.associative_scan(
+      compose, (discount, delta), reverse=True)
+    return errors
+  else:
+    raise ValueError(f'Unknown scan method: {method}')
+
+
 def retrace(
   *,
   reward, 
@@ -117,17 +162,21 @@ def retrace(
   axis=0, 
   tbo=False, 
   regularization=None, 
+  scan_method='scan', 
 ):
   """
   Params:
     discount = 1-done. 
     axis specifies the time dimension
+    scan_method: see reverse_linear_scan
   """
-  chex.assert_equal_shape([reward, q, next_qs, discount, reset])
+  jax_assert.assert_shape_compatibility([reward, q, ratio, discount, reset])
 
   # swap 'axis' with the 0-th dimension
-  dims, (next_q, ratio, discount, reset) = \
-    jax_utils.time_major(next_q, ratio, discount, reset, axis=axis)
+  dims, (reward, q, ratio, discount, reset) = \
+    jax_utils.time_major(reward, q, ratio, discount, reset, axis=axis)
+  next_qs, next_pi = jax.tree_util.tree_map(
+    lambda x: jnp.swapaxes(x, 0, axis), (next_qs, next_pi))
 
   if tbo:
     next_qs = inverse_h(next_qs)
@@ -136,20 +185,16 @@ def retrace(
     next_v -= regularization
   discount = discount * gamma
   delta = reward + discount * next_v - q
+  # the trace is cut after the last step, where the error is bootstrapped
   next_c = lam * jnp.minimum(ratio[1:], c_clip)
+  next_c = jnp.concatenate([next_c, jnp.zeros_like(next_c[:1])])
 
-  chex.assert_rank([delta[:-1], next_c])
   if reset is not None:
-    discounted_ratio = (1 - reset[1:]) * gamma * next_c
+    discounted_ratio = (1 - reset) * gamma * next_c
   else:
-    discounted_ratio = discount[1:] * next_c
+    discounted_ratio = discount * next_c
   
-  err = 0.
-  errors = []
-  for i in reversed(range(delta.shape[0])):
-    err = delta[i] + discounted_ratio[i] * err
-    errors.append(err)
-  errors = jnp.array(errors[::-1])
+  errors = reverse_linear_scan(delta, discounted_ratio, scan_method)
 
   target = errors + q
 
@@ -170,7 +215,8 @@ def gae(
   reset=None, 
   gamma=1, 
   lam=1, 
-  axis=0
+  axis=0, 
+  scan_method='scan', 
 ):
   jax_assert.assert_shape_compatibility([
     reward, value, next_value, discount, reset])
@@ -185,13 +231,8 @@ def gae(
   # Adjust discount based on reset
   discount = (discount if reset is None else (1 - reset)) * gae_discount
 
-  err = 0.
-  advs = []
-  # Compute advantages in a reversed order loop
-  for i in reversed(range(delta.shape[0])):
-    err = delta[i] + discount[i] * err
-    advs.append(err)
-  advs = jnp.array(advs[::-1])
+  # Compute advantages in a reversed order
+  advs = reverse_linear_scan(delta, discount, scan_method)
   
   # Calculate the value function from the advantages
   vs = advs + value
@@ -217,12 +258,14 @@ def v_trace(
   rho_clip=1, 
   rho_clip_pg=1, 
   adv_type='vtrace', 
-  axis=0
+  axis=0, 
+  scan_method='scan', 
 ):
   """
   Params:
     discount = 1-done. 
     axis specifies the time dimension
+    scan_method: see reverse_linear_scan
   """
   ratio = pi / mu
   return v_trace_from_ratio(
@@ -238,7 +281,8 @@ def v_trace(
     rho_clip=rho_clip, 
     rho_clip_pg=rho_clip_pg, 
     adv_type=adv_type, 
-    axis=axis
+    axis=axis, 
+    scan_method=scan_method, 
   )
 
 
@@ -256,13 +300,15 @@ def v_trace_from_ratio(
   rho_clip=1, 
   rho_clip_pg=1, 
   adv_type='vtrace', 
-  axis=1
+  axis=1, 
+  scan_method='scan', 
 ):
   """ This re-implementation of rlax.vtrace_td_error_and_advantage handles 
   infinite-horizon cases with hard reset.
   Params:
     discount = 1-done. 
     axis specifies the time dimension
+    scan_method: see reverse_linear_scan
   """
   if reward.ndim < ratio.ndim:
     chex.assert_rank(ratio, 4)
@@ -285,12 +331,7 @@ def v_trace_from_ratio(
   else:
     discounted_ratio = discount * clipped_c
   
-  err = 0.
-  errors = []
-  for i in reversed(range(delta.shape[0])):
-    err = delta[i] + discounted_ratio[i] * err
-    errors.append(err)
-  advs = jnp.array(errors[::-1])
+  advs = reverse_linear_scan(delta, discounted_ratio, scan_method)
   vs = advs + value
 
   if rho_clip_pg is None:
@@ -343,7 +384,8 @@ def compute_target_advantage(
       rho_clip=config.rho_clip, 
       rho_clip_pg=config.rho_clip_pg, 
       adv_type=config.get('adv_type', 'vtrace'), 
-      axis=axis
+      axis=axis, 
+      scan_method=config.get('scan_method', 'scan'), 
     )
   elif config.target_type == 'gae':
     v_target, advantage = gae(
@@ -354,7 +396,8 @@ def compute_target_advantage(
       reset=reset, 
       gamma=gamma, 
       lam=lam, 
-      axis=axis
+      axis=axis, 
+      scan_method=config.get('scan_method', 'scan'), 
     )
   elif config.target_type == 'td':
     if reset is not None:
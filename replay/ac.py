@@ -1,15 +1,18 @@
+from typing import Union
 import collections
 import logging
 import time
 import numpy as np
 import jax
 
+from core.ckpt.flat import FlatParams
 from core.elements.buffer import Buffer
 from core.elements.model import Model
 from tools.log import do_logging
 from core.typing import AttrDict, dict2AttrDict
 from tools.display import print_dict_info
-from tools.utils import batch_dicts, batch_states, stack_data_with_state
+from tools.timer import Timer
+from tools.utils import stack_data_with_state
 from replay import replay_registry
 
 logger = logging.getLogger(__name__)
@@ -134,7 +137,8 @@ class ACBuffer(Buffer):
     return self._sample_wait_time
 
   def reset(self):
-    self._buffers = collections.defaultdict(lambda: collections.defaultdict(list))
+    self._batch = None
+    self._n_rows = 0
     self._queue = collections.deque(maxlen=self.config.get('queue_len', 1))
     self._memory = []
     self._current_size = 0
@@ -151,45 +155,56 @@ class ACBuffer(Buffer):
     assert len(self._buffer) == 0, self._buffer
     self._buffer['obs'] = data['obs']
 
-  def merge_data(self, rid: int, data: dict, n: int):
-    """ Merging Data from Other Buffers """
+  def merge_data(self, rid: int, data: Union[dict, FlatParams], n: int):
+    """ Merging Data from Other Buffers
+
+    Data are copied into a preallocated batch as they arrive, and 
+    the latest batch_size rows are kept once max_size is reached.
+    Packed data are unpacked as views without copying
+    """
+    if isinstance(data, FlatParams):
+      with Timer('rollout_unpack'):
+        data = data.unpack()
+    with Timer('rollout_merge'):
+      data = self._select_sample_keys(data)
+      if self._batch is None:
+        self._batch = jax.tree_util.tree_map(
+          lambda x: np.empty((self.batch_size, *x.shape[1:]), x.dtype), data)
+      jax.tree_util.tree_map(
+        lambda b, x: self._write_rows(b, x, self._n_rows), self._batch, data)
+      self._n_rows += next(iter(jax.tree_util.tree_leaves(data))).shape[0]
+      self._current_size += n
+
+      if self._current_size >= self.max_size:
+        data = self._batch
+        shift = self._n_rows % self.batch_size
+        if self._n_rows > self.batch_size and shift:
+          # rows are written in a ring, restores their order
+          data = jax.tree_util.tree_map(lambda x: np.roll(x, -shift, 0), data)
+        # assert len(self._queue) == 0 or data.used, list(self._queue[0])
+        self._queue.append(data)
+        self._batch = None
+        self._n_rows = 0
+        self._current_size = 0
+
+  def _select_sample_keys(self, data: dict):
+    selected = AttrDict()
     for k, v in data.items():
-      self._buffers[rid][k].append(v)
-    self._current_size += n
-
-    if self._current_size >= self.max_size:
-      keys = list(next(iter(self._buffers.values())))
-      data = AttrDict()
-      for k in self.sample_keys:
-        if k == 'action':
-          v = batch_dicts(
-            sum([b[k] for b in self._buffers.values()], []), 
-            np.concatenate
-          )
-          data[k] = jax.tree_map(lambda x: x[-self.batch_size:], v)
-        elif k == 'prev_info':
-          for kk in keys:
-            if k in kk:
-              v = batch_dicts(
-                sum([b[kk] for b in self._buffers.values()], []), 
-                np.concatenate
-              )
-              data[kk] = jax.tree_map(lambda x: x[-self.batch_size:], v)
-        elif k == 'state':
-          data[k] = batch_states(
-            [batch_states(b[k], axis=0, func=np.concatenate) 
-             for b in self._buffers.values() if b], 
-            axis=0, func=np.concatenate)
-        elif k not in self._buffers[rid]:
-          continue
-        else:
-          data[k] = np.concatenate(
-            [np.concatenate(b[k]) for b in self._buffers.values() if b]
-          )[-self.batch_size:]
-      # assert len(self._queue) == 0 or data.used, list(self._queue[0])
-      self._queue.append(data)
-      self._buffers = collections.defaultdict(lambda: collections.defaultdict(list))
-      self._current_size = 0
+      if k in self.sample_keys or ('prev_info' in self.sample_keys and 'prev_info' in k):
+        selected[k] = v
+    return selected
+
+  def _write_rows(self, batch: np.ndarray, x: np.ndarray, n_rows: int):
+    if x.shape[0] > self.batch_size:
+      n_rows += x.shape[0] - self.batch_size
+      x = x[-self.batch_size:]
+    start = n_rows % self.batch_size
+    end = start + x.shape[0]
+    if end <= self.batch_size:
+      batch[start:end] = x
+    else:
+      batch[start:] = x[:self.batch_size - start]
+      batch[:end - self.batch_size] = x[self.batch_size - start:]
 
   def get_data(self, last_piece=None):
     _, data, _ = self._buffer.retrieve_all_data(last_piece)
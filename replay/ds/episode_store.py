@@ -0,0 +1,155 @@
+import numpy as np
+
+from replay.ds.ring_buffer import RingBuffer, MemmapRingBuffer
+
+
+class EpisodeStore:
+  """ Episodes concatenated in a RingBuffer, indexed by (start, length)
+
+  Episodes are laid out contiguously in FIFO order. The index keeps the
+  physical start, the length and the cumulative number of valid windows
+  of every live episode in flat arrays, where live episodes occupy
+  [head, tail). Evicting the oldest episode only advances head; the
+  arrays are compacted when tail reaches their end, which makes
+  eviction amortized O(1). When the underlying buffer is a
+  MemmapRingBuffer, the index is persisted with its metadata.
+  """
+  def __init__(self, memory: RingBuffer, max_episodes, seqlen=1):
+    self._memory = memory
+    self._max_episodes = max_episodes
+    self._seqlen = seqlen
+
+    size = 2 * (max_episodes + 1)
+    self._starts = np.zeros(size, np.int64)
+    self._lengths = np.zeros(size, np.int64)
+    # cumulative number of valid windows of length seqlen,
+    # _cum_windows[i] counts windows of episodes up to i(inclusive)
+    self._cum_windows = np.zeros(size, np.int64)
+    self._head = 0
+    self._tail = 0
+    self._n_transitions = 0
+
+    if isinstance(self._memory, MemmapRingBuffer) \
+        and 'episodes' in self._memory.info:
+      for start, length in self._memory.info['episodes'][-max_episodes:]:
+        self._append(start, length)
+
+  def __len__(self):
+    return self._tail - self._head
+
+  @property
+  def memory(self):
+    return self._memory
+
+  @property
+  def n_transitions(self):
+    return self._n_transitions
+
+  @property
+  def n_windows(self):
+    return self._window_count(self._tail) - self._window_count(self._head)
+
+  def add_episode(self, eps):
+    """ Appends an episode whose values are stacked along the first axis,
+    returning the number of evicted episodes """
+    epslen = len(next(iter(eps.values())))
+    assert epslen <= self._memory.capacity, (epslen, self._memory.capacity)
+    n_popped = 0
+    while self._n_transitions + epslen > self._memory.capacity:
+      self.pop_episode()
+      n_popped += 1
+    start = self._memory.idx
+    self._memory.extend_batch(eps, epslen)
+    self._append(start, epslen)
+    while len(self) > self._max_episodes:
+      self.pop_episode()
+      n_popped += 1
+    self._update_info()
+
+    return n_popped
+
+  def pop_episode(self):
+    assert len(self) > 0
+    self._n_transitions -= self._lengths[self._head]
+    self._head += 1
+
+  def clear(self):
+    self._head = self._tail = 0
+    self._n_transitions = 0
+    self._memory.clear()
+    self._update_info()
+
+  """ Indexing """
+  def episodes(self, eids):
+    """ Returns starts and lengths of episodes eids,
+    where 0 is the oldest episode """
+    eids = self._head + np.asarray(eids)
+    return self._starts[eids], self._lengths[eids]
+
+  def sample_windows(self, batch_size, seqlen=None, n=None, balance='episode'):
+    """ Samples starts and offsets of batch_size windows of length seqlen
+    from the n most recent episodes
+
+    Args:
+      balance: 'episode' samples an episode uniformly and then a window
+        within it; 'window' samples uniformly among all valid windows
+    """
+    seqlen = seqlen or self._seqlen
+    n = len(self) if n is None else min(n, len(self))
+    head = self._tail - n
+    lengths = self._lengths[head:self._tail]
+    if balance == 'episode':
+      eids = np.random.randint(n, size=batch_size)
+      n_windows = lengths[eids] - seqlen + 1
+      assert np.all(n_windows > 0), f'Episodes shorter than {seqlen}'
+      offsets = np.random.randint(n_windows)
+    elif balance == 'window':
+      if seqlen == self._seqlen:
+        cum_windows = self._cum_windows[head:self._tail] \
+          - self._window_count(head)
+      else:
+        cum_windows = np.cumsum(np.maximum(lengths - seqlen + 1, 0))
+      windows = np.random.randint(cum_windows[-1], size=batch_size)
+      eids = np.searchsorted(cum_windows, windows, side='right')
+      offsets = windows - (cum_windows[eids] \
+        - np.maximum(lengths[eids] - seqlen + 1, 0))
+    else:
+      raise ValueError(f'Unknown balance: {balance}')
+    starts = self._starts[head + eids]
+
+    return starts, offsets
+
+  def get(self, starts, offsets, seqlen, keys=None):
+    """ Gathers windows [start+offset, start+offset+seqlen) """
+    idxes = (starts + offsets)[:, None] + np.arange(seqlen)
+    idxes = idxes % self._memory.capacity
+    return self._memory.get(idxes, keys=keys)
+
+  """ Implementation """
+  def _window_count(self, i):
+    return self._cum_windows[i-1] if i > 0 else 0
+
+  def _append(self, start, length):
+    if self._tail == len(self._starts):
+      self._compact()
+    n_windows = max(length - self._seqlen + 1, 0)
+    self._starts[self._tail] = start
+    self._lengths[self._tail] = length
+    self._cum_windows[self._tail] = self._window_count(self._tail) + n_windows
+    self._tail += 1
+    self._n_transitions += length
+
+  def _compact(self):
+    n = len(self)
+    offset = self._window_count(self._head)
+    for v in (self._starts, self._lengths, self._cum_windows):
+      v[:n] = v[self._head:self._tail]
+    self._cum_windows[:n] -= offset
+    self._head, self._tail = 0, n
+
+  def _update_info(self):
+    if isinstance(self._memory, MemmapRingBuffer):
+      self._memory.update_info(episodes=np.stack([
+        self._starts[self._head:self._tail],
+        self._lengths[self._head:self._tail]
+      ], -1))
@@ -0,0 +1,402 @@
+import os
+from contextlib import contextmanager
+from pathlib import Path
+import threading
+import time
+import cloudpickle
+import numpy as np
+from jax import tree_util
+
+from core.typing import AttrDict, dict2AttrDict
+from tools.log import do_logging
+from tools.utils import infer_dtype
+
+
+META_FILE = 'meta.pkl'
+# the initial number of rows of a growing RingBuffer
+MIN_ROWS = 1024
+# the number of times get retries a lock-free gather before taking the lock
+MAX_READ_RETRIES = 8
+
+
+def _is_storable(leaves):
+  return len(leaves) > 0 and all(
+    [v.dtype.kind not in ('U', 'S', 'O') for v in leaves])
+
+
+class RingBuffer:
+  """ A preallocated, columnar ring buffer
+
+  Every leaf of a transition is stored in its own array of shape
+  (capacity, *leaf_shape), allocated from the first transition.
+  Indices passed to/returned from the buffer are physical indices;
+  use logical_idxes to convert from the FIFO order, where 0 is the
+  oldest transition. With grow, arrays start with MIN_ROWS rows and 
+  double on demand until they reach capacity, which only happens 
+  before the buffer first wraps around.
+
+  Writes are serialized by a lock and bracketed by a sequence counter, 
+  which is odd while a write is in progress. Readers do not take the 
+  lock; get retries a gather that overlapped with a write, so sampling 
+  threads rarely block writers and never observe a partially written 
+  batch. After MAX_READ_RETRIES failed attempts, get waits for the lock.
+  """
+  def __init__(self, capacity, precision=None, grow=False):
+    self._capacity = int(capacity)
+    self._precision = precision
+    self._grow = grow
+    # the number of allocated rows
+    self._n_rows = 0 if grow else self._capacity
+
+    self._memory = {}
+    self._treedefs = {}
+    self._idx = 0
+    self._is_full = False
+
+    self._lock = threading.RLock()
+    self._seq = 0
+
+  def __len__(self):
+    return self._capacity if self._is_full else self._idx
+
+  @property
+  def capacity(self):
+    return self._capacity
+
+  @property
+  def idx(self):
+    return self._idx
+
+  @property
+  def is_full(self):
+    return self._is_full
+
+  @property
+  def seq(self):
+    return self._seq
+
+  def is_initialized(self):
+    return self._memory != {}
+
+  def keys(self):
+    return self._memory.keys()
+
+  def nbytes(self):
+    return sum([v.nbytes for vs in self._memory.values() for v in vs])
+
+  def clear(self):
+    with self._writing():
+      self._idx = 0
+      self._is_full = False
+
+  """ Indexing """
+  def logical_idxes(self, idxes):
+    """ Maps FIFO indices(0 for the oldest) to physical indices """
+    start = self._idx if self._is_full else 0
+    return (start + np.asarray(idxes)) % self._capacity
+
+  def prev_idxes(self, n):
+    """ Physical indices of the n most recent transitions """
+    return np.arange(self._idx - n, self._idx) % self._capacity
+
+  def next_idxes(self, n):
+    return np.arange(self._idx, self._idx + n) % self._capacity
+
+  """ Writing """
+  def extend(self, trajs):
+    """ Writes a list of transitions, returning their physical indices """
+    n = len(trajs)
+    if n == 0:
+      return np.zeros(0, dtype=np.int64)
+    assert n <= self._capacity, (n, self._capacity)
+    # stack outside the lock to keep the critical section short
+    data = {k: [np.stack(x) for x in zip(
+      *[tree_util.tree_leaves(traj[k]) for traj in trajs])]
+      for k in trajs[0]}
+    with self._writing():
+      if not self.is_initialized():
+        self._init_memory(trajs[0])
+      self._reserve(n)
+      idxes = self.next_idxes(n)
+      for k, vs in self._memory.items():
+        for v, x in zip(vs, data[k]):
+          v[idxes] = x
+      self._advance(n)
+
+    return idxes
+
+  def extend_batch(self, data, n):
+    """ Writes n transitions stacked along the first axis """
+    assert n <= self._capacity, (n, self._capacity)
+    with self._writing():
+      if not self.is_initialized():
+        self._init_memory(tree_util.tree_map(lambda x: x[0], data))
+      self._reserve(n)
+      idxes = self.next_idxes(n)
+      for k, vs in self._memory.items():
+        for v, x in zip(vs, tree_util.tree_leaves(data[k])):
+          v[idxes] = x
+      self._advance(n)
+
+    return idxes
+
+  def pop_and_extend(self, trajs):
+    """ Writes trajs, returning the overwritten transitions """
+    n = len(trajs)
+    with self._lock:
+      if self._is_full:
+        n_popped = n
+      else:
+        n_popped = max(0, self._idx + n - self._capacity)
+      if n_popped:
+        # when not full, the overwritten slots are those wrapped around to the front
+        popped = self.get(self.next_idxes(n)[n-n_popped:])
+        popped = [tree_util.tree_map(lambda x: x[i], popped)
+          for i in range(n_popped)]
+      else:
+        popped = []
+      idxes = self.extend(trajs)
+
+    return idxes, popped
+
+  """ Reading """
+  def get(self, idxes, keys=None, add_seq_axis=False):
+    """ Gathers transitions at physical indices idxes """
+    idxes = np.asarray(idxes)
+    for _ in range(MAX_READ_RETRIES):
+      seq = self._seq
+      if seq % 2 == 0:
+        samples = self._gather(idxes, keys, add_seq_axis)
+        if self._seq == seq:
+          return samples
+      # a write is in progress or has happened during the gather
+      time.sleep(0)
+    # writes are too frequent for an optimistic read to succeed
+    with self._lock:
+      return self._gather(idxes, keys, add_seq_axis)
+
+  def retrieve_all(self):
+    """ Retrieves all transitions in FIFO order and clears the buffer """
+    with self._lock:
+      data = self.get(self.logical_idxes(np.arange(len(self))))
+      data = [tree_util.tree_map(lambda x: x[i], data)
+        for i in range(len(self))]
+      self.clear()
+    return data
+
+  """ Implementation """
+  @contextmanager
+  def _writing(self):
+    with self._lock:
+      self._seq += 1
+      try:
+        yield
+      finally:
+        self._seq += 1
+
+  def _gather(self, idxes, keys, add_seq_axis):
+    if keys is None:
+      keys = list(self._memory)
+    if add_seq_axis:
+      fn = lambda v: np.expand_dims(v[idxes], 1)
+    else:
+      fn = lambda v: v[idxes]
+    samples = AttrDict()
+    for k in keys:
+      if k not in self._memory:
+        continue
+      v = tree_util.tree_unflatten(
+        self._treedefs[k], [fn(v) for v in self._memory[k]])
+      samples[k] = dict2AttrDict(v) if isinstance(v, dict) else v
+
+    return samples
+
+  def _init_memory(self, traj):
+    if self._grow:
+      self._n_rows = min(self._capacity, MIN_ROWS)
+    for k, v in traj.items():
+      leaves, treedef = tree_util.tree_flatten(v)
+      leaves = [np.asarray(x) for x in leaves]
+      if not _is_storable(leaves):
+        # ignore strings and Nones
+        continue
+      # treedefs go first as readers only look at keys in _memory
+      self._treedefs[k] = treedef
+      self._memory[k] = [self._allocate(
+        f'{k}.{i}', 
+        (self._n_rows, *x.shape),
+        infer_dtype(x.dtype, self._precision) or x.dtype
+      ) for i, x in enumerate(leaves)]
+
+  def _allocate(self, name, shape, dtype):
+    return np.zeros(shape, dtype)
+
+  def _reserve(self, n):
+    """ Grows arrays so that n more transitions fit before wrapping """
+    if self._n_rows == self._capacity or self._idx + n <= self._n_rows:
+      return
+    n_rows = min(self._capacity, max(self._idx + n, 2 * self._n_rows))
+    for vs in self._memory.values():
+      for i, v in enumerate(vs):
+        new_v = np.zeros((n_rows, *v.shape[1:]), v.dtype)
+        new_v[:self._idx] = v[:self._idx]
+        vs[i] = new_v
+    self._n_rows = n_rows
+
+  def _advance(self, n):
+    self._idx += n
+    if self._idx >= self._capacity:
+      self._idx %= self._capacity
+      self._is_full = True
+
+  """ Pickling """
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_memory'] = {
+      k: tree_util.tree_unflatten(self._treedefs[k], vs)
+      for k, vs in self._memory.items()
+    }
+    del state['_treedefs']
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    memory = state.pop('_memory')
+    self.__dict__.update(state)
+    self._lock = threading.RLock()
+    self._memory = {}
+    self._treedefs = {}
+    for k, v in memory.items():
+      self._memory[k], self._treedefs[k] = tree_util.tree_flatten(v)
+
+
+class MemmapRingBuffer(RingBuffer):
+  """ A RingBuffer whose arrays live in np.memmap files under directory
+
+  Alongside the arrays, a small metadata file records the schema, the 
+  write position, and any info set by the owner through update_info. 
+  Constructing a MemmapRingBuffer on an existing directory reopens the 
+  arrays without reading them. Dirty pages are flushed by a background 
+  thread every flush_period seconds, after which the metadata is 
+  atomically replaced.
+  """
+  def __init__(self, capacity, precision=None, *, directory, flush_period=60):
+    super().__init__(capacity, precision)
+    self._directory = Path(directory).expanduser()
+    self._directory.mkdir(parents=True, exist_ok=True)
+    self._flush_period = flush_period
+    self._info = {}
+    self._flushed_seq = 0
+
+    self._open()
+
+    self._stop_event = threading.Event()
+    if self._flush_period:
+      self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+      self._flusher.start()
+
+  @property
+  def directory(self):
+    return self._directory
+
+  @property
+  def info(self):
+    return self._info
+
+  def update_info(self, **kwargs):
+    """ Sets owner-defined metadata that is persisted with the next flush """
+    with self._lock:
+      self._info.update(kwargs)
+
+  def flush(self):
+    """ Flushes arrays to disk and then records metadata
+
+    Writers wait for the flush so that the metadata describes exactly 
+    the flushed contents
+    """
+    with self._lock:
+      if self._seq == self._flushed_seq:
+        return
+      for vs in self._memory.values():
+        for v in vs:
+          v.flush()
+      meta = dict(
+        capacity=self._capacity, 
+        idx=self._idx, 
+        is_full=self._is_full, 
+        schema={
+          k: tree_util.tree_unflatten(
+            self._treedefs[k], [f'{k}.{i}.npy' for i in range(len(vs))])
+          for k, vs in self._memory.items()
+        }, 
+        info=dict(self._info), 
+      )
+      tmp_path = self._directory / f'{META_FILE}.tmp'
+      with open(tmp_path, 'wb') as f:
+        cloudpickle.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(tmp_path, self._directory / META_FILE)
+      self._flushed_seq = self._seq
+
+  def close(self):
+    self._stop_event.set()
+    self.flush()
+
+  """ Implementation """
+  def _allocate(self, name, shape, dtype):
+    return np.lib.format.open_memmap(
+      self._directory / f'{name}.npy', mode='w+', dtype=dtype, shape=shape)
+
+  def _open(self):
+    meta_path = self._directory / META_FILE
+    if not meta_path.exists():
+      return
+    with open(meta_path, 'rb') as f:
+      meta = cloudpickle.load(f)
+    assert meta['capacity'] == self._capacity, \
+      f'Inconsistent capacity: {meta["capacity"]} vs {self._capacity}'
+    for k, v in meta['schema'].items():
+      filenames, treedef = tree_util.tree_flatten(v)
+      self._memory[k] = [np.lib.format.open_memmap(
+        self._directory / f, mode='r+') for f in filenames]
+      self._treedefs[k] = treedef
+    self._idx = meta['idx']
+    self._is_full = meta['is_full']
+    self._info = meta['info']
+    do_logging(f'Reopening {len(self)} transitions from {self._directory}')
+
+  def _flush_loop(self):
+    while not self._stop_event.wait(self._flush_period):
+      self.flush()
+
+  """ Pickling """
+  def __getstate__(self):
+    self.flush()
+    return dict(
+      capacity=self._capacity, 
+      precision=self._precision, 
+      directory=self._directory, 
+      flush_period=self._flush_period, 
+    )
+
+  def __setstate__(self, state):
+    self.__init__(**state)
+
+
+def create_ring_buffer(
+  capacity, 
+  precision=None, 
+  storage='memory', 
+  directory=None, 
+  flush_period=60, 
+  grow=False, 
+):
+  if storage == 'memory':
+    return RingBuffer(capacity, precision, grow=grow)
+  elif storage == 'memmap':
+    assert directory is not None, 'A directory is required for memmap storage'
+    return MemmapRingBuffer(
+      capacity, precision, directory=directory, flush_period=flush_period)
+  else:
+    raise ValueError(f'Unknown storage: {storage}')
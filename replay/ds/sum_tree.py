@@ -80,3 +80,77 @@ class SumTree:
       diffs = diffs[idxes >= 0]
       idxes = idxes[idxes >= 0]
       self._container[idxes] += diffs
+
+
+class LevelSumTree:
+  """ A fixed-depth sum tree with an accompanying min tree
+
+  The capacity is padded to a power of two so that every leaf is at the
+  same depth. Nodes are laid out in a heap where the root is at index 1
+  and the leaves occupy [size, 2*size). Both batch_find and batch_update
+  run exactly depth vectorized steps, one per level. Duplicate indices
+  in batch_update are harmless as parents are recomputed from their 
+  children rather than incremented.
+  """
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._depth = max(int(np.ceil(np.log2(capacity))), 1)
+    self._size = 2**self._depth
+
+    self._sum = np.zeros(2 * self._size)
+    self._min = np.full(2 * self._size, np.inf)
+
+  @property
+  def total_priorities(self):
+    return self._sum[1]
+
+  @property
+  def min_priority(self):
+    return self._min[1]
+
+  def find(self, value):
+    priorities, idxes = self.batch_find(np.array([value]))
+    return priorities[0], idxes[0]
+
+  def batch_find(self, values):
+    """ vectorized find, descending one level per step """
+    values = np.array(values, dtype=np.float64)
+    idxes = np.ones(len(values), dtype=np.int64)
+    for _ in range(self._depth):
+      idxes *= 2
+      left = self._sum[idxes]
+      go_right = values > left
+      values -= left * go_right
+      idxes += go_right
+
+    return self._sum[idxes], idxes - self._size
+
+  def stratified_find(self, batch_size):
+    """ Samples one value from each of batch_size equal segments """
+    segment = self.total_priorities / batch_size
+    values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * segment
+    return self.batch_find(values)
+
+  def update(self, mem_idx, value):
+    self.batch_update(np.array([mem_idx]), np.array([value]))
+
+  def batch_update(self, mem_idxes, values):
+    """ vectorized update, recomputing one level per step """
+    np.testing.assert_array_less(0, values)
+    idxes = np.asarray(mem_idxes, dtype=np.int64) + self._size
+    self._sum[idxes] = values
+    self._min[idxes] = values
+    level_size = self._size
+    for _ in range(self._depth):
+      level_size //= 2
+      if level_size <= len(idxes):
+        # recomputing the whole level is cheaper than fancy indexing
+        lo, hi = level_size, 2 * level_size
+        self._sum[lo:hi] = self._sum[2*lo:2*hi:2] + self._sum[2*lo+1:2*hi:2]
+        self._min[lo:hi] = np.minimum(
+          self._min[2*lo:2*hi:2], self._min[2*lo+1:2*hi:2])
+      else:
+        idxes //= 2
+        left, right = 2 * idxes, 2 * idxes + 1
+        self._sum[idxes] = self._sum[left] + self._sum[right]
+        self._min[idxes] = np.minimum(self._min[left], self._min[right])
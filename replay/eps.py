@@ -3,7 +3,6 @@ import collections
 from datetime import datetime
 import logging
 from pathlib import Path
-import random
 import uuid
 from typing import List
 import numpy as np
@@ -14,7 +13,9 @@ from tools.log import do_logging
 from core.typing import AttrDict
 from replay.local import EpisodicBuffer
 from replay.utils import load_data, save_data
-from tools.utils import batch_dicts, yield_from_tree
+from replay.ds.episode_store import EpisodeStore
+from replay.ds.ring_buffer import create_ring_buffer
+from tools.utils import yield_from_tree
 from tools.display import print_dict_info
 from replay import replay_registry
 
@@ -42,11 +43,22 @@ class EpisodicReplay(Buffer):
     if self._save:
       self._dir.mkdir(parents=True, exist_ok=True)
 
+    # filenames of the saved episodes, aligned with episodes in self._store
     self._filenames = collections.deque()
-    self._memory = {}
 
     self.max_episodes = self.config.get('max_episodes', 1000)
     self.min_episodes = self.config.get('min_episodes', 10)
+    # 'episode' samples episodes uniformly, 'window' samples windows uniformly
+    self.balance = self.config.get('balance', 'episode')
+    self._storage = self.config.get('storage', 'memory')
+    self._store = EpisodeStore(create_ring_buffer(
+      self._get_max_transitions(), 
+      self.config.get('precision'), 
+      storage=self._storage, 
+      directory=self._dir, 
+      flush_period=self.config.get('flush_period', 60), 
+      grow=True, 
+    ), self.max_episodes, seqlen=self.sample_size or 1)
     self.batch_size = self.config.batch_size
     self.n_recency = self.config.get('n_recency', self.min_episodes)
 
@@ -55,11 +67,21 @@ class EpisodicReplay(Buffer):
       for _ in range(self.n_envs)
     ]
 
+  def _get_max_transitions(self):
+    """ Transitions of max_episodes full-length episodes unless specified """
+    if self.config.get('max_transitions'):
+      return int(float(self.config.max_transitions))
+    max_episode_steps = self.config.get('max_episode_steps') \
+      or self.env_stats.get('max_episode_steps')
+    if max_episode_steps:
+      return int(self.max_episodes * max_episode_steps)
+    return int(1e6)
+
   def ready_to_sample(self):
     return len(self) >= self.min_episodes
 
   def __len__(self):
-    return len(self._filenames)
+    return len(self._store)
 
   def add(self, idxes=None, **data):
     if self.n_envs > 1:
@@ -116,31 +138,23 @@ class EpisodicReplay(Buffer):
       episodes = [episodes]
     timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
     for eps in episodes:
+      if eps is None:
+        continue
       epslen = len(next(iter(eps.values())))
-      if eps is None or (self.sample_size and epslen < self.sample_size):
+      if self.sample_size and epslen < self.sample_size:
         # do_logging(f'Ignore short episode of length {epslen}. Minimum acceptable episode length: {self.sample_size}')
         continue  # ignore None/short episodes
-      identifier = str(uuid.uuid4().hex)
-      filename = self._dir / f'{timestamp}-{identifier}-{epslen}.npz'
-      self._memory[filename] = eps
-      if self._save:
+      n_popped = self._store.add_episode(eps)
+      if self._save and self._storage == 'memory':
+        identifier = str(uuid.uuid4().hex)
+        filename = self._dir / f'{timestamp}-{identifier}-{epslen}.npz'
         save_data(filename, eps)
-      self._filenames.append(filename)
-    if self._save:
-      self._remove_file()
-    else:
-      self._pop_episode()
+        self._filenames.append(filename)
+        self._remove_file(n_popped)
 
   def count_episodes(self):
-    """ count the total number of episodes and transitions in the directory """
-    if self._save:
-      filenames = self._dir.glob('*.npz')
-      # subtract 1 as we don't take into account the terminal state
-      lengths = [int(n.stem.rsplit('-', 1)[-1]) - 1 for n in filenames]
-      episodes, steps = len(lengths), sum(lengths)
-      return episodes, steps
-    else:
-      return 0, 0
+    """ count the total number of episodes and transitions in the memory """
+    return len(self._store), self._store.n_transitions
   
   def count_steps(self):
     filenames = self._dir.glob('*.npz')
@@ -150,14 +164,16 @@ class EpisodicReplay(Buffer):
     return episodes, steps
 
   def load_data(self):
-    if self._memory == {}:
-      # load data from files
-      for filename in self._dir.glob('*.npz'):
-        if filename not in self._memory:
-          data = load_data(filename)
-          if data is not None:
-            self._filenames.append(filename)
-            self._memory[filename] = data
+    if self._storage == 'memmap':
+      # memmapped episodes are reopened at construction
+      do_logging(f'{len(self)} episodes are loaded', logger=logger)
+    elif len(self) == 0:
+      # load data from files, where filenames start with timestamps
+      for filename in sorted(self._dir.glob('*.npz')):
+        data = load_data(filename)
+        if data is not None:
+          self._filenames.append(filename)
+          self._remove_file(self._store.add_episode(data), unlink=False)
       do_logging(f'{len(self)} episodes are loaded', logger=logger)
     else:
       do_logging(f'There are already {len(self)} episodes in the memory. No further loading is performed', logger=logger)
@@ -170,10 +186,7 @@ class EpisodicReplay(Buffer):
     squeeze=False
   ):
     if self.ready_to_sample():
-      batch_size = batch_size or self.batch_size
-      samples = [self._sample(sample_keys, sample_size, squeeze)
-        for _ in range(batch_size)]
-      data = batch_dicts(samples)
+      data = self._sample(batch_size, sample_keys, sample_size, squeeze)
     else:
       data = None
 
@@ -189,52 +202,37 @@ class EpisodicReplay(Buffer):
   ):
     """ Sample from the most n recent trajectories. 
     """
-    batch_size = batch_size or self.batch_size
     n = n or self.n_recency
-    samples = batch_dicts(
-      [self._sample(sample_keys, sample_size, squeeze, n) 
-      for _ in range(batch_size)]
-    )
+    samples = self._sample(batch_size, sample_keys, sample_size, squeeze, n)
 
     return samples
 
-  def _sample(self, sample_keys=None, sample_size=None, squeeze=False, n=None):
-    """ Samples a sequence """
-    assert set(self._filenames) == set(self._memory), (set(self._memory) - set(self._filenames))
+  def _sample(
+    self, 
+    batch_size=None, 
+    sample_keys=None, 
+    sample_size=None, 
+    squeeze=False, 
+    n=None
+  ):
+    """ Samples a batch of sequences in a single gather """
+    batch_size = batch_size or self.batch_size
     sample_keys = sample_keys or self.sample_keys
     sample_size = sample_size or self.sample_size
-    n = n or len(self._filenames)
-    if n is None:
-      filename = random.choice(self._filenames)
-    else:
-      filename = random.choice(list(self._filenames)[-n:])
-    episode = self._memory[filename]
-    epslen = len(next(iter(episode.values())))
-    available = epslen - self.sample_size
-    assert available >= 0, f'Skipped short episode of length {epslen}.' \
-      f'{[(k, np.array(v).shape) for e in self._memory.values() for k, v in e.items()]}'
-
-    i = random.randint(0, available)
+    starts, offsets = self._store.sample_windows(
+      batch_size, sample_size, n=n, balance=self.balance)
+    sample = self._store.get(starts, offsets, sample_size, keys=sample_keys)
     if sample_size == 1 and squeeze:
-      sample = episode.subdict(*sample_keys).slice(i)
-    else:
-      sample = episode.subdict(*sample_keys).slice(
-        np.arange(i, i+sample_size))
+      sample = sample.slice(indices=0, axis=1)
 
     return sample
 
-  def _pop_episode(self):
-    if len(self._memory) > self.max_episodes:
-      filename = self._filenames.popleft()
-      assert(filename in self._memory)
-      del self._memory[filename]
-
-  def _remove_file(self):
-    if len(self._memory) > self.max_episodes:
+  def _remove_file(self, n, unlink=True):
+    """ Removes files of the n evicted episodes """
+    for _ in range(n):
       filename = self._filenames.popleft()
-      assert(filename in self._memory)
-      del self._memory[filename]
-      filename.unlink()
+      if unlink:
+        filename.unlink()
       
   def clear_temp_bufs(self):
     for b in self._tmp_bufs:
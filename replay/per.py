@@ -1,4 +1,5 @@
 import os
+import threading
 from typing import List
 import numpy as np
 
@@ -7,10 +8,12 @@ from core.elements.buffer import Buffer
 from core.elements.model import Model
 from tools.log import do_logging
 from core.typing import AttrDict
+from tools.prefetch import Prefetcher
 from tools.schedule import PiecewiseSchedule
-from tools.utils import batch_dicts, yield_from_tree
+from tools.utils import yield_from_tree
 from replay.local import NStepBuffer
-from replay.ds.sum_tree import SumTree
+from replay.ds.ring_buffer import MemmapRingBuffer, create_ring_buffer
+from replay.ds.sum_tree import LevelSumTree
 from replay import replay_registry
 from replay.mixin.rms import TemporaryRMS
 
@@ -44,9 +47,7 @@ class ProportionalPER(Buffer):
     self._filedir = filedir
     self._filename = self.config.filename if self.config.filename else 'uniform'
 
-    self._memory = [None for _ in range(self.max_size)]
-    self._is_full = False
-    self._idx = 0
+    self._memory = self._build_memory()
 
     if self.config.model_norm_obs:
       self.obs_rms = TemporaryRMS(self.config.get('obs_name', 'obs'), [0])
@@ -56,7 +57,9 @@ class ProportionalPER(Buffer):
     ]
 
     self._top_priority = 1.
-    self._data_structure = SumTree(self.max_size)
+    self._data_structure = LevelSumTree(self.max_size)
+    # guards the sum tree, which is updated by both writers and learners
+    self._tree_lock = threading.Lock()
     self._use_is_ratio = self.config.use_is_ratio
     self._alpha = self.config.get('alpha', 0)
     self._beta = self.config.get('beta', .4)
@@ -66,19 +69,28 @@ class ProportionalPER(Buffer):
     else:
       self._beta_scheduler = None
     self._sample_i = 0   # count how many times self._sample is called
+    # priorities of prefetched batches may lag behind by n_prefetch updates
+    n_prefetch = self.config.get('n_prefetch', 0)
+    self._prefetcher = Prefetcher(
+      self._prefetch, n_prefetch, name='replay') if n_prefetch else None
+    if len(self._memory):
+      # reopened memmapped transitions start with the top priority
+      self.update_data_structure(
+        np.arange(len(self)), self._top_priority * np.ones(len(self)))
 
   def __len__(self):
-    if self._is_full:
-      return self.max_size
-    else:
-      return self._idx
+    return len(self._memory)
 
   def ready_to_sample(self):
-    return len(self._memory) >= self.min_size
+    return len(self) >= self.min_size
 
   def get_obs_rms(self):
     if self.config.model_norm_obs:
       return self.obs_rms.retrieve_rms()
+
+  def get_prefetch_stats(self):
+    if self._prefetcher is not None:
+      return self._prefetcher.get_stats()
   
   def reset(self):
     pass
@@ -96,11 +108,11 @@ class ProportionalPER(Buffer):
             self.config, self.env_stats, self.model, self.aid, 0))
         traj = self._tmp_bufs[i].add(**d)
         if traj is not None:
-          trajs.append(traj)
+          trajs.extend(traj)
     else:
       traj = self._tmp_bufs[0].add(**data)
       if traj is not None:
-        trajs.append(traj)
+        trajs.extend(traj)
     self.merge(trajs)
 
   def add_and_pop(self, **data):
@@ -113,11 +125,11 @@ class ProportionalPER(Buffer):
             self.config, self.env_stats, self.model, self.aid, 0))
         traj = self._tmp_bufs[i].add(**d)
         if traj is not None:
-          trajs.append(traj)
+          trajs.extend(traj)
     else:
       traj = self._tmp_bufs[0].add(**data)
       if traj is not None:
-        trajs.append(traj)
+        trajs.extend(traj)
     popped_data.extend(self.merge_and_pop(trajs))
 
     return popped_data
@@ -125,38 +137,31 @@ class ProportionalPER(Buffer):
   def merge(self, trajs):
     if isinstance(trajs, dict):
       trajs = [trajs]
+    if not trajs:
+      return
     n = len(trajs)
-    idxes = self._get_next_idxes(self._idx, n)
-    for i, traj in zip(idxes, trajs):
-      self._memory[i] = traj
+    idxes = self._memory.extend(trajs)
     assert len(self) <= self.max_size, len(self)
     self._update_obs_rms(trajs)
 
     priority = self._top_priority * np.ones(n)
     self.update_data_structure(idxes, priority)
-    self._idx += n
-    if self._idx >= self.max_size:
-      self._idx %= self.max_size
-      self._is_full = True
+    if self._prefetcher is not None:
+      self._prefetcher.notify()
 
   def merge_and_pop(self, trajs):
     if isinstance(trajs, dict):
       trajs = [trajs]
-    popped_data = []
+    if not trajs:
+      return []
     n = len(trajs)
-    idxes = self._get_next_idxes(self._idx, n)
-    for i, traj in zip(idxes, trajs):
-      if len(self._memory) == self._memory.maxlen:
-        popped_data.append(self._memory[i])
-      self._memory[i] = traj
+    idxes, popped_data = self._memory.pop_and_extend(trajs)
     self._update_obs_rms(trajs)
     
     priority = self._top_priority * np.ones(n)
     self.update_data_structure(idxes, priority)
-    self._idx += n
-    if self._idx >= self.max_size:
-      self._idx %= self.max_size
-      self._is_full = True
+    if self._prefetcher is not None:
+      self._prefetcher.notify()
 
     return popped_data
 
@@ -166,7 +171,7 @@ class ProportionalPER(Buffer):
     n = max(batch_size, n or self.n_recency)
     if n > len(self):
       return None
-    idxes = self._get_prev_idxes(self._idx, n)
+    idxes = self._memory.prev_idxes(n)
     idxes = np.random.choice(idxes, size=batch_size, replace=False)
 
     samples = self._get_samples(
@@ -176,7 +181,10 @@ class ProportionalPER(Buffer):
 
   def sample(self, batch_size=None):
     if self.ready_to_sample():
-      samples = self._sample(batch_size=batch_size)
+      if self._prefetcher is not None and batch_size in (None, self.batch_size):
+        samples = self._prefetcher.get()
+      else:
+        samples = self._sample(batch_size=batch_size)
       self._sample_i += 1
       if self._beta_scheduler:
         self._update_beta()
@@ -191,7 +199,7 @@ class ProportionalPER(Buffer):
     batch_size = batch_size or self.batch_size
     n = len(self) if n is None else min(n, len(self))
     n = n // batch_size * batch_size
-    idxes = self._get_prev_idxes(self._idx, n)
+    idxes = self._memory.prev_idxes(n)
     np.random.shuffle(idxes)
     for i in range(0, n, batch_size):
       yield self._get_samples(idxes[i:i+batch_size], self._memory)
@@ -206,16 +214,14 @@ class ProportionalPER(Buffer):
   def update_priorities(self, priorities, idxes):
     assert not np.any(np.isnan(priorities)), priorities
     np.testing.assert_array_less(0, priorities)
-    self._top_priority = max(self._top_priority, np.max(priorities))
+    with self._tree_lock:
+      self._top_priority = max(self._top_priority, np.max(priorities))
     self.update_data_structure(idxes, priorities)
 
   """ Retrieval """
   def retrieve_all_data(self):
     self.clear_local_buffer()
-    data = self._memory
-    self._memory = [None for _ in range(self.max_size)]
-    self._is_full = False
-    self._idx = 0
+    data = self._memory.retrieve_all()
     return data
 
   def clear_local_buffer(self, drop_data=False):
@@ -233,34 +239,29 @@ class ProportionalPER(Buffer):
   
   def update_data_structure(self, idxes, priorities):
     priorities = priorities ** self._alpha
-    self._data_structure.batch_update(idxes, priorities)
+    with self._tree_lock:
+      self._data_structure.batch_update(idxes, priorities)
 
-  def _compute_IS_ratios(self, probabilities):
+  def _compute_IS_ratios(self, probabilities, min_probability):
     """
     w = (N * p)**(-beta)
     max(w) = max(N * p)**(-beta) = (N * min(p))**(-beta)
     norm_w = w / max(w) = (N*p)**(-beta) / (N * min(p))**(-beta)
          = (min(p) / p)**beta
+    where min(p) is taken over the whole buffer via the min tree
     """
-    IS_ratios = (np.min(probabilities) / probabilities)**self._beta
+    IS_ratios = (min_probability / probabilities)**self._beta
 
     return IS_ratios
 
-  def _get_prev_idxes(self, idx, n):
-    return np.arange(idx-n, idx) % self.max_size
-
-  def _get_next_idxes(self, idx, n):
-    return np.arange(idx, idx+n) % self.max_size
-
   def _sample(self, batch_size=None):
     batch_size = batch_size or self.batch_size
-    total_priorities = self._data_structure.total_priorities
-
-    intervals = np.linspace(0, total_priorities, batch_size+1)
-    values = np.random.uniform(intervals[:-1], intervals[1:])
-    priorities, idxes = self._data_structure.batch_find(values)
-    priorities = np.where(idxes >= len(self), self._top_priority, priorities)   # a lazy fix for the out-of-range find in sum tree
-    idxes = np.where(idxes >= len(self), self._idx-1, idxes)   # a lazy fix for the out-of-range find in sum tree
+    with self._tree_lock:
+      total_priorities = self._data_structure.total_priorities
+      min_priority = self._data_structure.min_priority
+      priorities, idxes = self._data_structure.stratified_find(batch_size)
+    priorities = np.where(idxes >= len(self), self._top_priority**self._alpha, priorities)   # a lazy fix for the out-of-range find in sum tree
+    idxes = np.where(idxes >= len(self), self._memory.idx-1, idxes)   # a lazy fix for the out-of-range find in sum tree
     # assert np.max(idxes) < len(self), f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
     # assert np.min(priorities) > 0, f'idxes: {idxes}\nvalues: {values}\npriorities: {priorities}\ntotal: {total_priorities}, len: {len(self)}'
 
@@ -270,19 +271,18 @@ class ProportionalPER(Buffer):
     samples.priority = priorities
     if self._use_is_ratio:
       probabilities = priorities / total_priorities
-      is_ratio = self._compute_IS_ratios(probabilities)
+      is_ratio = self._compute_IS_ratios(
+        probabilities, min_priority / total_priorities)
       samples.is_ratio = is_ratio.astype(np.float32)
 
     return samples
 
+  def _prefetch(self):
+    if self.ready_to_sample():
+      return self._sample()
+
   def _get_samples(self, idxes, memory, sample_keys=None, add_seq_dim=True):
-    if add_seq_dim:
-      fn = lambda x: np.expand_dims(np.stack(x), 1)
-    else:
-      fn = np.stack
-    samples = batch_dicts(
-      [memory[i] for i in idxes], func=fn, keys=sample_keys
-    )
+    samples = memory.get(idxes, keys=sample_keys, add_seq_axis=add_seq_dim)
 
     return samples
 
@@ -290,26 +290,49 @@ class ProportionalPER(Buffer):
     if self.config.model_norm_obs:
       self.obs_rms.update_obs_rms(trajs)
 
+  def _build_memory(self):
+    directory = None
+    if self._filedir is not None:
+      directory = os.path.join(self._filedir, self._filename)
+    return create_ring_buffer(
+      self.max_size, 
+      self.config.get('precision'), 
+      storage=self.config.get('storage', 'memory'), 
+      directory=directory, 
+      flush_period=self.config.get('flush_period', 60), 
+    )
+
   """ Save & Restore """
   def save(self, filedir=None, filename=None):
     filedir = filedir or self._filedir
     filename = filename or self._filename
-    save(
-      (self._memory, self._data_structure, self._is_full, self._idx, self._top_priority), 
-      filedir=filedir, 
-      filename=filename, 
-      name='data'
-    )
+    if isinstance(self._memory, MemmapRingBuffer):
+      # transitions are flushed incrementally, leaving the tree to save
+      self._memory.flush()
+      data = (self._data_structure, self._top_priority)
+    else:
+      data = (self._memory, self._data_structure, self._top_priority)
+    save(data, filedir=filedir, filename=filename, name='data')
     do_logging(f'Number of transitions saved: {len(self)}')
   
   def restore(self, filedir=None, filename=None):
     filedir = filedir or self._filedir
     filename = filename or self._filename
-    self._memory, self._is_full, self._idx, self._top_priority = \
-      restore(
+    if self._prefetcher is not None:
+      # drop batches sampled from the old memory
+      self._prefetcher.stop()
+    if isinstance(self._memory, MemmapRingBuffer):
+      self._data_structure, self._top_priority = restore(
+        filedir=filedir, 
+        filename=filename, 
+        default=(LevelSumTree(self.max_size), 1.), 
+        name='data'
+      )
+    else:
+      self._memory, self._data_structure, self._top_priority = restore(
         filedir=filedir, 
         filename=filename, 
-        default=([None for _ in range(self.max_size)], SumTree(self.max_size), False, 0, 1.), 
+        default=(self._build_memory(), LevelSumTree(self.max_size), 1.), 
         name='data'
       )
     do_logging(f'Number of transitions restored: {len(self)}')
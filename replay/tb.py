@@ -9,6 +9,43 @@ from core.typing import AttrDict, dict2AttrDict
 from tools.utils import batch_dicts
 from replay import replay_registry
 
+try:
+  import numba
+except ImportError:
+  numba = None
+
+
+def _reverse_discounted_sum(delta, discount):
+  """ advs[i] = delta[i] + discount[i] * advs[i+1], vectorized over 
+  all but the first dimension """
+  next_adv = 0
+  advs = np.zeros_like(delta, dtype=np.float32)
+  for i in reversed(range(advs.shape[0])):
+    advs[i] = next_adv = (delta[i] + discount[i] * next_adv)
+  return advs
+
+
+if numba is not None:
+  @numba.njit(cache=True)
+  def _reverse_discounted_sum_kernel(delta, discount, next_adv, advs):
+    # next_adv carries the promoted dtype of delta and discount as 
+    # in _reverse_discounted_sum, advs rounds it to float32
+    for i in range(delta.shape[0] - 1, -1, -1):
+      for j in range(delta.shape[1]):
+        next_adv[j] = delta[i, j] + discount[i, j] * next_adv[j]
+        advs[i, j] = next_adv[j]
+
+
+def _reverse_discounted_sum_numba(delta, discount):
+  shape = delta.shape
+  delta = np.ascontiguousarray(delta.reshape(shape[0], -1))
+  discount = np.ascontiguousarray(
+    np.broadcast_to(discount, shape).reshape(shape[0], -1))
+  next_adv = np.zeros(delta.shape[1], np.result_type(delta, discount))
+  advs = np.zeros(delta.shape, np.float32)
+  _reverse_discounted_sum_kernel(delta, discount, next_adv, advs)
+  return advs.reshape(shape)
+
 
 def compute_gae(
   reward, 
@@ -18,7 +55,13 @@ def compute_gae(
   gae_discount, 
   next_value=None, 
   reset=None, 
+  use_numba=False, 
 ):
+  """ Computes GAE along the first axis, vectorized over the others
+
+  use_numba runs the recursion in a compiled loop, which gives the same
+  results and pays off when the batch dimensions are small
+  """
   if next_value is None:
     value, next_value = value[:-1], value[1:]
   elif next_value.ndim < value.ndim:
@@ -29,15 +72,51 @@ def compute_gae(
   delta = (reward + discount * gamma * next_value - value).astype(np.float32)
   discount = (discount if reset is None else (1 - reset)) * gae_discount
   
-  next_adv = 0
-  advs = np.zeros_like(reward, dtype=np.float32)
-  for i in reversed(range(advs.shape[0])):
-    advs[i] = next_adv = (delta[i] + discount[i] * next_adv)
+  if use_numba and numba is None:
+    do_logging('numba is not installed, falling back to numpy', 
+      level='warning', once=True)
+    use_numba = False
+  if use_numba:
+    advs = _reverse_discounted_sum_numba(delta, discount)
+  else:
+    advs = _reverse_discounted_sum(delta, discount)
   traj_ret = advs + value
 
   return advs, traj_ret
 
 
+def compute_episodic_gae(episodes, gamma, gae_discount, use_numba=False):
+  """ Computes GAE for episodes terminated by discount 0 in one call
+
+  Episodes are stacked along the second axis and zero-padded to the 
+  longest one. Padding has zero discount, so every episode gets the 
+  same values as computing it alone with a zero next value.
+  """
+  lens = [len(eps['reward']) for eps in episodes]
+  maxlen = max(lens)
+  def pad(k):
+    x = episodes[0][k]
+    padded = np.zeros((maxlen, len(episodes), *x.shape[1:]), x.dtype)
+    for i, eps in enumerate(episodes):
+      padded[:lens[i], i] = eps[k]
+    return padded
+  reward, discount, value = pad('reward'), pad('discount'), pad('value')
+  next_value = np.concatenate([value[1:], np.zeros_like(value[:1])])
+  advs, traj_ret = compute_gae(
+    reward=reward, 
+    discount=discount, 
+    value=value, 
+    gamma=gamma, 
+    gae_discount=gae_discount, 
+    next_value=next_value, 
+    use_numba=use_numba, 
+  )
+  advs = [advs[:n, i] for i, n in enumerate(lens)]
+  traj_ret = [traj_ret[:n, i] for i, n in enumerate(lens)]
+
+  return advs, traj_ret
+
+
 @replay_registry.register('tblocal')
 class TurnBasedLocalBuffer(Buffer):
   def __init__(
@@ -121,14 +200,8 @@ class TurnBasedLocalBuffer(Buffer):
       assert v.shape[0] == epslen, (k, v.shape, epslen)
 
     if self.data_type == 'seq':
-      episode['advantage'], episode['v_target'] = compute_gae(
-        reward=episode['reward'], 
-        discount=episode['discount'],
-        value=episode['value'],
-        gamma=self.config.gamma,
-        gae_discount=self.config.gamma * self.config.lam,
-        next_value=np.array([0], np.float32), 
-      )
+      # advantages are computed for all episodes at once in retrieve_all_data
+      pass
     elif self.data_type == 'step':
       new_eps = {}
       for k, v in episode.items():
@@ -146,6 +219,15 @@ class TurnBasedLocalBuffer(Buffer):
     return episode
 
   def retrieve_all_data(self):
+    if self.data_type == 'seq' and self._memory:
+      advs, traj_ret = compute_episodic_gae(
+        self._memory, 
+        gamma=self.config.gamma, 
+        gae_discount=self.config.gamma * self.config.lam, 
+        use_numba=self.config.get('use_numba', False), 
+      )
+      for eps, adv, ret in zip(self._memory, advs, traj_ret):
+        eps['advantage'], eps['v_target'] = adv, ret
     data = batch_dicts(self._memory, np.concatenate)
     for k, v in data.items():
       assert v.shape[0] == self._size, (k, v.shape, self._size)
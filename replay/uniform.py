@@ -2,16 +2,20 @@ import os
 import collections
 from typing import Dict
 import numpy as np
+import jax
 
+from core.ckpt.flat import FlatParams
 from core.ckpt.pickle import save, restore
 from core.elements.buffer import Buffer
 from core.elements.model import Model
 from tools.log import do_logging
 from core.typing import AttrDict
 from replay.local import NStepBuffer
+from tools.prefetch import Prefetcher
 from tools.timer import Timer, timeit
-from tools.utils import batch_dicts, yield_from_tree, yield_from_tree_with_indices
+from tools.utils import yield_from_tree, yield_from_tree_with_indices
 from replay import replay_registry
+from replay.ds.ring_buffer import MemmapRingBuffer, create_ring_buffer
 from replay.mixin.rms import TemporaryRMS
 
 
@@ -43,23 +47,33 @@ class UniformReplay(Buffer):
     self._filedir = filedir
     self._filename = self.config.filename if self.config.filename else 'uniform'
 
-    self._memory = collections.deque(maxlen=self.max_size)
+    self._memory = self._build_memory()
 
     if self.config.model_norm_obs:
       self.obs_rms = TemporaryRMS(self.config.get('obs_name', 'obs'), [0])
     self._tmp_bufs: Dict[int, NStepBuffer] = collections.defaultdict(
       lambda: NStepBuffer(config, env_stats, model, aid, 0))
 
+    # a background thread keeping n_prefetch batches ready for sample, 
+    # which makes sample and merge safe to call from different threads
+    n_prefetch = self.config.get('n_prefetch', 0)
+    self._prefetcher = Prefetcher(
+      self._prefetch, n_prefetch, name='replay') if n_prefetch else None
+
   def __len__(self):
     return len(self._memory)
 
   def ready_to_sample(self):
-    return len(self._memory) >= self.min_size
+    return len(self) >= self.min_size
 
   def get_obs_rms(self):
     if self.config.model_norm_obs:
       return self.obs_rms.retrieve_rms()
 
+  def get_prefetch_stats(self):
+    if self._prefetcher is not None:
+      return self._prefetcher.get_stats()
+
   def reset(self):
     pass
   
@@ -89,22 +103,29 @@ class UniformReplay(Buffer):
   def merge(self, trajs):
     if isinstance(trajs, dict):
       trajs = [trajs]
+    if not trajs:
+      return
     self._memory.extend(trajs)
     assert len(self) <= self.max_size, len(self)
     self._update_obs_rms(trajs)
+    if self._prefetcher is not None:
+      self._prefetcher.notify()
 
   def merge_and_pop(self, trajs):
     if isinstance(trajs, dict):
       trajs = [trajs]
-    popped_data = []
-    for traj in trajs:
-      if len(self._memory) == self._memory.maxlen:
-        popped_data.append(self._memory.popleft())
-      self._memory.append(traj)
+    if not trajs:
+      return []
+    _, popped_data = self._memory.pop_and_extend(trajs)
     self._update_obs_rms(trajs)
+    if self._prefetcher is not None:
+      self._prefetcher.notify()
     return popped_data
 
   def merge_data(self, rid: int, data: dict, n: int):
+    if isinstance(data, FlatParams):
+      # copies out of the views since data are kept in memory
+      data = jax.tree_util.tree_map(np.array, data.unpack())
     n_seq = next(iter(data.values())).shape[1]
     for d in yield_from_tree_with_indices(data, range(n_seq), axis=1):
       self.add(rid, **d)
@@ -116,7 +137,7 @@ class UniformReplay(Buffer):
     n = max(batch_size, n or self.n_recency)
     if n > len(self):
       return None
-    idxes = np.arange(len(self)-n, len(self))
+    idxes = self._memory.prev_idxes(n)
     idxes = np.random.choice(idxes, size=batch_size, replace=False)
 
     samples = self._get_samples(
@@ -126,7 +147,11 @@ class UniformReplay(Buffer):
     
   def sample(self, batch_size=None, add_seq_axis=True):
     if self.ready_to_sample():
-      samples = self._sample(batch_size, add_seq_axis=add_seq_axis)
+      if self._prefetcher is not None and add_seq_axis \
+          and batch_size in (None, self.batch_size):
+        samples = self._prefetcher.get()
+      else:
+        samples = self._sample(batch_size, add_seq_axis=add_seq_axis)
     else:
       samples = None
 
@@ -142,6 +167,7 @@ class UniformReplay(Buffer):
       idxes = np.arange(len(self))[-n:]
     else:
       idxes = np.arange(len(self))[-(start + n):-start]
+    idxes = self._memory.logical_idxes(idxes)
     np.random.shuffle(idxes)
     # print('ergodic sample idx max', np.max(idxes), 'min', np.min(idxes))
     for i in range(0, n, batch_size):
@@ -151,19 +177,18 @@ class UniformReplay(Buffer):
     if not self.ready_to_sample():
       return None
     end = min(len(self), start+n)
-    idxes = np.arange(start, end)
+    idxes = self._memory.logical_idxes(np.arange(start, end))
     # print('range sample idx max', np.max(idxes), 'min', np.min(idxes))
     return self._get_samples(idxes, self._memory)
 
   """ Retrieval """
   def retrieve_all_data(self):
     self.clear_local_buffer()
-    data = self._memory
-    self._memory = collections.deque(maxlen=self.max_size)
+    data = self._memory.retrieve_all()
     return data
 
   def clear_local_buffer(self, drop_data=False):
-    for b in self._tmp_bufs:
+    for b in self._tmp_bufs.values():
       if drop_data:
         b.reset()
       else:
@@ -182,28 +207,54 @@ class UniformReplay(Buffer):
 
     return samples
 
+  def _prefetch(self):
+    if self.ready_to_sample():
+      return self._sample()
+
   def _get_samples(self, idxes, memory, sample_keys=None, add_seq_axis=True):
     if sample_keys is None:
       sample_keys = self.sample_keys
-    raw_samples = [memory[i] for i in idxes]
-    fn = lambda x: np.expand_dims(np.stack(x), 1) if add_seq_axis else np.stack
-    samples = batch_dicts(raw_samples, func=fn, keys=sample_keys)
+    samples = memory.get(idxes, keys=sample_keys, add_seq_axis=add_seq_axis)
     return samples
 
   def _update_obs_rms(self, trajs):
     if self.config.model_norm_obs:
       self.obs_rms.update_obs_rms(trajs)
 
+  def _build_memory(self):
+    directory = None
+    if self._filedir is not None:
+      directory = os.path.join(self._filedir, self._filename)
+    return create_ring_buffer(
+      self.max_size, 
+      self.config.get('precision'), 
+      storage=self.config.get('storage', 'memory'), 
+      directory=directory, 
+      flush_period=self.config.get('flush_period', 60), 
+    )
+
   """ Save & Restore """
   def save(self, filedir=None, filename=None):
+    if isinstance(self._memory, MemmapRingBuffer):
+      # data are flushed incrementally; only pending pages are written here
+      self._memory.flush()
+      do_logging(f'Number of transitions flushed: {len(self)}')
+      return
     filedir = filedir or self._filedir
     filename = filename or self._filename
     save(self._memory, filedir=filedir, filename=filename, name='data')
     do_logging(f'Number of transitions saved: {len(self)}')
   
   def restore(self, filedir=None, filename=None):
+    if isinstance(self._memory, MemmapRingBuffer):
+      # memmapped data are reopened at construction
+      do_logging(f'Number of transitions restored: {len(self)}')
+      return
     filedir = filedir or self._filedir
     filename = filename or self._filename
+    if self._prefetcher is not None:
+      # drop batches sampled from the old memory
+      self._prefetcher.stop()
     self._memory = restore(filedir=filedir, filename=filename, 
-      default=collections.deque(maxlen=self.max_size), name='data')
+      default=self._build_memory(), name='data')
     do_logging(f'Number of transitions restored: {len(self)}')
@@ -111,6 +111,14 @@ def parse_train_args():
   parser.add_argument(
     '--exploiter', 
     action='store_true')
+  parser.add_argument(
+    '--warmup', 
+    action='store_true', 
+    help='compile jitted functions into the compilation cache and exit')
+  parser.add_argument(
+    '--no_jax_cache', 
+    action='store_true', 
+    help='disable the persistent compilation cache under root_dir')
   args = parser.parse_args()
 
   return args
@@ -162,6 +170,17 @@ def parse_eval_args():
     '--verbose', '-v', 
     type=str, 
     default='warning')
+  parser.add_argument(
+    '--cfr', 
+    type=str, 
+    nargs='*', 
+    default=None, 
+    help='benchmark CFR solvers on the given OpenSpiel games, '
+      'kuhn_poker and leduc_poker if none is given')
+  parser.add_argument(
+    '--cfr_iterations', 
+    type=int, 
+    default=1000)
   args = parser.parse_args()
 
   return args
@@ -182,6 +201,13 @@ def parse_rank_args():
     '--n_episodes', '-n', 
     type=int, 
     default=1000)
+  parser.add_argument(
+    '--target_ci', '-ci', 
+    type=float, 
+    default=None, 
+    help='evaluate adaptively until the half widths of the confidence '
+      'intervals of payoffs are within target_ci, running at most '
+      'n_episodes for each strategy profile')
   parser.add_argument(
     '--n_envs', '-ne', 
     type=int, 
@@ -3,7 +3,6 @@ warnings.filterwarnings("ignore")
 
 import argparse
 import os, sys
-import cloudpickle
 os.environ['XLA_FLAGS'] = "--xla_gpu_force_compilation_parallelism=1"
 
 # import random
@@ -17,6 +16,9 @@ from torch.utils._pytree import tree_map
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from core.ckpt.pickle import restore_params
+from core.names import ANCILLARY
+from core.typing import ModelPath
 from core.utils import configure_jax_gpu
 from tools.display import print_dict_info
 from tools import pkg
@@ -314,21 +316,19 @@ if __name__ == '__main__':
   env_stats = config.env_stats
 
   # load parameters
+  model_path = ModelPath(config.root_dir, config.model_name)
+  model_params = restore_params(model_path, 'params/model', to_print=False)
   for policy in ['policy', 'policies']:
-    policy_ckpt = os.path.join(
-      config.root_dir, config.model_name, 'params', 'model', f'{policy}.pkl')
-    if os.path.exists(policy_ckpt):
+    if policy in model_params:
       break
-  with open(policy_ckpt, 'rb') as f:
-    params = cloudpickle.load(f)
+  params = model_params[policy]
   print_dict_info(params)
   
   # load ancillary data
-  anc_ckpt = os.path.join(config.root_dir, config.model_name, 'params', 'ancillary.pkl')
+  anc = restore_params(model_path, 'params', ANCILLARY, to_print=False)
   obs_anc = None
-  if os.path.exists(anc_ckpt):
-    with open(anc_ckpt, 'rb') as f:
-      anc = cloudpickle.load(f)
+  if anc:
+    anc = anc[ANCILLARY]
     idx = np.random.randint(len(anc.obs))
     # print('ancillary data', anc)
     obs_anc = anc.obs[idx]
@@ -13,7 +13,7 @@ from core.elements.builder import ElementsBuilder
 from tools.log import setup_logging, do_logging
 from core.names import PATH_SPLIT
 from core.typing import dict2AttrDict
-from core.utils import configure_jax_gpu
+from core.utils import configure_jax_cache, configure_jax_gpu, get_jax_cache_dir
 from tools.plot import plot_data_dict
 from tools.ray_setup import sigint_shutdown_ray
 from tools.run import evaluate
@@ -99,6 +99,7 @@ if __name__ == '__main__':
   configure_jax_gpu()
   setup_logging(args.verbose)
   configs = setup_configs(args)
+  configure_jax_cache(get_jax_cache_dir(configs[0]))
   n = compute_episodes(args)
 
 
@@ -10,7 +10,7 @@ from run.utils import search_for_config
 from distributed.common.local.controller import Controller
 
 
-def main(config, payoff_name, n):
+def main(config, payoff_name, n, target_ci=None):
   ray.init()
 
   if config.env.env_name.startswith('grl'):
@@ -23,7 +23,7 @@ def main(config, payoff_name, n):
   controller = Controller(config, to_restore=False)
   controller.build_managers_for_evaluation(config)
 
-  controller.evaluate_all(n, payoff_name)
+  controller.evaluate_all(n, payoff_name, target_ci)
 
   ray.shutdown()
 
@@ -44,4 +44,4 @@ if __name__ == '__main__':
     config.env.n_envs = args.n_envs
   n = max(config.runner.n_runners * config.env.n_envs, n)
 
-  main(config, args.payoff, n=n)
+  main(config, args.payoff, n=n, target_ci=args.target_ci)
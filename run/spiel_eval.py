@@ -21,7 +21,9 @@ from __future__ import print_function
 from open_spiel.python import policy
 from open_spiel.python import rl_environment
 from open_spiel.python.algorithms import exploitability, policy_aggregator
-import os, sys
+import pyspiel
+import hashlib
+import os, sys, time
 import numpy as np
 from jax import nn
 
@@ -31,12 +33,22 @@ from core.elements.builder import ElementsBuilder
 from tools.log import setup_logging
 from core.utils import *
 from core.typing import ModelPath, get_basic_model_name, dict2AttrDict
-from core.ckpt.pickle import set_weights_for_agent
+from core.ckpt.flat import FLAT_SUFFIX
+from core.ckpt.pickle import get_filedir, restore, save, set_weights_for_agent
 from env.func import create_env
+from game.cfr import ALGORITHMS, CFRSolver, GameTree, aggregate_policies, \
+  compute_best_response_values, compute_nash_conv
 from run.args import parse_eval_args
 from run.utils import search_for_all_configs, search_for_config
 
 
+def legal_action_probs(logits, legal_actions):
+  """ Returns the softmax of logits renormalized over legal actions, as 
+  PolicyAggregator and PolicyTableExtractor do """
+  probs = np.asarray(nn.softmax(np.squeeze(logits)), np.float64)[legal_actions]
+  return dict(zip(legal_actions, probs / np.sum(probs)))
+
+
 class RLPolicy(policy.Policy):
   """Joint policy to be evaluated."""
 
@@ -74,9 +86,7 @@ class RLPolicy(policy.Policy):
       obs[k] = np.expand_dims(np.expand_dims(v, 0), 0)
 
     _, terms, _ = self._agent.actor(obs)
-    probs = np.squeeze(nn.softmax(terms['mu_logits']))
-    prob_dict = {action: probs[action] for action in legal_actions}
-    return prob_dict
+    return legal_action_probs(terms['mu_logits'], legal_actions)
 
 
 class JointPolicy(policy.Policy):
@@ -112,9 +122,167 @@ class JointPolicy(policy.Policy):
       obs[k] = np.expand_dims(np.expand_dims(v, 0), 0)
 
     _, terms, _ = self._agents[cur_player].actor(obs)
-    probs = np.squeeze(nn.softmax(terms['mu_logits']))
-    prob_dict = {action: probs[action] for action in legal_actions}
-    return prob_dict
+    return legal_action_probs(terms['mu_logits'], legal_actions)
+
+
+def get_params_hash(model: ModelPath, name='params'):
+  """ Returns a hash of the contents of the params saved under model, 
+  or None if there are none """
+  filedir = get_filedir(model, name)
+  paths = [f'{filedir}{FLAT_SUFFIX}', f'{filedir}.pkl']
+  for root, _, files in sorted(os.walk(filedir)):
+    paths += [os.path.join(root, f) for f in sorted(files)]
+  paths = [p for p in paths if os.path.isfile(p)]
+  if not paths:
+    return None
+  md5 = hashlib.md5()
+  for p in paths:
+    md5.update(os.path.relpath(p, os.path.join(*model)).encode())
+    with open(p, 'rb') as f:
+      for chunk in iter(lambda: f.read(1 << 20), b''):
+        md5.update(chunk)
+  return md5.hexdigest()
+
+
+class PolicyTableExtractor:
+  """ Extracts the action probabilities of agents at all information 
+  states of a game as tables indexed by the information sets of the game 
+  tree. Information states are enumerated once and batched through the 
+  model in chunks of chunk_size. Tables are keyed by a hash of the 
+  contents of the params and cached in memory and, if cache_dir is 
+  given, on disk, leaving the directories of the models untouched """
+  def __init__(self, env, tree: GameTree=None, chunk_size=4096, cache_dir=None):
+    self.env = env
+    self.game = env.game
+    self.tree = tree or env.build_game_tree()
+    self.chunk_size = chunk_size
+    self.cache_dir = cache_dir
+    self._inputs = {}
+    self._tables = {}
+
+  def extract(self, config, build_agent_fn):
+    """ Returns the table of the agent of config for player config.aid, 
+    calling build_agent_fn to build the agent only if no table of the 
+    same params is cached """
+    model = ModelPath(config.root_dir, config.model_name)
+    params_hash = get_params_hash(model)
+    if params_hash is None:
+      return self._compute_table(build_agent_fn(), config.aid)
+    key = (params_hash, config.aid)
+    if key in self._tables:
+      return self._tables[key]
+    filename = f'policy_table-{params_hash}-{config.aid}'
+    data = None
+    if self.cache_dir is not None:
+      data = restore(filedir=self.cache_dir, filename=filename, 
+        default=None, to_print=False)
+    if data is not None and data['game'] == str(self.game):
+      table = data['table']
+    else:
+      table = self._compute_table(build_agent_fn(), config.aid)
+      if self.cache_dir is not None:
+        save(dict(game=str(self.game), table=table), 
+          filedir=self.cache_dir, filename=filename, to_print=False)
+    self._tables[key] = table
+    return table
+
+  def _compute_table(self, agent, player):
+    """ Computes the probabilities of RLPolicy.action_probabilities, i.e., 
+    the softmax of logits renormalized over legal actions """
+    inputs, infosets = self._get_inputs(player)
+    table = self.tree.uniform_policy()
+    for start in range(0, infosets.size, self.chunk_size):
+      inp = {k: v[start:start+self.chunk_size] for k, v in inputs.items()}
+      _, terms, _ = agent.actor(inp)
+      logits = np.reshape(terms['mu_logits'], (-1, self.tree.n_actions))
+      table[infosets[start:start+self.chunk_size]] = np.asarray(nn.softmax(logits))
+    table = np.where(self.tree.legal_actions, table, 0)
+    return table / np.sum(table, -1, keepdims=True)
+
+  def _get_inputs(self, player):
+    """ Returns the model inputs and information sets of all information 
+    states of player """
+    if player in self._inputs:
+      return self._inputs[player]
+    tabular_policy = policy.TabularPolicy(self.game, [player])
+    obs_list, infosets = [], []
+    for key, idx in tabular_policy.state_lookup.items():
+      state = tabular_policy.states[idx]
+      obs = {"info_state": [None, None], "legal_actions": [None, None]}
+      obs["current_player"] = player
+      obs["info_state"][player] = state.information_state_tensor(player)
+      obs["legal_actions"][player] = state.legal_actions(player)
+      time_step = rl_environment.TimeStep(
+        observations=obs, 
+        rewards=None, 
+        discounts=None, 
+        step_type=None
+      )
+      obs_list.append(self.env.get_obs(time_step))
+      infosets.append(self.tree.infoset_index[key])
+    # the batch of the inputs of RLPolicy.action_probabilities
+    inputs = {k: np.expand_dims(np.stack([o[k] for o in obs_list]), 1) 
+      for k in obs_list[0]}
+    n = len(obs_list)
+    inputs['prev_action'] = np.zeros((n, 1, self.tree.n_actions), dtype=np.float32)
+    inputs['prev_reward'] = np.zeros((n, 1), dtype=np.float32)
+    self._inputs[player] = (inputs, np.array(infosets))
+    return self._inputs[player]
+
+
+_extractors = {}
+
+
+def get_policy_table_extractor(env, env_name, cache_dir=None):
+  """ Returns the extractor of env_name, shared across evaluations in 
+  this process """
+  key = (env_name, cache_dir)
+  if key not in _extractors:
+    _extractors[key] = PolicyTableExtractor(env, cache_dir=cache_dir)
+  return _extractors[key]
+
+
+def compute_nash_conv_stats(tree: GameTree, policy_array: np.ndarray, prefix=''):
+  """ Returns the statistics reported by exploitability.best_response 
+  for both players """
+  br_values, on_policy = compute_best_response_values(tree, policy_array)
+  nash_convs = br_values - on_policy
+  stats = dict(
+    nash_conv=(nash_convs[0] + nash_convs[1]) / 2, 
+    nash_conv1=nash_convs[0], 
+    nash_conv2=nash_convs[1], 
+    expl2=br_values[0], 
+    expl1=br_values[1], 
+    expl=(br_values[0] + br_values[1]) / 2, 
+    on_policy_value1=on_policy[0], 
+    on_policy_value2=on_policy[1], 
+  )
+  return {f'{prefix}{k}': float(v) for k, v in stats.items()}
+
+
+def compute_tabular_nash_conv(
+  configs, latest_configs, env, avg=True, latest=True, cache_dir=None):
+  """ Computes NashConvs on the policy tables of agents, building only 
+  the agents whose tables are not cached """
+  extractor = get_policy_table_extractor(
+    env, configs[0].env.env_name, cache_dir=cache_dir)
+  tree = extractor.tree
+  builder = ElementsBuilder(configs[0], env.stats())
+  def extract(config):
+    return extractor.extract(config, lambda: build_agent(builder, config, env))
+
+  nash_conv = {}
+  if avg:
+    tables = [[extract(c) for c in configs if c.aid == aid] for aid in range(2)]
+    nash_conv.update(compute_nash_conv_stats(
+      tree, aggregate_policies(tree, tables)))
+  if latest:
+    latest_configs = sorted(latest_configs, key=lambda c: c.aid)
+    tables = [[extract(c)] for c in latest_configs]
+    nash_conv.update(compute_nash_conv_stats(
+      tree, aggregate_policies(tree, tables), prefix='latest_'))
+  return nash_conv
+
 
 def build_agent(builder, config, env):
   name = 'params'
@@ -177,6 +345,56 @@ def build_policies(configs, env):
   return aggr_policy
 
 
+def to_tabular_policy(game, tree: GameTree, policy_array: np.ndarray):
+  """ Converts a policy over the information sets of tree to an OpenSpiel 
+  TabularPolicy """
+  tabular_policy = policy.TabularPolicy(game)
+  for key, idx in tabular_policy.state_lookup.items():
+    tabular_policy.action_probability_array[idx] = policy_array[tree.infoset_index[key]]
+  return tabular_policy
+
+
+def benchmark_cfr(
+  games=('kuhn_poker', 'leduc_poker'), 
+  algos=ALGORITHMS, 
+  n_iterations=1000, 
+  n_workers=0, 
+  seed=0, 
+):
+  """ Runs the array-based CFR solvers on OpenSpiel games, reporting 
+  iterations per second and NashConvs cross-checked against OpenSpiel """
+  results = []
+  for name in games:
+    game = pyspiel.load_game(name)
+    start = time.time()
+    tree = GameTree.from_game(game)
+    print(f'{name}: {tree.n_nodes} nodes, {tree.n_infosets} information sets, '
+      f'built in {time.time() - start:.3g}s')
+    for algo in algos:
+      solver = CFRSolver(tree, algo, n_workers=n_workers, seed=seed)
+      start = time.time()
+      solver.iterate(n_iterations)
+      duration = time.time() - start
+      solver.close()
+      avg_policy = solver.average_policy()
+      nash_conv = compute_nash_conv(tree, avg_policy)
+      spiel_nash_conv = exploitability.nash_conv(
+        game, to_tabular_policy(game, tree, avg_policy))
+      np.testing.assert_allclose(nash_conv, spiel_nash_conv, rtol=1e-6, atol=1e-9)
+      result = dict(
+        game=name, 
+        algo=algo, 
+        n_iterations=n_iterations, 
+        iterations_per_second=n_iterations / duration, 
+        nash_conv=nash_conv, 
+        exploitability=nash_conv / tree.n_players, 
+      )
+      print('\t'.join([f'{k}={v:.3g}' if isinstance(v, float) else f'{k}={v}' 
+        for k, v in result.items()]))
+      results.append(result)
+  return results
+
+
 def main(
   configs, 
   step, 
@@ -184,6 +402,7 @@ def main(
   avg=True, 
   latest=True, 
   write_to_disk=True, 
+  tabular=True, 
 ):
   configs = [dict2AttrDict(c) for c in configs]
   if configs[0].self_play:
@@ -207,37 +426,44 @@ def main(
   configure_jax_gpu(None)
 
   nash_conv = {'step': step}
-
-  if avg:
-    aggr_policy = build_policies(configs, env)
-    br1 = exploitability.best_response(env.game, aggr_policy, 0)
-    br2 = exploitability.best_response(env.game, aggr_policy, 1)
-    nash_conv.update(dict(
-      nash_conv=(br1['nash_conv'] + br2['nash_conv']) / 2, 
-      nash_conv1=br1['nash_conv'], 
-      nash_conv2=br2['nash_conv'], 
-      expl2=br1['best_response_value'], 
-      expl1=br2['best_response_value'], 
-      expl=(br1['best_response_value'] + br2['best_response_value']) / 2, 
-      on_policy_value1=br1['on_policy_value'], 
-      on_policy_value2=br2['on_policy_value'], 
-    ))
-
   latest_configs = get_latest_configs(configs)
-  if latest:
-    joint_policy = build_latest_joint_policy(latest_configs, env)
-    br1 = exploitability.best_response(env.game, joint_policy, 0)
-    br2 = exploitability.best_response(env.game, joint_policy, 1)
-    nash_conv.update(dict(
-      latest_nash_conv=(br1['nash_conv'] + br2['nash_conv']) / 2, 
-      latest_nash_conv1=br1['nash_conv'], 
-      latest_nash_conv2=br2['nash_conv'], 
-      latest_expl2=br1['best_response_value'], 
-      latest_expl1=br2['best_response_value'], 
-      latest_expl=(br1['best_response_value'] + br2['best_response_value']) / 2, 
-      latest_on_policy_value1=br1['on_policy_value'], 
-      latest_on_policy_value2=br2['on_policy_value'], 
-    ))
+
+  if tabular:
+    # tables are cached next to the evaluation output
+    cache_dir = None if filename is None else \
+      os.path.join(os.path.dirname(os.path.abspath(filename)), 'policy_tables')
+    nash_conv.update(compute_tabular_nash_conv(
+      configs, latest_configs, env, avg=avg, latest=latest, cache_dir=cache_dir))
+  else:
+    if avg:
+      aggr_policy = build_policies(configs, env)
+      br1 = exploitability.best_response(env.game, aggr_policy, 0)
+      br2 = exploitability.best_response(env.game, aggr_policy, 1)
+      nash_conv.update(dict(
+        nash_conv=(br1['nash_conv'] + br2['nash_conv']) / 2, 
+        nash_conv1=br1['nash_conv'], 
+        nash_conv2=br2['nash_conv'], 
+        expl2=br1['best_response_value'], 
+        expl1=br2['best_response_value'], 
+        expl=(br1['best_response_value'] + br2['best_response_value']) / 2, 
+        on_policy_value1=br1['on_policy_value'], 
+        on_policy_value2=br2['on_policy_value'], 
+      ))
+
+    if latest:
+      joint_policy = build_latest_joint_policy(latest_configs, env)
+      br1 = exploitability.best_response(env.game, joint_policy, 0)
+      br2 = exploitability.best_response(env.game, joint_policy, 1)
+      nash_conv.update(dict(
+        latest_nash_conv=(br1['nash_conv'] + br2['nash_conv']) / 2, 
+        latest_nash_conv1=br1['nash_conv'], 
+        latest_nash_conv2=br2['nash_conv'], 
+        latest_expl2=br1['best_response_value'], 
+        latest_expl1=br2['best_response_value'], 
+        latest_expl=(br1['best_response_value'] + br2['best_response_value']) / 2, 
+        latest_on_policy_value1=br1['on_policy_value'], 
+        latest_on_policy_value2=br2['on_policy_value'], 
+      ))
 
   if write_to_disk:
     root_dir = latest_configs[0].root_dir
@@ -259,6 +485,10 @@ if __name__ == '__main__':
   args = parse_eval_args()
 
   setup_logging(args.verbose)
+  if args.cfr is not None:
+    benchmark_cfr(args.cfr or ('kuhn_poker', 'leduc_poker'), 
+      n_iterations=args.cfr_iterations)
+    sys.exit()
   # load respective config
   if len(args.directory) == 1:
     configs = search_for_all_configs(args.directory[0])
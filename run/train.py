@@ -8,6 +8,7 @@ elif sys.platform == "darwin":
 # os.environ["XLA_FLAGS"] = ("--xla_cpu_multi_thread_eigen=false "
                # "intra_op_parallelism_threads=1")
 
+import time
 from datetime import datetime
 
 # try:
@@ -20,14 +21,18 @@ from datetime import datetime
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from tools.log import setup_logging, do_logging
+from core.elements.builder import ElementsBuilder
 from core.names import PATH_SPLIT
-from core.utils import configure_jax_gpu
+from core.utils import configure_jax_cache, configure_jax_gpu, get_jax_cache_dir
+from env.func import create_env
+from env.utils import divide_env_output
 from tools import pkg
 from tools.utils import modify_config
 from run.args import parse_train_args
 from run.grid_search import GridSearch
 from run.utils import *
 from tools.timer import get_current_datetime
+from tools import yaml_op
 
 
 def _get_algo_name(algo):
@@ -197,10 +202,70 @@ def setup_configs(cmd_args, algo_env_config):
   return configs
 
 
+def _count_files(directory):
+  return sum(len(files) for _, _, files in os.walk(directory))
+
+
+def warmup(configs, cache_dir=None):
+  """ Compiles jit_action and jit_train of every agent, reporting 
+  the time of a cold start, i.e., with an empty compilation cache, 
+  and that of a warm start """
+  n_entries = _count_files(cache_dir) if cache_dir else 0
+  start = time.time()
+  env = create_env(configs[0].env, no_remote=True)
+  env_stats = env.stats()
+  agent_env_outs = divide_env_output(env.output())
+  compile_time = 0
+  for aid, config in enumerate(configs):
+    builder = ElementsBuilder(config, env_stats)
+    elements = builder.build_acting_strategy_from_scratch(
+      config, env_stats=env_stats, build_monitor=False)
+    trainer = builder.build_trainer(elements.model, config, env_stats)
+    # the first call compiles jit_action for the input of runners
+    action_start = time.time()
+    elements.strategy(agent_env_outs[aid], evaluation=False)
+    compile_time += time.time() - action_start
+    if elements.model.jit_action.buckets:
+      compile_time += elements.model.jit_action.warmup()
+    compile_time += trainer.warmup()
+  env.close()
+  duration = time.time() - start
+
+  if not cache_dir:
+    do_logging(f'Warmup takes {duration:.3g}s, '
+      f'of which compilation takes {compile_time:.3g}s', color='cyan')
+    return
+  start_type = 'warm' if n_entries > 0 else 'cold'
+  record_path = os.path.join(cache_dir, 'warmup.yaml')
+  record = yaml_op.load(record_path)
+  record[start_type] = dict(total=duration, compile=compile_time)
+  yaml_op.dump(record_path, **record)
+  do_logging(f'{start_type.capitalize()} start: {duration:.3g}s in total, '
+    f'{compile_time:.3g}s for compilation, '
+    f'{_count_files(cache_dir) - n_entries} new cache entries', color='cyan')
+  if 'cold' in record and 'warm' in record:
+    do_logging(f'Compilation time of a cold start: {record["cold"]["compile"]:.3g}s, '
+      f'a warm start: {record["warm"]["compile"]:.3g}s', color='cyan')
+
+
+def _configure_jax_cache(cmd_args, config):
+  if cmd_args.no_jax_cache:
+    return None
+  if cmd_args.warmup:
+    # warmup caches every computation, however fast to compile or small
+    return configure_jax_cache(
+      get_jax_cache_dir(config), min_compile_time=0, min_entry_size=0)
+  return configure_jax_cache(get_jax_cache_dir(config))
+
+
 def _run_with_configs(cmd_args):
   algo_env_config = _get_algo_env_config(cmd_args)
 
   configs = setup_configs(cmd_args, algo_env_config)
+  cache_dir = _configure_jax_cache(cmd_args, configs[0])
+  if cmd_args.warmup:
+    warmup(configs, cache_dir)
+    return
 
   main = pkg.import_main(
     cmd_args.train_entry, cmd_args.algorithms[0], 
@@ -225,6 +290,10 @@ if __name__ == '__main__':
   processes = []
   if cmd_args.directory != '':
     configs = [search_for_config(d) for d in cmd_args.directory]
+    cache_dir = _configure_jax_cache(cmd_args, configs[0])
+    if cmd_args.warmup:
+      warmup(configs, cache_dir)
+      sys.exit()
     main = pkg.import_main(cmd_args.train_entry, config=configs[0])
     main(configs)
   else:
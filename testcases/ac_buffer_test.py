@@ -0,0 +1,119 @@
+import collections
+import time
+import numpy as np
+import jax
+import ray
+
+from core.ckpt.flat import FlatPacker
+from core.typing import AttrDict, dict2AttrDict
+from replay.ac import ACBuffer
+from tools.utils import batch_dicts
+
+
+env_stats = dict2AttrDict(dict(obs_keys=[['obs']], use_action_mask=False))
+
+
+def _buffer(n_runners, n_envs, n_steps, max_size=None):
+  config = dict2AttrDict(dict(
+    n_runners=n_runners, n_envs=n_envs, n_steps=n_steps,
+    sample_keys=['obs', 'action', 'reward', 'value', 'prev_info'],
+  ))
+  if max_size is not None:
+    config.max_size = max_size
+  return ACBuffer(config, env_stats, None)
+
+
+def _rollout(n_envs, n_steps, obs_dim=16):
+  data = AttrDict()
+  data.obs = np.random.randn(n_envs, n_steps, obs_dim).astype(np.float32)
+  data.next_obs = np.random.randn(n_envs, n_steps, obs_dim).astype(np.float32)
+  data.action = AttrDict()
+  data.action.action = np.random.randint(5, size=(n_envs, n_steps))
+  data.reward = np.random.randn(n_envs, n_steps).astype(np.float32)
+  data.value = np.random.randn(n_envs, n_steps+1).astype(np.float32)
+  data.prev_info_logits = np.random.randn(n_envs, n_steps, 5).astype(np.float32)
+  data.raw_reward = data.reward.copy()
+  return data
+
+
+def merge_ref(rollouts, sample_keys, batch_size):
+  """ The original key by key concatenation """
+  buffers = collections.defaultdict(list)
+  for data in rollouts:
+    for k, v in data.items():
+      buffers[k].append(v)
+  data = AttrDict()
+  for k in sample_keys:
+    if k == 'action':
+      v = batch_dicts(buffers[k], np.concatenate)
+      data[k] = jax.tree_util.tree_map(lambda x: x[-batch_size:], v)
+    elif k == 'prev_info':
+      for kk in list(buffers):
+        if k in kk:
+          v = np.concatenate(buffers[kk])
+          data[kk] = v[-batch_size:]
+    elif k in buffers:
+      data[k] = np.concatenate(buffers[k])[-batch_size:]
+  return data
+
+
+def _assert_tree_equal(x, y):
+  assert set(x) == set(y), (set(x), set(y))
+  for k in x:
+    jax.tree_util.tree_map(np.testing.assert_array_equal, x[k], y[k])
+
+
+class TestClass:
+  def test_merge_data(self):
+    # the last case overfills the batch and keeps the latest rows
+    for n_runners, n_envs, n_steps, max_size in [
+        (4, 3, 10, None), (3, 4, 10, 100)]:
+      for flat in [False, True]:
+        buffer = _buffer(n_runners, n_envs, n_steps, max_size)
+        packer = FlatPacker()
+        for _ in range(2):
+          rollouts = [_rollout(n_envs, n_steps) for _ in range(n_runners)]
+          for rid, data in enumerate(rollouts):
+            assert not buffer.ready()
+            buffer.merge_data(
+              rid, packer.pack(data) if flat else data, n_envs * n_steps)
+          assert buffer.ready()
+          expected = merge_ref(rollouts, buffer.sample_keys, buffer.batch_size)
+          _assert_tree_equal(buffer.sample(), expected)
+
+
+def benchmark():
+  """ Times receiving rollouts, run by python -m testcases.ac_buffer_test """
+  ray.init(num_cpus=1, include_dashboard=False, log_to_driver=False)
+  try:
+    n_runners, n_envs, n_steps = 16, 8, 200
+    buffer = _buffer(n_runners, n_envs, n_steps)
+    rollouts = [_rollout(n_envs, n_steps, obs_dim=64) for _ in range(n_runners)]
+    packer = FlatPacker()
+    dict_ids = [ray.put(r) for r in rollouts]
+    flat_ids = [ray.put(packer.pack(r)) for r in rollouts]
+
+    start = time.time()
+    data = [ray.get(i) for i in dict_ids]
+    merge_ref(data, buffer.sample_keys, buffer.batch_size)
+    ref_time = time.time() - start
+
+    start = time.time()
+    for rid, i in enumerate(flat_ids):
+      buffer.merge_data(rid, ray.get(i), n_envs * n_steps)
+    buffer.sample()
+    flat_time = time.time() - start
+
+    start = time.time()
+    for r in rollouts:
+      packer.pack(r)
+    pack_time = (time.time() - start) / n_runners
+    print(f'Receiving {n_runners} rollouts: key by key concatenation '
+      f'{ref_time*1000:.3g}ms, flat {flat_time*1000:.3g}ms, '
+      f'packing {pack_time*1000:.3g}ms per rollout')
+  finally:
+    ray.shutdown()
+
+
+if __name__ == '__main__':
+  benchmark()
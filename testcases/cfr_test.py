@@ -0,0 +1,88 @@
+import numpy as np
+
+from game.cfr import CFRSolver, GameTree, aggregate_policies, \
+  compute_exploitability, compute_nash_conv
+from game.kuhn_poker import KuhnPoker
+
+
+def _build_tree():
+  return GameTree.from_game(KuhnPoker())
+
+
+class TestClass:
+  def test_game_tree(self):
+    tree = _build_tree()
+    assert tree.n_nodes == 58, tree.n_nodes
+    assert tree.n_infosets == 12, tree.n_infosets
+    policy = tree.uniform_policy()
+    # the NashConv of the uniform policy reported by OpenSpiel
+    np.testing.assert_allclose(compute_nash_conv(tree, policy), 0.916666666666667)
+    values = tree.compute_values(tree.edge_weights(policy))[0]
+    np.testing.assert_allclose(values, [0.125, -0.125])
+
+  def test_convergence(self):
+    tree = _build_tree()
+    expl = {}
+    for algo, n_iterations, tol in [
+        ('cfr', 1000, 2e-3), ('cfr+', 1000, 2e-4), ('mccfr', 4000, 5e-2)]:
+      solver = CFRSolver(tree, algo, seed=0)
+      solver.iterate(n_iterations)
+      policy = solver.average_policy()
+      expl[algo] = compute_exploitability(tree, policy)
+      assert expl[algo] < tol, (algo, expl[algo])
+      value = tree.compute_values(tree.edge_weights(policy))[0, 0]
+      # the game value of Kuhn poker for the first player
+      np.testing.assert_allclose(value, -1 / 18, atol=10 * tol)
+    assert expl['cfr+'] < expl['cfr'], expl
+
+  def test_chance_sampling(self):
+    tree = _build_tree()
+    rng = np.random.default_rng(0)
+    levels, _ = tree._sample_levels(rng)
+    # only the subtree of one of the six deals is traversed
+    assert [l.size for l in levels] == [1, 1, 1, 2, 4, 2]
+    policy = rng.dirichlet(np.ones(tree.n_actions), size=tree.n_infosets)
+    regrets, _, values = tree.compute_updates(policy, 0)
+    n = 2000
+    sampled = [tree.compute_updates(policy, 0, rng) for _ in range(n)]
+    # sampled regrets and values are unbiased
+    np.testing.assert_allclose(
+      sum(r for r, _, _ in sampled) / n, regrets, atol=.03)
+    np.testing.assert_allclose(
+      sum(v for _, _, v in sampled) / n, values, atol=.03)
+
+  def test_multiprocessing(self):
+    tree = _build_tree()
+    subtrees = tree.split(2)
+    assert len(subtrees) == 2
+    # every decision node is in exactly one subtree
+    assert sum(np.sum(t.player >= 0) for t in subtrees) == np.sum(tree.player >= 0)
+    for algo in ['cfr', 'cfr+']:
+      serial = CFRSolver(tree, algo)
+      serial.iterate(50)
+      parallel = CFRSolver(tree, algo, n_workers=3)
+      parallel.iterate(50)
+      parallel.close()
+      np.testing.assert_allclose(parallel.regrets, serial.regrets, atol=1e-10)
+      np.testing.assert_allclose(
+        parallel.average_policy(), serial.average_policy(), atol=1e-10)
+
+  def test_aggregate_policies(self):
+    tree = _build_tree()
+    rng = np.random.default_rng(0)
+    policies = [
+      [rng.dirichlet(np.ones(tree.n_actions), size=tree.n_infosets) for _ in range(3)]
+      for _ in range(tree.n_players)
+    ]
+    probs = [rng.dirichlet(np.ones(3)) for _ in range(tree.n_players)]
+    mixed = aggregate_policies(tree, policies, probs)
+    # the behavior policy realizes the values of the mixed strategies
+    def value(pi0, pi1):
+      policy = np.where(tree.infoset_player[:, None] == 0, pi0, pi1)
+      return tree.compute_values(tree.edge_weights(policy))[0]
+    expected = sum(
+      probs[0][i] * probs[1][j] * value(pi0, pi1)
+      for i, pi0 in enumerate(policies[0])
+      for j, pi1 in enumerate(policies[1])
+    )
+    np.testing.assert_allclose(value(mixed, mixed), expected)
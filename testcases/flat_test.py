@@ -0,0 +1,167 @@
+import os
+import time
+import cloudpickle
+import numpy as np
+import jax
+import jax.numpy as jnp
+import optax
+import ray
+
+from core.ckpt.flat import ALIGNMENT, FlatLayout, FlatPacker, FlatParams, \
+  restore_flat, save_flat
+from core.ckpt.pickle import restore_params, save_params
+from core.ckpt.writer import JOURNAL, STAGED_SUFFIX, AsyncCheckpointer
+from core.typing import AttrDict, ModelPath
+from tools import yaml_op
+
+
+def _params(n_layers=4, size=64):
+  params = {}
+  for i in range(n_layers):
+    params[f'layer{i}'] = {
+      'w': np.random.randn(size, size).astype(np.float32),
+      'b': np.random.randn(size).astype(np.float32),
+    }
+  params['step'] = np.array(3, np.int64)
+  params['mask'] = np.array([True, False, True])
+  params['half'] = jnp.ones((3, 5), jnp.bfloat16)
+  return params
+
+
+def _assert_tree_equal(x, y):
+  jax.tree_util.tree_map(
+    lambda a, b: np.testing.assert_array_equal(a, b), x, y)
+
+
+class TestClass:
+  def test_flat_params(self):
+    params = _params()
+    packer = FlatPacker()
+    flat = packer.pack(params)
+    assert flat.buffer.dtype == np.uint8 and flat.buffer.ndim == 1
+    assert all(o % ALIGNMENT == 0 for o in flat.layout.offsets)
+    restored = flat.unpack()
+    _assert_tree_equal(restored, params)
+    leaves = jax.tree_util.tree_leaves(restored)
+    for x in leaves:
+      assert np.shares_memory(x, flat.buffer)
+
+    # the layout is reused for new versions of the same structure
+    params2 = jax.tree_util.tree_map(np.zeros_like, params)
+    flat2 = packer.pack(params2)
+    assert flat2.layout is flat.layout
+    _assert_tree_equal(flat2.unpack(), params2)
+    params2['extra'] = np.zeros(2)
+    assert packer.pack(params2).layout is not flat.layout
+
+  def test_flat_params_ray(self):
+    ray.init(num_cpus=1, include_dashboard=False, log_to_driver=False)
+    try:
+      params = _params(n_layers=8, size=512)
+      flat = FlatPacker().pack(params)
+      mid = ray.put(flat)
+      restored = ray.get(mid)
+      assert isinstance(restored, FlatParams)
+      _assert_tree_equal(restored.unpack(), params)
+      # arrays are read from the object store without copying
+      assert not restored.buffer.flags.writeable
+
+      nested = jax.tree_util.tree_map(jnp.asarray, params)
+      for name, x in [('nested', nested), ('flat', flat)]:
+        start = time.time()
+        for _ in range(10):
+          mid = ray.put(x)
+        put_time = (time.time() - start) / 10
+        start = time.time()
+        for _ in range(10):
+          y = ray.get(mid)
+          if name == 'flat':
+            y = y.unpack()
+        get_time = (time.time() - start) / 10
+        print(f'{name} weights of {flat.nbytes / 2**20:.3g}MB: '
+          f'put {put_time*1000:.3g}ms, get {get_time*1000:.3g}ms')
+    finally:
+      ray.shutdown()
+
+  def test_flat_checkpoint(self, tmp_path):
+    params = _params()
+    params['info'] = AttrDict(status='training', train_step=10, score=.5, aux=None)
+    params['layers'] = [np.ones(3), (np.zeros(2), 1)]
+    path = os.path.join(tmp_path, 'ckpt', 'model.flat')
+    save_flat(params, path)
+    assert os.listdir(os.path.dirname(path)) == ['model.flat']
+    restored = restore_flat(path)
+    assert list(restored) == list(params)
+    assert isinstance(restored['info'], AttrDict)
+    assert restored['info'] == params['info']
+    assert isinstance(restored['layers'][1], tuple)
+    _assert_tree_equal(restored, params)
+    assert restored['half'].dtype == jnp.bfloat16
+    # arrays are read-only views into the memory-mapped file
+    assert not restored['layer0']['w'].flags.writeable
+    assert restore_flat(path, use_mmap=False)['layer0']['w'].flags.writeable
+
+    # optimizer states fall back to a pickled treedef
+    opt = optax.adam(1e-3)
+    state = opt.init(jax.tree_util.tree_map(jnp.asarray, _params(1)))
+    save_flat(state, path)
+    restored = restore_flat(path)
+    assert jax.tree_util.tree_structure(restored) == jax.tree_util.tree_structure(state)
+    _assert_tree_equal(restored, state)
+
+  def test_restore_params(self, tmp_path):
+    model_path = ModelPath(str(tmp_path), 'a0')
+    model = {'policy': _params(1), 'value': _params(1)}
+    save_params(model, model_path, 'params/model', to_print=False)
+    save_params({'ancillary': {'mean': np.zeros(3)}}, model_path, 'params', to_print=False)
+    # saving other keys keeps previously saved ones
+    save_params({'train_step': 5}, model_path, 'params', to_print=False)
+    # legacy pickles are restored unless a flat checkpoint covers them
+    legacy_dir = os.path.join(tmp_path, 'a0', 'params', 'opt')
+    os.makedirs(legacy_dir)
+    with open(os.path.join(legacy_dir, 'policy.pkl'), 'wb') as f:
+      cloudpickle.dump({'mu': np.ones(2)}, f)
+    stale_dir = os.path.join(tmp_path, 'a0', 'params', 'model')
+    os.makedirs(stale_dir)
+    with open(os.path.join(stale_dir, 'policy.pkl'), 'wb') as f:
+      cloudpickle.dump({'stale': np.ones(2)}, f)
+
+    params = restore_params(model_path, 'params', to_print=False)
+    assert set(params) == {'model', 'opt', 'ancillary', 'train_step'}
+    _assert_tree_equal(params['model'], model)
+    np.testing.assert_array_equal(params['opt']['policy']['mu'], np.ones(2))
+    assert params['train_step'] == 5
+    params = restore_params(model_path, 'params', 'ancillary', to_print=False)
+    assert list(params) == ['ancillary']
+    params = restore_params(model_path, 'params/model', ['policy'], to_print=False)
+    _assert_tree_equal(params, {'policy': model['policy']})
+
+  def test_async_checkpointer(self, tmp_path):
+    model_path = ModelPath(str(tmp_path), 'a0')
+    model_dir = os.path.join(*model_path)
+    checkpointer = AsyncCheckpointer()
+    params = {'policy': _params(2, size=256)}
+    anc = {'ancillary': np.zeros(3)}
+    with checkpointer.save():
+      save_params(params, model_path, 'params/model', to_print=False)
+      save_params(anc, model_path, 'params', to_print=False)
+      save_params({'train_step': 1}, model_path, 'params', to_print=False)
+    # params are snapshot, so they can be updated during the write
+    w = params['policy']['layer0']['w'].copy()
+    params['policy']['layer0']['w'] += 1
+    checkpointer.wait()
+    restored = restore_params(model_path, 'params', to_print=False)
+    np.testing.assert_array_equal(restored['model']['policy']['layer0']['w'], w)
+    assert restored['train_step'] == 1 and 'ancillary' in restored
+    assert yaml_op.load(os.path.join(model_dir, JOURNAL))['complete']
+    assert not any(f.endswith(STAGED_SUFFIX) for _, _, fs in os.walk(model_dir) for f in fs)
+
+    # a checkpoint interrupted while renaming staged files is completed on restore
+    save_params({'train_step': 2}, model_path, 'params/model', to_print=False)
+    path = os.path.join(model_dir, 'params', 'model.flat')
+    os.replace(path, f'{path}{STAGED_SUFFIX}')
+    yaml_op.dump(os.path.join(model_dir, JOURNAL),
+      complete=False, files=['params/model.flat'])
+    restored = restore_params(model_path, 'params/model', to_print=False)
+    assert restored['train_step'] == 2
+    assert yaml_op.load(os.path.join(model_dir, JOURNAL))['complete']
@@ -0,0 +1,108 @@
+import time
+import numpy as np
+
+from replay.tb import compute_gae, compute_episodic_gae
+
+
+gamma = .99
+lam = .95
+gae_discount = gamma * lam
+
+
+def compute_gae_ref(
+  reward,
+  discount,
+  value,
+  gamma,
+  gae_discount,
+  next_value=None,
+  reset=None,
+):
+  """ The original per-timestep implementation """
+  if next_value is None:
+    value, next_value = value[:-1], value[1:]
+  elif next_value.ndim < value.ndim:
+    next_value = np.expand_dims(next_value, 1)
+    next_value = np.concatenate([value[1:], next_value], 0)
+
+  delta = (reward + discount * gamma * next_value - value).astype(np.float32)
+  discount = (discount if reset is None else (1 - reset)) * gae_discount
+
+  next_adv = 0
+  advs = np.zeros_like(reward, dtype=np.float32)
+  for i in reversed(range(advs.shape[0])):
+    advs[i] = next_adv = (delta[i] + discount[i] * next_adv)
+  traj_ret = advs + value
+
+  return advs, traj_ret
+
+
+def _episode(epslen):
+  discount = np.ones((epslen, 1), np.float32)
+  discount[-1] = 0
+  return dict(
+    reward=np.random.randn(epslen, 1).astype(np.float32),
+    value=np.random.randn(epslen, 1).astype(np.float32),
+    discount=discount,
+  )
+
+
+def _time(fn, n=5):
+  fn()
+  start = time.time()
+  for _ in range(n):
+    fn()
+  return (time.time() - start) / n
+
+
+class TestClass:
+  def test_gae_equality(self):
+    for dtype in [np.float32, np.float64]:
+      shape = (100, 8, 3)
+      reward = np.random.randn(*shape).astype(np.float32)
+      value = np.random.randn(*shape).astype(np.float32)
+      next_value = np.random.randn(*shape).astype(np.float32)
+      discount = np.random.binomial(1, .9, shape).astype(dtype)
+      reset = np.random.binomial(1, .1, shape).astype(dtype)
+      expected = compute_gae_ref(
+        reward, discount, value, gamma, gae_discount,
+        next_value=next_value, reset=reset)
+      for use_numba in [False, True]:
+        result = compute_gae(
+          reward, discount, value, gamma, gae_discount,
+          next_value=next_value, reset=reset, use_numba=use_numba)
+        np.testing.assert_array_equal(result, expected)
+
+  def test_episodic_gae_equality(self):
+    episodes = [_episode(n) for n in np.random.randint(1, 50, size=20)]
+    for use_numba in [False, True]:
+      advs, traj_ret = compute_episodic_gae(
+        episodes, gamma, gae_discount, use_numba=use_numba)
+      for eps, adv, ret in zip(episodes, advs, traj_ret):
+        expected = compute_gae_ref(
+          eps['reward'], eps['discount'], eps['value'],
+          gamma, gae_discount, next_value=np.array([0], np.float32))
+        np.testing.assert_array_equal(adv, expected[0])
+        np.testing.assert_array_equal(ret, expected[1])
+
+
+def benchmark():
+  """ Times per-episode and batched GAE, run by python -m testcases.gae_test """
+  for n_steps, n_envs, n_units in [(200, 8, 1), (400, 32, 2), (1000, 64, 5)]:
+    # episodes of one unit in one env each, as collected by TurnBasedLocalBuffer
+    episodes = [_episode(n_steps) for _ in range(n_envs * n_units)]
+    ref_time = _time(lambda: [compute_gae_ref(
+      eps['reward'], eps['discount'], eps['value'], gamma, gae_discount,
+      next_value=np.array([0], np.float32)) for eps in episodes])
+    np_time = _time(lambda: compute_episodic_gae(
+      episodes, gamma, gae_discount))
+    nb_time = _time(lambda: compute_episodic_gae(
+      episodes, gamma, gae_discount, use_numba=True))
+    print(f'GAE(n_steps={n_steps}, n_envs={n_envs}, n_units={n_units}): '
+      f'per episode {ref_time*1000:.3g}ms, '
+      f'batched {np_time*1000:.3g}ms, '
+      f'batched numba {nb_time*1000:.3g}ms')
+
+
+if __name__ == '__main__':
+  benchmark()
@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 
 from game.alpharank import AlphaRank
@@ -111,3 +112,48 @@ class TestClass:
     rank, mass = alpha_rank.compute_rank(payoffs, True, True)
     p2 = flow[rank]
     # np.testing.assert_equal(p2, np.sort(flow)[::-1])
+
+  def test_alpha_rank_transition_matrix(self):
+    alpha_rank = AlphaRank(10, 5)
+    ns = (3, 4, 2)
+    rng = np.random.default_rng(0)
+    payoffs = [rng.normal(size=ns) for _ in ns]
+    profiles = list(itertools.product(*[range(n) for n in ns]))
+    eta = 1 / sum(n - 1 for n in ns)
+    ref = np.zeros((len(profiles), len(profiles)))
+    for i, row in enumerate(profiles):
+      for j, col in enumerate(profiles):
+        diff = [k for k in range(len(ns)) if row[k] != col[k]]
+        if len(diff) == 1:
+          k = diff[0]
+          ref[i, j] = alpha_rank._compute_transition_probability(
+            payoffs[k][col] - payoffs[k][row], eta)
+      ref[i, i] = 1 - ref[i].sum()
+    transition = alpha_rank.compute_transition_matrix(payoffs)
+    np.testing.assert_allclose(transition, ref)
+    sparse_transition = alpha_rank.compute_transition_matrix(payoffs, to_sparse=True)
+    assert sparse_transition.nnz == len(profiles) * (sum(ns) - len(ns) + 1)
+
+    # the sparse solvers agree with the dense one
+    pi = alpha_rank.compute_stationary_distribution(payoffs)
+    sparse_rank = AlphaRank(10, 5, max_dense_size=0)
+    np.testing.assert_allclose(
+      sparse_rank.compute_stationary_distribution(payoffs), pi, atol=1e-8)
+    # power iteration stops once the residual is within tol
+    power_pi = sparse_rank._power_iteration(sparse_transition.T.tocsr())
+    assert np.abs(power_pi @ ref - power_pi).sum() < sparse_rank.tol
+    np.testing.assert_allclose(power_pi, pi, atol=1e-6)
+
+  def test_alpha_rank_warm_start(self):
+    n = 500
+    rng = np.random.default_rng(0)
+    payoff = rng.normal(size=(n + 20, n + 20))
+    payoff = payoff - payoff.T
+    alpha_rank = AlphaRank(1000, 5, 0)
+    alpha_rank.compute_rank([payoff[:n, :n]], True, True)
+    # strategies are added incrementally
+    rank, mass = alpha_rank.compute_rank([payoff], True, True)
+    np.testing.assert_allclose(np.sum(mass), 1)
+    pi = AlphaRank(1000, 5, 0, max_dense_size=np.inf).compute_stationary_distribution(
+      [payoff], True)
+    np.testing.assert_allclose(mass, pi[rank], atol=1e-8)
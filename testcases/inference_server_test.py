@@ -0,0 +1,131 @@
+import threading
+import time
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from core.typing import AttrDict
+from distributed.common.remote.inference_server import InferenceBatcher, \
+  InferenceServer
+from env.func import create_env
+from tools.yaml_op import load_config
+
+
+def _make_action():
+  n_traces = []
+  def raw_action(w, data):
+    n_traces.append(data.obs.shape[0])
+    action = jnp.argmax(data.obs @ w, -1)
+    # bias is not batched, though its size equals a bucket size
+    stats = AttrDict(value=jnp.sum(data.obs, -1), scale=jnp.float32(2),
+      bias=jnp.sum(w, -1))
+    state = data.state + 1
+    return action, stats, state
+  return jax.jit(raw_action), n_traces
+
+
+OUT_AXES = (0, AttrDict(value=0, scale=None, bias=None), 0)
+
+
+def _data(n, obs_dim=4):
+  data = AttrDict()
+  data.obs = np.random.randn(n, 3, obs_dim).astype(np.float32)
+  data.state = np.random.randn(n, 8).astype(np.float32)
+  return data
+
+
+class TestClass:
+  def test_inference_batcher(self):
+    w = np.random.randn(4, 5).astype(np.float32)
+    action_fn, n_traces = _make_action()
+    keys = []
+    def fn(key, data):
+      keys.append(key)
+      return action_fn(w, data)
+
+    batcher = InferenceBatcher(
+      fn, max_batch_size=16, max_latency=.05, out_axes=OUT_AXES)
+    assert batcher.buckets == [1, 2, 4, 8, 16]
+    assert batcher.bucket(5) == 8 and batcher.bucket(40) == 48
+
+    sizes = [3, 1, 2, 5, 2, 4]
+    inputs = [_data(n) for n in sizes]
+    results = [None] * len(sizes)
+    def infer(i):
+      results[i] = batcher(i % 2, inputs[i])
+    threads = [threading.Thread(target=infer, args=(i,)) for i in range(len(sizes))]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    # requests are batched by key and padded to buckets
+    assert set(keys) == {0, 1}
+    assert len(keys) < len(sizes)
+    assert all(n in batcher.buckets for n in n_traces), n_traces
+
+    for data, (action, stats, state) in zip(inputs, results):
+      expected = action_fn(w, data)
+      np.testing.assert_array_equal(action, expected[0])
+      np.testing.assert_allclose(stats.value, expected[1].value)
+      np.testing.assert_allclose(state, expected[2])
+      assert stats.scale == 2
+      np.testing.assert_allclose(stats.bias, np.sum(w, -1), rtol=1e-5)
+    stats = batcher.get_stats()
+    assert stats['infer/n_requests'] > 1
+
+  def test_inference_batcher_latency(self):
+    w = np.random.randn(4, 5).astype(np.float32)
+    action_fn, _ = _make_action()
+    max_latency = .02
+    batcher = InferenceBatcher(
+      lambda key, data: action_fn(w, data), max_batch_size=64,
+      max_latency=max_latency, buckets=[8, 64], out_axes=lambda key: OUT_AXES)
+    batcher(0, _data(2))
+    # a lone request is dispatched after the deadline
+    start = time.time()
+    batcher(0, _data(2))
+    elapsed = time.time() - start
+    assert max_latency <= elapsed < max_latency + .1, elapsed
+    # a full batch is dispatched right away
+    batcher(0, _data(64))
+    start = time.time()
+    batcher(0, _data(64))
+    assert time.time() - start < max_latency, time.time() - start
+
+  def test_inference_server_ppo(self):
+    config = load_config('algo/ppo/configs/rand')
+    config.env.n_runners = 1
+    config.env.n_envs = 1
+    config.model.policy.rnn_type = None
+    config.model.value.rnn_type = None
+    config.model.print_params = False
+    config.runner = AttrDict(inference_server=AttrDict(max_latency=.01))
+    config.self_play = False
+    env_stats = create_env(config.env, no_remote=True).stats()
+    server = InferenceServer(config.asdict(), env_stats)
+    model = server.models[0]
+    # params are cached by the object refs of weights
+    server._params[0]['mid'] = model.params
+
+    n_units = len(env_stats.aid2uids[0])
+    obs_shape = env_stats.obs_shape[0].obs
+    inputs = [np.random.randn(n, n_units, *obs_shape).astype(np.float32)
+      for n in [2, 3]]
+    results = [None] * len(inputs)
+    def infer(i):
+      # runners send no global_state, which PPO fills in with obs
+      results[i] = server.infer(0, ['mid'], AttrDict(obs=inputs[i]))
+    threads = [threading.Thread(target=infer, args=(i,)) 
+      for i in range(len(inputs))]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+    for obs, (action, stats, state) in zip(inputs, results):
+      expected = model.action(AttrDict(obs=obs), False)
+      assert state is None
+      assert set(action) == set(expected[0])
+      for k, v in action.items():
+        assert v.shape == expected[0][k].shape, k
+      # sampled actions differ, but their distributions and values match
+      assert set(stats) == set(expected[1])
+      for k, v in expected[1].items():
+        if k != 'mu_logprob':
+          np.testing.assert_allclose(stats[k], v, rtol=1e-5, atol=1e-6, err_msg=k)
@@ -0,0 +1,129 @@
+import time
+import functools
+import numpy as np
+import jax
+
+from jax_tools.jax_loss import SCAN_METHODS, gae, v_trace_from_ratio, retrace
+
+
+def _data(bs, seqlen, n_actions=None):
+  shape = (bs, seqlen)
+  data = dict(
+    reward=np.random.randn(*shape).astype(np.float32),
+    value=np.random.randn(*shape).astype(np.float32),
+    next_value=np.random.randn(*shape).astype(np.float32),
+    ratio=np.random.uniform(.5, 1.5, shape).astype(np.float32),
+    discount=np.random.binomial(1, .95, shape).astype(np.float32),
+  )
+  if n_actions:
+    next_qs = np.random.randn(*shape, n_actions).astype(np.float32)
+    next_pi = np.random.dirichlet(np.ones(n_actions), shape).astype(np.float32)
+    data.update(next_qs=next_qs, next_pi=next_pi)
+  return data
+
+
+def _gae(data, scan_method):
+  return gae(
+    reward=data['reward'],
+    value=data['value'],
+    next_value=data['next_value'],
+    discount=data['discount'],
+    gamma=.99,
+    lam=.95,
+    axis=1,
+    scan_method=scan_method
+  )
+
+
+def _v_trace(data, scan_method):
+  return v_trace_from_ratio(
+    reward=data['reward'],
+    value=data['value'],
+    next_value=data['next_value'],
+    ratio=data['ratio'],
+    discount=data['discount'],
+    gamma=.99,
+    lam=.95,
+    axis=1,
+    scan_method=scan_method
+  )
+
+
+def _retrace(data, scan_method):
+  return retrace(
+    reward=data['reward'],
+    q=data['value'],
+    next_qs=data['next_qs'],
+    next_pi=data['next_pi'],
+    ratio=data['ratio'],
+    discount=data['discount'],
+    gamma=.99,
+    lam=.95,
+    axis=1,
+    scan_method=scan_method
+  )
+
+
+class TestClass:
+  def test_gae(self):
+    data = _data(4, 50)
+    adv = np.zeros_like(data['reward'])
+    err = 0
+    delta = data['reward'] + .99 * data['discount'] * data['next_value'] - data['value']
+    for i in reversed(range(50)):
+      err = delta[:, i] + .99 * .95 * data['discount'][:, i] * err
+      adv[:, i] = err
+    for method in SCAN_METHODS:
+      vs, advs = _gae(data, method)
+      np.testing.assert_allclose(advs, adv, rtol=1e-4, atol=1e-4)
+      np.testing.assert_allclose(vs, adv + data['value'], rtol=1e-4, atol=1e-4)
+
+  def test_scan_methods(self):
+    data = _data(4, 50, n_actions=3)
+    for fn in [_gae, _v_trace, _retrace]:
+      expected = fn(data, 'loop')
+      for method in SCAN_METHODS:
+        np.testing.assert_allclose(
+          fn(data, method), expected, rtol=1e-4, atol=1e-4)
+
+  def test_retrace(self):
+    data = _data(4, 20, n_actions=3)
+    next_v = np.sum(data['next_qs'] * data['next_pi'], -1)
+    delta = data['reward'] + .99 * data['discount'] * next_v - data['value']
+    c = .95 * np.minimum(data['ratio'], 1)
+    target = np.zeros_like(delta)
+    err = 0
+    for i in reversed(range(20)):
+      if i < 19:
+        err = delta[:, i] + .99 * data['discount'][:, i] * c[:, i+1] * err
+      else:
+        err = delta[:, i]
+      target[:, i] = err + data['value'][:, i]
+    for method in SCAN_METHODS:
+      np.testing.assert_allclose(
+        _retrace(data, method), target, rtol=1e-4, atol=1e-4)
+
+
+def benchmark():
+  """ Times the scan methods, run by python -m testcases.jax_loss_test """
+  for seqlen in [32, 128, 400]:
+    data = _data(64, seqlen)
+    for method in SCAN_METHODS:
+      if method == 'loop' and seqlen > 128:
+        # compiling the unrolled loop takes minutes
+        continue
+      fn = jax.jit(functools.partial(_gae, scan_method=method))
+      start = time.time()
+      compiled = fn.lower(data).compile()
+      compile_time = time.time() - start
+      jax.block_until_ready(compiled(data))
+      start = time.time()
+      for _ in range(20):
+        jax.block_until_ready(compiled(data))
+      run_time = (time.time() - start) / 20
+      print(f'gae(seqlen={seqlen}, method={method}): '
+        f'compile {compile_time*1000:.3g}ms, run {run_time*1000:.3g}ms')
+
+
+if __name__ == '__main__':
+  benchmark()
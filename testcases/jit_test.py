@@ -0,0 +1,136 @@
+import gc
+import threading
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from core.jit import JitFunction, bucket_size, default_buckets, jit, pad
+from core.typing import AttrDict, dict2AttrDict
+from core.utils import config_hash
+
+
+def raw_action(params, rng, data, evaluation=False):
+  state = data.pop('state')
+  x = jnp.tanh(data.obs @ params.w)
+  if not evaluation:
+    x = x + jax.random.normal(rng, x.shape)
+  # norm is not batched, though its size may equal the padded batch size
+  stats = AttrDict(logprob=x.sum(-1), norm=jnp.sum(params.w, -1))
+  return x, stats, state + 1
+
+
+OUT_AXES = (0, AttrDict(logprob=0, norm=None), 0)
+
+
+def _data(n):
+  data = AttrDict()
+  data.obs = np.random.randn(n, 3, 4).astype(np.float32)
+  data.state = np.random.randn(n, 8).astype(np.float32)
+  return data
+
+
+class TestClass:
+  def test_buckets(self):
+    assert default_buckets(20) == [1, 2, 4, 8, 16, 20]
+    assert bucket_size(5, [4, 8]) == 8 and bucket_size(17, [4, 8]) == 24
+    x = np.arange(6).reshape(2, 3)
+    np.testing.assert_array_equal(pad(x, 4), [[0, 1, 2], [3, 4, 5], [3, 4, 5], [3, 4, 5]])
+    assert pad(jnp.asarray(x), 5, axis=1).shape == (2, 5)
+
+  def test_jit_function(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    f = jit(raw_action, name='test_action', config={'max_batch_size': 8},
+      static_argnames='evaluation', pad_argnames=('data',), out_axes=OUT_AXES)
+    assert f.buckets == [1, 2, 4, 8]
+    ref = jax.jit(raw_action, static_argnames='evaluation')
+    for n in [3, 4, 2, 11]:
+      data = _data(n)
+      out = f(params, rng, data.copy(), True)
+      expected = ref(params, rng, data.copy(), True)
+      jax.tree_util.tree_map(np.testing.assert_allclose, out, expected)
+    # 3 and 4 share a bucket, and 11 is padded to 16
+    assert f.n_traces == 3, f.n_traces
+    assert f.get_stats()['jit/test_action/compile_time'] > 0
+    assert JitFunction.all_stats()['jit/test_action/n_traces'] == 3
+
+  def test_instances(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    fs = [jit(raw_action, name='test_instances', static_argnames='evaluation')
+      for _ in range(2)]
+    fs[0](params, rng, _data(2), True)
+    fs[1](params, rng, _data(2), True)
+    # functions sharing a name report their total traces
+    assert JitFunction.all_stats()['jit/test_instances/n_traces'] == 2
+    del fs
+    gc.collect()
+    assert 'jit/test_instances/n_traces' not in JitFunction.all_stats()
+
+  def test_concurrent_traces(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    f = jit(raw_action, name='test_concurrent_traces', config={'buckets': [2, 4]},
+      static_argnames='evaluation', pad_argnames=('data',), out_axes=OUT_AXES)
+    f(params, rng, _data(2), True)
+    def call():
+      for _ in range(20):
+        f(params, rng, _data(1), True)
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    # calls of other threads are not mistaken for traces
+    assert f.n_traces == 1, f.n_traces
+    f(params, rng, _data(3), True)
+    assert f.n_traces == 2, f.n_traces
+
+  def test_set_buckets(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    f = jit(raw_action, name='test_set_buckets',
+      static_argnames='evaluation', pad_argnames=('data',), out_axes=OUT_AXES)
+    f(params, rng, _data(3), True)
+    f(params, rng, _data(4), True)
+    assert f.n_traces == 2, f.n_traces
+    # e.g., for the varying numbers of ready environments
+    f.set_buckets(default_buckets(8))
+    for n in [3, 4, 2]:
+      out = f(params, rng, _data(n), True)
+      assert out[0].shape[0] == out[1].logprob.shape[0] == n
+      assert out[1].norm.shape == (4,)
+    # 3 is padded to the traced size 4, and only 2 is traced anew
+    assert f.n_traces == 3, f.n_traces
+
+  def test_warmup(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    f = jit(raw_action, name='test_warmup', config={'buckets': [4, 16]},
+      static_argnames='evaluation', pad_argnames=('data',), out_axes=OUT_AXES)
+    f.warmup(params, rng, _data(1), evaluation=False)
+    assert f.n_traces == 2, f.n_traces
+    for n in [1, 3, 9, 16]:
+      f(params, rng, _data(n), False)
+    assert f.n_traces == 2, f.n_traces
+    # a new static value is traced again
+    f(params, rng, _data(2), True)
+    assert f.n_traces == 3, f.n_traces
+
+  def test_warmup_from_first_call(self):
+    params = AttrDict(w=jnp.ones((4, 5)))
+    rng = jax.random.PRNGKey(0)
+    f = jit(raw_action, name='test_first_call', config={'buckets': [2, 8]},
+      static_argnames='evaluation', pad_argnames=('data',), out_axes=OUT_AXES)
+    f(params, rng, _data(2), False)
+    f.warmup()
+    assert f.n_traces == 2, f.n_traces
+    f(params, rng, _data(7), False)
+    assert f.n_traces == 2, f.n_traces
+
+  def test_config_hash(self):
+    config = dict2AttrDict(dict(
+      root_dir='logs/a', seed=0, model=dict(units=[64, 64], seed=0)))
+    other = dict2AttrDict(dict(
+      root_dir='logs/b', seed=1, model=dict(units=[64, 64], seed=1)))
+    assert config_hash(config) == config_hash(other)
+    other.model.units = [32]
+    assert config_hash(config) != config_hash(other)
@@ -0,0 +1,43 @@
+import numpy as np
+
+from game.meta_solver import ALGORITHMS, MetaSolver, compute_nash_conv, compute_utilities
+from game.utils import compute_utility
+
+
+class TestClass:
+  def test_compute_utilities(self):
+    ns = (3, 4, 5)
+    payoffs = [np.random.normal(size=ns) for _ in ns]
+    strategies = [np.random.dirichlet(np.ones(n), size=2) for n in ns]
+    utilities = compute_utilities(payoffs, strategies)
+    for b in range(2):
+      sb = [s[b] for s in strategies]
+      for i, u in enumerate(utilities):
+        ref = compute_utility(payoffs[i], sb[:i], True)
+        ref = compute_utility(ref, sb[i+1:])
+        np.testing.assert_allclose(u[b], ref)
+    nash_conv = compute_nash_conv(payoffs, strategies)
+    assert nash_conv.shape == (2,) and np.all(nash_conv >= 0)
+
+  def test_convergence(self):
+    # biased rock-paper-scissors, whose Nash equilibrium is (1/5, 1/5, 3/5)
+    payoff = np.array([
+      [0, -3, 1],
+      [3, 0, -1],
+      [-1, 1, 0]
+    ], np.float64)
+    payoffs = [payoff, -payoff]
+    nash = np.array([1, 1, 3]) / 5
+    nash_convs = {}
+    for algo in ALGORITHMS:
+      for use_jax in [False, True]:
+        solver = MetaSolver(algo, n_iterations=2000, n_restarts=4, use_jax=use_jax, seed=0)
+        strategies, nash_conv = solver.compute_all(payoffs)
+        assert strategies[0].shape == (4, 3), strategies[0].shape
+        assert np.all(nash_conv < .06), (algo, use_jax, nash_conv)
+        for s in strategies:
+          np.testing.assert_allclose(s, np.tile(nash, (4, 1)), atol=.03)
+        nash_convs[algo, use_jax] = nash_conv
+      np.testing.assert_allclose(
+        nash_convs[algo, False], nash_convs[algo, True], rtol=1e-3, atol=1e-5)
+    assert np.all(nash_convs['rm+', False] < nash_convs['rm', False])
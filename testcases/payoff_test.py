@@ -0,0 +1,140 @@
+import tempfile
+import time
+import numpy as np
+
+from game.payoff import PayoffTable, SelfPlayPayoffTable
+
+
+def _random_results(sizes, m, n_scores=3):
+  sids = [tuple(np.random.randint(n) for n in sizes) for _ in range(m)]
+  scores = [np.random.randn(len(sizes), np.random.randint(1, n_scores+1)).tolist()
+    for _ in range(m)]
+  return sids, scores
+
+
+class TestClass:
+  def test_payoff_table(self, tmp_path):
+    np.random.seed(0)
+    for step_size in [None, .1]:
+      table = PayoffTable(3, step_size, str(tmp_path), name=f'payoff{step_size}')
+      ref = PayoffTable(3, step_size, str(tmp_path), name=f'ref{step_size}')
+      sizes = [0, 0, 0]
+      for _ in range(5):
+        for aid in np.random.randint(3, size=4):
+          table.expand(aid)
+          ref.expand(aid)
+          sizes[aid] += 1
+        table.expand_all([0, 1, 2])
+        ref.expand_all([0, 1, 2])
+        sizes = [n + 1 for n in sizes]
+        assert all(p.shape == tuple(sizes) for p in table.payoffs)
+
+        sids, scores = _random_results(sizes, 50)
+        if step_size:
+          # moving averages depend on the order of results for a profile
+          sids, idxes = np.unique(sids, axis=0, return_index=True)
+          sids, scores = [tuple(x) for x in sids], [scores[i] for i in idxes]
+        for sid, s in zip(sids, scores):
+          ref.update(sid, s)
+        table.update_many(
+          np.array(sids),
+          [[sum(x) for x in s] for s in scores],
+          [[len(x) for x in s] for s in scores])
+        for p, rp, c, rc in zip(table.payoffs, ref.payoffs, table.counts, ref.counts):
+          np.testing.assert_allclose(p, rp, rtol=1e-5, atol=1e-6)
+          np.testing.assert_array_equal(c, rc)
+
+      # the views into the buffers with spare capacity are saved
+      table.save(to_print=False)
+      restored = PayoffTable(3, step_size, str(tmp_path), name=f'payoff{step_size}')
+      for p, rp in zip(table.payoffs, restored.payoffs):
+        np.testing.assert_array_equal(p, rp)
+      restored.expand(0)
+      assert restored.payoffs[0].shape[0] == sizes[0] + 1
+
+  def test_self_play_payoff_table(self, tmp_path):
+    np.random.seed(0)
+    for step_size in [None, .1]:
+      table = SelfPlayPayoffTable(step_size, str(tmp_path), name=f'payoff{step_size}')
+      ref = SelfPlayPayoffTable(step_size, str(tmp_path), name=f'ref{step_size}')
+      n = 0
+      for _ in range(4):
+        for _ in range(3):
+          table.expand()
+          ref.expand()
+          n += 1
+        sids = np.random.randint(n, size=(40, 2))
+        if step_size:
+          sids = np.unique(np.sort(sids, -1), axis=0)
+        scores = [np.random.randn(np.random.randint(1, 4)).tolist() for _ in sids]
+        for sid, s in zip(sids, scores):
+          ref.update(tuple(sid), s)
+        table.update_many(sids, [sum(s) for s in scores], [len(s) for s in scores])
+        np.testing.assert_allclose(table.payoffs, ref.payoffs, rtol=1e-5, atol=1e-6)
+        np.testing.assert_array_equal(table.counts, ref.counts)
+
+  def test_moments(self, tmp_path):
+    table = PayoffTable(2, .1, str(tmp_path))
+    sp_table = SelfPlayPayoffTable(None, str(tmp_path), name='sp_payoff')
+    for _ in range(4):
+      table.expand_all([0, 1])
+      sp_table.expand()
+    scores = {}
+    for i in range(30):
+      sid = tuple(np.random.randint(4, size=2))
+      s = np.random.normal(sid[0] - sid[1], sid[0] + 1, size=np.random.randint(1, 5))
+      scores.setdefault(sid, []).extend(s)
+      if i % 2:
+        table.update(sid, [s.tolist(), (-s).tolist()])
+        sp_table.update(sid, s.tolist())
+      else:
+        m2 = np.sum((s - s.mean())**2)
+        table.update_many([sid, sid], [[s.sum(), -s.sum()], [0, 0]], [len(s), 0], [[m2, m2], [0, 0]])
+        sp_table.update_many([sid], [s.sum()], [len(s)], [m2])
+    variances = table.get_variances()
+    cis = table.get_confidence_intervals()
+    for sid, s in scores.items():
+      np.testing.assert_allclose(table.means[0][sid], np.mean(s))
+      np.testing.assert_allclose(table.means[1][sid], -np.mean(s))
+      if len(s) > 1:
+        np.testing.assert_allclose(variances[0][sid], np.var(s, ddof=1))
+        np.testing.assert_allclose(cis[1][sid], 1.96 * np.std(s, ddof=1) / np.sqrt(len(s)))
+      else:
+        assert np.isinf(cis[0][sid])
+
+    # self-play tables merge the results of (i, j) and (j, i)
+    sp_variances = sp_table.get_variances()
+    for i in range(4):
+      for j in range(i+1, 4):
+        s = scores.get((i, j), []) + [-x for x in scores.get((j, i), [])]
+        assert sp_table.counts[i, j] == sp_table.counts[j, i] == len(s)
+        if len(s) > 1:
+          np.testing.assert_allclose(sp_table.means[j, i], -np.mean(s))
+          np.testing.assert_allclose(sp_variances[j, i], np.var(s, ddof=1))
+
+
+def benchmark():
+  """ Times expanding and updating payoff tables, run by python -m testcases.payoff_test """
+  tmp_path = tempfile.mkdtemp()
+  n = 300
+  table = PayoffTable(2, None, str(tmp_path))
+  start = time.time()
+  for _ in range(n):
+    table.expand_all([0, 1])
+  expand_time = time.time() - start
+
+  sids, scores = _random_results([n, n], 10000, n_scores=1)
+  start = time.time()
+  for sid, s in zip(sids, scores):
+    table.update(sid, s)
+  update_time = time.time() - start
+  start = time.time()
+  table.update_many(np.array(sids), np.array(scores)[..., 0], 1)
+  update_many_time = time.time() - start
+  print(f'Adding {n} strategies: {expand_time*1000:.3g}ms; '
+    f'{len(sids)} updates: {update_time*1000:.3g}ms one by one, '
+    f'{update_many_time*1000:.3g}ms in a batch')
+
+
+if __name__ == '__main__':
+  benchmark()
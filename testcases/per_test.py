@@ -0,0 +1,46 @@
+import numpy as np
+
+from core.typing import dict2AttrDict
+from replay.per import ProportionalPER
+
+
+def _build_per(n_envs):
+  config = dict2AttrDict(dict(
+    n_runners=1, n_envs=n_envs, max_size=32, min_size=1, batch_size=4,
+    n_steps=1, max_steps=3, gamma=.5, sample_keys=['obs', 'reward', 'discount'],
+  ))
+  env_stats = dict2AttrDict(dict(obs_keys=[['obs']], use_action_mask=[False]))
+  return ProportionalPER(config, env_stats, None)
+
+
+def _transition(t, discount=1.):
+  return dict(
+    obs=np.full(2, t, np.float32), next_obs=np.full(2, t + 1, np.float32),
+    reward=np.float32(1), discount=np.float32(discount))
+
+
+class TestClass:
+  def test_n_step_transitions(self):
+    per = _build_per(1)
+    per.add(**_transition(0))
+    per.add(**_transition(1))
+    assert len(per) == 0, len(per)
+    per.add(**_transition(2, discount=0))
+    # the episode end flushes every pending transition as its own entry
+    assert len(per) == 3, len(per)
+    data = per._memory.get(np.arange(3))
+    np.testing.assert_allclose(data['reward'], [1.75, 1.5, 1])
+    np.testing.assert_allclose(data['steps'], [3, 2, 1])
+    np.testing.assert_allclose(data['next_obs'][:, 0], [3, 3, 3])
+    for t in range(4):
+      per.add(**_transition(t))
+    # a complete 3-step transition is stored once the window is full
+    assert len(per) == 4, len(per)
+
+  def test_n_step_transitions_of_multiple_envs(self):
+    per = _build_per(2)
+    for t in range(2):
+      per.add(**{k: np.stack([v, v]) for k, v in _transition(t).items()})
+    last = _transition(2, discount=0)
+    per.add(**{k: np.stack([v, v]) for k, v in last.items()})
+    assert len(per) == 6, len(per)
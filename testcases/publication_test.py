@@ -0,0 +1,87 @@
+import numpy as np
+
+from core.names import MODEL, TRAIN_STEP
+from core.typing import ModelPath, ModelWeights
+from distributed.common.publication import WeightPublisher, receive_weights
+
+
+def _params():
+  return {
+    'policy': {
+      'w': np.random.randn(128, 64).astype(np.float32), 
+      'b': np.zeros(64, np.float32),
+    },
+    'count': np.array(0, np.int32),
+  }
+
+
+def _update(params, scale=1e-2):
+  return {
+    'policy': {k: v + scale * np.random.randn(*v.shape).astype(v.dtype) 
+      for k, v in params['policy'].items()},
+    'count': params['count'] + 1,
+  }
+
+
+def _publish(publisher, receiver, params, versions, model, lossless=False):
+  mw = ModelWeights(model, {
+    MODEL: publisher.encode(params, lossless=lossless), TRAIN_STEP: 0})
+  if not receive_weights(mw, receiver, versions):
+    publisher.reset()
+    return False
+  receiver.update(mw.weights)
+  return True
+
+
+class TestClass:
+  def test_full_publication(self):
+    model = ModelPath('root', 'a0/i1-v1')
+    params = _params()
+    for dtype in [None, 'float16', 'bfloat16']:
+      publisher = WeightPublisher({'dtype': dtype})
+      receiver, versions = {}, {}
+      assert _publish(publisher, receiver, params, versions, model)
+      assert versions[model] == publisher.version == 1
+      w = receiver[MODEL]['policy']['w']
+      assert w.dtype == np.float32
+      if dtype is None:
+        np.testing.assert_array_equal(w, params['policy']['w'])
+      else:
+        np.testing.assert_allclose(w, params['policy']['w'], rtol=1e-2, atol=1e-2)
+        stats = publisher.get_stats()
+        assert stats['publish/bytes'] < .6 * stats['publish/raw_bytes'], stats
+      # lossless publication ignores quantization
+      assert _publish(publisher, receiver, params, versions, model, lossless=True)
+      np.testing.assert_array_equal(receiver[MODEL]['policy']['w'], params['policy']['w'])
+
+  def test_delta_publication(self):
+    model = ModelPath('root', 'a0/i1-v1')
+    publisher = WeightPublisher({'topk': .1, 'dtype': 'float16', 'full_interval': 50})
+    receiver, versions = {}, {}
+    params = _params()
+    assert _publish(publisher, receiver, params, versions, model)
+    publisher.get_stats()
+    for _ in range(20):
+      params = _update(params)
+      assert _publish(publisher, receiver, params, versions, model)
+      # the publisher tracks what the receiver holds
+      for x, y in zip(publisher._base, [receiver[MODEL]['count'], 
+          receiver[MODEL]['policy']['b'], receiver[MODEL]['policy']['w']]):
+        np.testing.assert_array_equal(x, y)
+    assert receiver[MODEL]['count'] == params['count']
+    stats = publisher.get_stats()
+    assert stats['publish/is_delta'] == 1
+    assert stats['publish/bytes_ratio'] < .2, stats
+    # dropped entries are carried over, so the error does not grow with versions
+    err = np.abs(receiver[MODEL]['policy']['w'] - params['policy']['w']).max()
+    assert err < .1, err
+    print(f'delta publication: bytes ratio {stats["publish/bytes_ratio"]:.3g}, '
+      f'max error {err:.3g}')
+
+    # a delta against a version the receiver does not hold is rejected
+    versions[model] = 0
+    assert not _publish(publisher, receiver, _update(params), versions, model)
+    params = _update(params)
+    assert _publish(publisher, receiver, params, versions, model)
+    np.testing.assert_allclose(
+      receiver[MODEL]['policy']['w'], params['policy']['w'], rtol=1e-2, atol=1e-2)
@@ -0,0 +1,179 @@
+import collections
+import pickle
+import tempfile
+import threading
+import numpy as np
+import pytest
+
+from replay.ds.episode_store import EpisodeStore
+from replay.ds import ring_buffer
+from replay.ds.ring_buffer import RingBuffer, MemmapRingBuffer
+from tools.prefetch import Prefetcher
+from tools.utils import batch_dicts
+
+
+def _traj(i):
+  return dict(
+    obs=np.ones((2, 3), np.float32) * i,
+    action=dict(a=np.int32(i), b=np.array([i, i], np.float32)),
+    reward=float(i),
+    name='ignored',
+  )
+
+
+class TestClass:
+  def test_fifo(self):
+    cap = 17
+    buf = RingBuffer(cap)
+    ref = collections.deque(maxlen=cap)
+    i = 0
+    for _ in range(20):
+      n = np.random.randint(1, cap)
+      trajs = [_traj(i+j) for j in range(n)]
+      i += n
+      _, popped = buf.pop_and_extend(trajs)
+      n_popped = max(0, len(ref) + n - cap)
+      expected = list(ref)[:n_popped]
+      ref.extend(trajs)
+      assert len(buf) == len(ref)
+      np.testing.assert_equal(
+        [p['reward'] for p in popped], [p['reward'] for p in expected])
+
+      idxes = np.random.randint(len(ref), size=8)
+      x = buf.get(buf.logical_idxes(idxes), keys=['obs', 'action', 'reward'])
+      y = batch_dicts([ref[i] for i in idxes], keys=['obs', 'action', 'reward'])
+      np.testing.assert_equal(x.obs, y.obs)
+      np.testing.assert_equal(x.action.a, y.action.a)
+      np.testing.assert_equal(x.action.b, y.action.b)
+      np.testing.assert_equal(x.reward, y.reward)
+      assert 'name' not in x
+
+    recent = buf.get(buf.prev_idxes(3))
+    np.testing.assert_equal(recent.reward, [i-3, i-2, i-1])
+
+  def test_grow(self, monkeypatch):
+    monkeypatch.setattr(ring_buffer, 'MIN_ROWS', 4)
+    buf = RingBuffer(10, grow=True)
+    buf.extend([_traj(i) for i in range(3)])
+    assert buf.get([0]).obs.shape == (1, 2, 3)
+    n_rows = lambda: len(buf._memory['reward'][0])
+    assert n_rows() == 4
+    buf.extend_batch(dict(reward=np.arange(3, 6, dtype=np.float32),
+      obs=np.ones((3, 2, 3), np.float32),
+      action=dict(a=np.arange(3, 6, dtype=np.int32),
+        b=np.ones((3, 2), np.float32))), 3)
+    assert n_rows() == 8
+    _, popped = buf.pop_and_extend([_traj(i) for i in range(6, 12)])
+    # arrays reach capacity before the buffer wraps around
+    assert n_rows() == 10
+    np.testing.assert_equal([p['reward'] for p in popped], [0, 1])
+    np.testing.assert_equal(
+      buf.get(buf.logical_idxes(np.arange(10))).reward, np.arange(2, 12))
+
+  def test_pickle(self):
+    buf = RingBuffer(10, precision=32)
+    buf.extend([_traj(i) for i in range(6)])
+    buf.extend([_traj(i) for i in range(6, 12)])
+    new_buf = pickle.loads(pickle.dumps(buf))
+    assert len(new_buf) == len(buf) == 10
+    assert new_buf.get([0]).reward.dtype == np.float32
+    np.testing.assert_equal(
+      new_buf.get(new_buf.logical_idxes(np.arange(10)), add_seq_axis=True).reward,
+      np.arange(2, 12)[:, None])
+
+  def test_memmap(self):
+    directory = tempfile.mkdtemp()
+    buf = MemmapRingBuffer(10, directory=directory, flush_period=None)
+    buf.extend([_traj(i) for i in range(7)])
+    buf.update_info(step=7)
+    buf.flush()
+    buf.extend([_traj(i) for i in range(7, 9)])   # not flushed
+
+    new_buf = MemmapRingBuffer(10, directory=directory, flush_period=None)
+    assert len(new_buf) == 7
+    assert new_buf.info['step'] == 7
+    x = new_buf.get(new_buf.logical_idxes(np.arange(7)))
+    np.testing.assert_equal(x.reward, np.arange(7))
+    np.testing.assert_equal(x.action.b[:, 0], np.arange(7))
+
+  def test_episode_store(self):
+    directory = tempfile.mkdtemp()
+    store = EpisodeStore(MemmapRingBuffer(
+      20, directory=directory, flush_period=None), max_episodes=3)
+    for i, epslen in enumerate([5, 8, 6, 9]):
+      store.add_episode(dict(reward=np.arange(epslen) + 100 * i))
+    # the first two episodes are evicted to make room for the last one
+    assert len(store) == 2 and store.n_transitions == 15
+    store.memory.flush()
+
+    store = EpisodeStore(MemmapRingBuffer(
+      20, directory=directory, flush_period=None), max_episodes=3)
+    starts, lengths = store.episodes(np.array([0, 1, 1]))
+    np.testing.assert_equal(lengths, [6, 9, 9])
+    x = store.get(starts, np.array([0, 0, 5]), 4)
+    np.testing.assert_equal(
+      x.reward, [[200, 201, 202, 203], [300, 301, 302, 303], [305, 306, 307, 308]])
+
+  def test_episode_windows(self):
+    store = EpisodeStore(RingBuffer(1000), max_episodes=5, seqlen=3)
+    epslens = np.random.randint(3, 20, size=50)
+    for i, epslen in enumerate(epslens):
+      store.add_episode(dict(eid=np.full(epslen, i), t=np.arange(epslen)))
+    assert len(store) == 5
+    assert store.n_transitions == np.sum(epslens[-5:])
+    assert store.n_windows == np.sum(epslens[-5:] - 2)
+
+    for balance in ['episode', 'window']:
+      starts, offsets = store.sample_windows(1000, n=2, balance=balance)
+      x = store.get(starts, offsets, 3)
+      np.testing.assert_array_less(44 + .5, x.eid)
+      np.testing.assert_equal(x.eid, np.repeat(x.eid[:, :1], 3, 1))
+      np.testing.assert_equal(np.diff(x.t), 1)
+      np.testing.assert_array_less(x.t, epslens[x.eid])
+
+  # without retries, every read takes the lock
+  @pytest.mark.parametrize('max_retries', [ring_buffer.MAX_READ_RETRIES, 0])
+  def test_concurrent_access(self, monkeypatch, max_retries):
+    monkeypatch.setattr(ring_buffer, 'MAX_READ_RETRIES', max_retries)
+    buf = RingBuffer(64)
+    buf.extend([_traj(0)])
+    n_writes = 2000
+    def write():
+      for i in range(1, n_writes):
+        buf.extend([_traj(i) for _ in range(np.random.randint(1, 8))])
+    writer = threading.Thread(target=write)
+    writer.start()
+    while writer.is_alive():
+      x = buf.get(np.random.randint(len(buf), size=16))
+      # every transition is written as a whole
+      np.testing.assert_equal(x.obs, x.reward[:, None, None] * np.ones((2, 3)))
+      np.testing.assert_equal(x.action.a, x.reward)
+      np.testing.assert_equal(x.action.b[:, 1], x.reward)
+    writer.join()
+
+  def test_prefetcher(self):
+    buf = RingBuffer(64)
+    def sample():
+      if len(buf) >= 8:
+        return buf.get(np.random.randint(len(buf), size=4))
+    prefetcher = Prefetcher(sample, 3, wait_time=1)
+    prefetcher.start()
+    buf.extend([_traj(i) for i in range(8)])
+    prefetcher.notify()
+    for _ in range(20):
+      x = prefetcher.get(timeout=5)
+      assert x.reward.shape == (4,)
+    stats = prefetcher.get_stats()
+    assert 0 <= stats['prefetch/queue_depth'] <= 3
+    prefetcher.stop()
+    assert not prefetcher.is_running()
+    # nothing produced before stopping is served afterwards
+    assert prefetcher._queue.empty()
+
+  def test_prefetcher_failure(self):
+    def sample():
+      raise ValueError('sampling failed')
+    prefetcher = Prefetcher(sample, 2)
+    with pytest.raises(ValueError, match='sampling failed'):
+      prefetcher.get(timeout=5)
+    prefetcher.stop()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from game.payoff import PayoffTable, SelfPlayPayoffTable
+from game.scheduler import EvaluationScheduler
+
+
+def _evaluate(table, sids, n_episodes, true_payoff, stds, self_play):
+  for sid in sids:
+    sid = tuple(sid)
+    s = np.random.normal(true_payoff[sid], stds[sid], size=n_episodes)
+    if self_play:
+      table.update_many([sid], [s.sum()], [n_episodes], [np.sum((s - s.mean())**2)])
+    else:
+      m2 = np.sum((s - s.mean())**2)
+      table.update_many([sid], [[s.sum(), -s.sum()]], [n_episodes], [[m2, m2]])
+
+
+class TestClass:
+  def test_adaptive_evaluation(self, tmp_path):
+    n = 8
+    max_episodes = 1000
+    true_payoff = np.random.uniform(-1, 1, size=(n, n))
+    true_payoff = true_payoff - true_payoff.T
+    # most profiles are nearly deterministic
+    stds = np.where(np.add.outer(np.arange(n), np.arange(n)) % n == 0, 1., .05)
+    for self_play in [False, True]:
+      for priority in ['ci', 'rank']:
+        if self_play:
+          table = SelfPlayPayoffTable(None, str(tmp_path), name=f'sp{priority}')
+          for _ in range(n):
+            table.expand()
+        else:
+          table = PayoffTable(2, None, str(tmp_path), name=f'{priority}')
+          for _ in range(n):
+            table.expand_all([0, 1])
+        scheduler = EvaluationScheduler(
+          .1, max_episodes=max_episodes, priority=priority,
+          meta_solver=dict(n_iterations=100))
+        n_episodes = 0
+        while True:
+          payoffs = table.get_payoffs()
+          sids = scheduler.schedule(payoffs, table.get_counts(),
+            table.get_confidence_intervals(), 4, self_play)
+          if len(sids) == 0:
+            break
+          assert len(sids) <= 4, sids
+          _evaluate(table, sids, scheduler.episodes_per_task, true_payoff, stds, self_play)
+          n_episodes += len(sids) * scheduler.episodes_per_task
+
+        cis = table.get_confidence_intervals()
+        counts = table.get_counts()
+        if self_play:
+          mask = ~np.eye(n, dtype=bool)
+          assert np.all(cis[mask] <= .1), cis
+          n_profiles = n * (n - 1) // 2
+        else:
+          assert all(np.all(ci <= .1) for ci in cis), cis
+          assert np.all(counts[0] >= scheduler.min_episodes)
+          n_profiles = n * n
+        # an order of magnitude fewer episodes than a fixed count per profile
+        assert n_episodes < n_profiles * max_episodes / 10, n_episodes
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+
+pytest.importorskip('pyspiel')
+from open_spiel.python.algorithms import exploitability, policy_aggregator
+
+from core.typing import AttrDict
+from env.openspiel import OpenSpiel
+from game.cfr import aggregate_policies
+from run.spiel_eval import JointPolicy, PolicyTableExtractor, RLPolicy, \
+  compute_nash_conv_stats
+
+
+class LinearAgent:
+  """ An agent whose actor computes logits linearly from observations """
+  def __init__(self, obs_dim, n_actions, seed):
+    self.w = np.random.default_rng(seed).normal(size=(obs_dim, n_actions))
+    self.actor = self
+
+  def __call__(self, inp, evaluation=False):
+    logits = np.asarray(inp['obs'], np.float32) @ self.w
+    return None, dict(mu_logits=logits), None
+
+
+def _config(root_dir, aid):
+  return AttrDict(root_dir=root_dir, model_name=f'agent{aid}', aid=aid)
+
+
+def _best_response_stats(game, joint_policy):
+  """ The statistics spiel_eval.main reports with tabular=False """
+  br1 = exploitability.best_response(game, joint_policy, 0)
+  br2 = exploitability.best_response(game, joint_policy, 1)
+  return dict(
+    nash_conv=(br1['nash_conv'] + br2['nash_conv']) / 2,
+    nash_conv1=br1['nash_conv'],
+    nash_conv2=br2['nash_conv'],
+    expl2=br1['best_response_value'],
+    expl1=br2['best_response_value'],
+    on_policy_value1=br1['on_policy_value'],
+    on_policy_value2=br2['on_policy_value'],
+  )
+
+
+class TestClass:
+  # illegal actions of leduc poker check that both paths renormalize
+  @pytest.mark.parametrize('game', ['kuhn_poker', 'leduc_poker'])
+  def test_tabular_nash_conv(self, game):
+    env = OpenSpiel(game, seed=0)
+    n_actions = env.game.num_distinct_actions()
+    obs_dim = env.game.information_state_tensor_size()
+    # two agents for every player, averaged as in spiel_eval.main
+    agents = [[LinearAgent(obs_dim, n_actions, 2 * aid + i) for i in range(2)]
+      for aid in range(2)]
+
+    root_dir = tempfile.mkdtemp()
+    cache_dir = os.path.join(tempfile.mkdtemp(), 'policy_tables')
+    extractor = PolicyTableExtractor(env, cache_dir=cache_dir)
+    tables = [[extractor.extract(_config(root_dir, aid), lambda: agent)
+      for agent in agents[aid]] for aid in range(2)]
+    stats = compute_nash_conv_stats(
+      extractor.tree, aggregate_policies(extractor.tree, tables))
+    # params are not saved, so nothing is cached or written
+    assert os.listdir(root_dir) == [] and not os.path.exists(cache_dir)
+
+    policies = [[RLPolicy(env, agent, aid) for agent in agents[aid]]
+      for aid in range(2)]
+    aggr_policy = policy_aggregator.PolicyAggregator(env.game).aggregate(
+      [0, 1], policies, [np.ones(2), np.ones(2)])
+    expected = _best_response_stats(env.game, aggr_policy)
+    for k, v in expected.items():
+      np.testing.assert_allclose(stats[k], v, atol=1e-6, err_msg=k)
+
+    # the latest policies
+    stats = compute_nash_conv_stats(
+      extractor.tree, aggregate_policies(extractor.tree, [ts[-1:] for ts in tables]))
+    joint_policy = JointPolicy(env, [agents[0][-1], agents[1][-1]])
+    expected = _best_response_stats(env.game, joint_policy)
+    for k, v in expected.items():
+      np.testing.assert_allclose(stats[k], v, atol=1e-6, err_msg=k)
+
+  def test_policy_table_cache(self):
+    env = OpenSpiel('kuhn_poker', seed=0)
+    agent = LinearAgent(
+      env.game.information_state_tensor_size(), env.game.num_distinct_actions(), 0)
+    root_dir = tempfile.mkdtemp()
+    config = _config(root_dir, 0)
+    params_path = os.path.join(root_dir, config.model_name, 'params.pkl')
+    os.makedirs(os.path.dirname(params_path))
+    def write_params(content):
+      with open(params_path, 'wb') as f:
+        f.write(content)
+    write_params(b'v1')
+    n_builds = []
+    def build_agent():
+      n_builds.append(1)
+      return agent
+
+    cache_dir = tempfile.mkdtemp()
+    table = PolicyTableExtractor(env, cache_dir=cache_dir).extract(config, build_agent)
+    np.testing.assert_allclose(table.sum(-1), 1)
+    # another process reuses the table cached on disk
+    extractor = PolicyTableExtractor(env, cache_dir=cache_dir)
+    np.testing.assert_array_equal(extractor.extract(config, build_agent), table)
+    assert len(n_builds) == 1
+    # rewriting the same params does not invalidate the cache
+    write_params(b'v1')
+    extractor.extract(config, build_agent)
+    assert len(n_builds) == 1
+    write_params(b'v2')
+    extractor.extract(config, build_agent)
+    assert len(n_builds) == 2
+    assert os.listdir(os.path.dirname(params_path)) == ['params.pkl']
@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+
+from core.typing import ModelPath
+from distributed.common.strategy_pool import StrategyPool
+
+
+def _model(i):
+  return ModelPath('logs', f'a0/i{i}-v{i}')
+
+
+def _params(i, mb=1):
+  return {'model': {'w': np.full(mb * 2**18, i, np.float32)}, 'train_step': i}
+
+
+class TestClass:
+  def test_lru_eviction(self):
+    loads = []
+    def load(model):
+      loads.append(model)
+      return _params(int(model.model_name[-1]))
+    pool = StrategyPool(load, max_size_mb=3)
+    for i in range(6):
+      pool.add(_model(i))
+    assert len(pool) == 6 and not loads
+    # the active model is pinned
+    pool[_model(9)] = _params(9)
+
+    for i in range(6):
+      assert pool[_model(i)]['train_step'] == i
+    assert len(loads) == 6
+    stats = pool.get_stats()
+    assert stats['n_resident'] == 3 and stats['resident_mb'] <= 3, stats
+    assert pool.is_resident(_model(9))
+    # recently used models stay resident
+    assert pool.is_resident(_model(5)) and not pool.is_resident(_model(0))
+    pool[_model(4)]
+    assert len(loads) == 6
+    pool[_model(0)]
+    assert len(loads) == 7 and not pool.is_resident(_model(3))
+
+    # unpinned models are evicted once saved
+    pool.unpin(_model(9))
+    pool[_model(1)], pool[_model(2)]
+    assert not pool.is_resident(_model(9))
+    assert set(pool) == {_model(i) for i in [0, 1, 2, 3, 4, 5, 9]}
+
+  def test_in_place_updates(self):
+    evicted = []
+    pool = StrategyPool(lambda m: _params(0), max_size_mb=2, on_evict=evicted.append)
+    # active models are inserted empty and filled in place
+    pool[_model(9)] = {}
+    pool[_model(9)].update(_params(9, mb=3))
+    pool.update_size(_model(9))
+    assert pool.get_stats()['resident_mb'] == 3
+    assert pool.is_resident(_model(9)) and not evicted
+    pool.unpin(_model(9))
+    assert not pool.is_resident(_model(9)) and evicted == [_model(9)]
+    assert pool.get_stats()['resident_mb'] == 0
+
+  def test_prefetch(self):
+    release = threading.Event()
+    def load(model):
+      release.wait()
+      return _params(int(model.model_name[-1]))
+    pool = StrategyPool(load, max_size_mb=10)
+    for i in range(4):
+      pool.add(_model(i))
+    futures = pool.prefetch([_model(1), _model(2)])
+    assert len(futures) == 2 and not pool.is_resident(_model(1))
+    release.set()
+    # waits for the load in flight rather than loading again
+    assert pool[_model(1)]['train_step'] == 1
+    futures[-1].result()
+    assert pool.is_resident(_model(2))
+    pool[_model(2)]
+    assert pool.n_loads == 2
@@ -0,0 +1,168 @@
+import time
+import numpy as np
+import pytest
+
+from core.typing import AttrDict, dict2AttrDict
+from env.cls import VecEnv
+from env.func import create_env
+from env.typing import EnvOutput
+
+
+class CountingEnv:
+  """ A two-agent env whose outputs are determined by eid and step """
+  def __init__(self, eid, max_episode_steps=5, sleep=0):
+    self.eid = eid
+    self.max_episode_steps = max_episode_steps
+    self._sleep = sleep
+    self._epslen = 0
+    self._score = 0
+
+  def stats(self):
+    return AttrDict(n_agents=2, n_units=2)
+
+  def random_action(self):
+    return [{'action': np.array([1])}, {'action': np.array([2])}]
+
+  def reset(self):
+    self._epslen = 0
+    self._score = 0
+    self._prev_output = self._output = self._make_output(0, 1, True)
+    return self._output
+
+  def step(self, action):
+    time.sleep(self._sleep)
+    self._epslen += 1
+    reward = float(action[0]['action'][0] + action[1]['action'][0])
+    self._score += reward
+    if self._epslen == self.max_episode_steps:
+      terminal = self._make_output(reward, 0, False)
+      self.reset()
+      self._prev_output = terminal
+      self._output = self._output._replace(reward=self._prev_output.reward, 
+        discount=self._prev_output.discount)
+    else:
+      self._prev_output = self._output = self._make_output(reward, 1, False)
+    return self._output
+
+  def output(self):
+    return self._output
+
+  def prev_output(self):
+    return self._prev_output
+
+  def prev_obs(self):
+    return self._prev_output.obs
+
+  def score(self):
+    return self._score
+
+  def epslen(self):
+    return self._epslen
+
+  def info(self):
+    return {'eid': self.eid}
+
+  def _make_output(self, reward, discount, reset):
+    obs = [{
+      'obs': np.full((1, 3), self.eid * 100 + self._epslen, np.float32),
+      'action_mask': np.ones((1, 2), bool),
+    } for _ in range(2)]
+    return EnvOutput(
+      obs,
+      [np.array([reward], np.float32)] * 2,
+      [np.array([discount], np.float32)] * 2,
+      [np.array([reset])] * 2,
+    )
+
+
+def make_counting_env(config, eid=None):
+  sleep = config.get('sleep', 0)
+  if config.get('slow_eids') and eid in config.slow_eids:
+    sleep *= 20
+  return CountingEnv(eid, sleep=sleep)
+
+
+def _assert_output_equal(x, y):
+  for xx, yy in zip(x, y):
+    for a, b in zip(xx, yy):
+      if isinstance(a, dict):
+        assert set(a) == set(b)
+        for k in a:
+          np.testing.assert_equal(a[k], b[k])
+      else:
+        np.testing.assert_equal(a, b)
+
+
+class TestClass:
+  def test_subproc_env(self):
+    config = dict2AttrDict(dict(env_name='counting', n_envs=5, seed=0))
+    env = VecEnv(config.copy(), make_counting_env)
+    sub_config = config.copy()
+    sub_config.update(vec_env='subproc', n_workers=2)
+    sub_env = create_env(sub_config, make_counting_env, reset_at_init=False)
+    try:
+      assert sub_env.n_envs == 5 and sub_env.stats().n_agents == 2
+      _assert_output_equal(env.reset(), sub_env.reset())
+      for _ in range(12):
+        action = env.random_action()
+        _assert_output_equal(env.step(action), sub_env.step(action))
+      assert env.score() == sub_env.score()
+      assert env.epslen([1, 4]) == sub_env.epslen([1, 4])
+      assert sub_env.info([3, 0]) == [{'eid': 3}, {'eid': 0}]
+      _assert_output_equal(env.reset([3, 1]), sub_env.reset([3, 1]))
+      _assert_output_equal(env.output(), sub_env.output())
+      assert isinstance(sub_env.output().obs[0], AttrDict)
+      # a failing worker leaves the replies of the others in sync
+      with pytest.raises(RuntimeError, match='worker 0'):
+        sub_env._call('step', [0, 4], [(None,), (CountingEnv(4).random_action(),)])
+      assert sub_env.info([3, 0]) == [{'eid': 3}, {'eid': 0}]
+    finally:
+      sub_env.close()
+
+  def test_subproc_env_speedup(self):
+    config = dict2AttrDict(dict(env_name='counting', n_envs=8, seed=0, sleep=.01))
+    env = VecEnv(config.copy(), make_counting_env)
+    sub_config = config.copy()
+    sub_config.update(vec_env='subproc', n_workers=8)
+    sub_env = create_env(sub_config, make_counting_env)
+    try:
+      action = env.random_action()
+      durations = []
+      for e in [env, sub_env]:
+        start = time.time()
+        for _ in range(20):
+          e.step(action)
+        durations.append(time.time() - start)
+      # 8 workers sleep in parallel
+      assert durations[1] < durations[0] / 2, durations
+    finally:
+      sub_env.close()
+
+  def test_subproc_env_async(self):
+    config = dict2AttrDict(dict(
+      env_name='counting', n_envs=6, seed=0, sleep=.005, slow_eids=[0, 1]))
+    env = VecEnv(config.copy(), make_counting_env)
+    sub_config = config.copy()
+    sub_config.update(vec_env='subproc', n_workers=3)
+    sub_env = create_env(sub_config, make_counting_env)
+    try:
+      action = env.random_action()
+      # envs 0 and 1 share the slow worker, the others keep stepping
+      sub_env.step_async(action)
+      counts = np.zeros(6, np.int32)
+      for _ in range(10):
+        out, idxes = sub_env.step_wait(min_ready=2)
+        assert len(idxes) >= 2 and len(idxes) % 2 == 0, idxes
+        assert set(sub_env.pending_idxes()).isdisjoint(idxes)
+        counts[idxes] += 1
+        for i, o in zip(idxes, out.obs[0].obs):
+          np.testing.assert_equal(o, i * 100 + counts[i] % 5)
+        sub_env.step_async(
+          [{k: v[:len(idxes)] for k, v in a.items()} for a in action], idxes)
+      assert counts[2:].min() > counts[:2].max(), counts
+      out, idxes = sub_env.step_wait()
+      assert sub_env.pending_idxes() == []
+      counts[idxes] += 1
+      np.testing.assert_equal(sub_env.epslen(), counts % 5)
+    finally:
+      sub_env.close()
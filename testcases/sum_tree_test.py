@@ -0,0 +1,68 @@
+import time
+import numpy as np
+
+from replay.ds.sum_tree import SumTree, LevelSumTree
+
+
+def _time(fn, n=10):
+  start = time.time()
+  for _ in range(n):
+    fn()
+  return (time.time() - start) / n
+
+
+class TestClass:
+  def test_level_sum_tree(self):
+    for _ in range(10):
+      cap = np.random.randint(10, 100)
+      st1 = SumTree(cap)
+      st2 = LevelSumTree(cap)
+
+      sz = np.random.randint(5, cap+1)
+      priorities = np.random.uniform(.1, 1, size=sz)
+      st1.batch_update(np.arange(sz), priorities)
+      st2.batch_update(np.arange(sz), priorities)
+      np.testing.assert_allclose(st1.total_priorities, st2.total_priorities)
+      np.testing.assert_allclose(st2.min_priority, np.min(priorities))
+
+      bs = np.random.randint(2, sz)
+      intervals = np.linspace(0, st1.total_priorities, bs+1)
+      values = np.random.uniform(intervals[:-1], intervals[1:])
+      idx1 = np.searchsorted(np.cumsum(priorities), values)
+      p2, idx2 = st2.batch_find(values)
+      np.testing.assert_allclose(priorities[idx1], p2)
+      np.testing.assert_equal(idx1, idx2)
+
+      p, idxes = st2.stratified_find(bs)
+      np.testing.assert_array_less(idxes, sz)
+      np.testing.assert_equal(np.diff(idxes) >= 0, True)
+      np.testing.assert_allclose(p, priorities[idxes])
+
+      # updates with duplicate indices
+      idxes = np.random.randint(sz, size=2*sz)
+      new_priorities = np.random.uniform(.1, 1, size=2*sz)
+      st2.batch_update(idxes, new_priorities)
+      priorities[idxes] = new_priorities
+      np.testing.assert_allclose(st2.total_priorities, np.sum(priorities))
+      np.testing.assert_allclose(st2.min_priority, np.min(priorities))
+
+
+def benchmark():
+  """ Times SumTree and LevelSumTree, run by python -m testcases.sum_tree_test """
+  cap = int(1e6)
+  for bs in [256, 4096, 16384]:
+    for Tree in [SumTree, LevelSumTree]:
+      st = Tree(cap)
+      st.batch_update(np.arange(cap), np.random.uniform(.1, 1, size=cap))
+      idxes = np.random.randint(cap, size=bs)
+      priorities = np.random.uniform(.1, 1, size=bs)
+      values = np.random.uniform(0, st.total_priorities, size=bs)
+      update_time = _time(lambda: st.batch_update(idxes, priorities))
+      find_time = _time(lambda: st.batch_find(values))
+      print(f'{Tree.__name__}(capacity={cap}, batch_size={bs}): '
+        f'batch_update {update_time*1000:.3g}ms, '
+        f'batch_find {find_time*1000:.3g}ms')
+
+
+if __name__ == '__main__':
+  benchmark()
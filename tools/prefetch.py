@@ -0,0 +1,126 @@
+import atexit
+import queue
+import threading
+import time
+
+from tools.log import do_logging
+
+
+class _Failure:
+  """ Carries an exception raised by produce_fn to the consumer """
+  def __init__(self, error: Exception):
+    self.error = error
+
+
+class Prefetcher:
+  """ Keeps up to depth results of produce_fn queued by a background thread
+
+  Args:
+    produce_fn: a function returning the next item, or None if no item
+      is available yet
+    depth: the maximum number of queued items
+    name: name used in stats
+    wait_time: how long the thread waits for notify when produce_fn
+      returns None
+  """
+  def __init__(self, produce_fn, depth=2, name='prefetch', wait_time=.1):
+    self._produce_fn = produce_fn
+    self._depth = depth
+    self._name = name
+    self._wait_time = wait_time
+
+    self._queue = queue.Queue(maxsize=depth)
+    self._data_event = threading.Event()
+    self._stop_event = threading.Event()
+    self._thread = None
+
+    self._n_gets = 0
+    self._n_starved = 0
+    self._starved_time = 0
+    self._depth_sum = 0
+
+  @property
+  def depth(self):
+    return self._depth
+
+  def is_running(self):
+    return self._thread is not None and self._thread.is_alive()
+
+  def start(self):
+    if self.is_running():
+      return
+    self._stop_event.clear()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+    # stops the thread before the interpreter, and jax, tears down
+    atexit.register(self.stop)
+
+  def stop(self):
+    if not self.is_running():
+      return
+    self._stop_event.set()
+    self._data_event.set()
+    # the producer gives up putting within wait_time once stopped
+    self._thread.join()
+    self._thread = None
+    # drops items produced before the thread stopped
+    while not self._queue.empty():
+      self._queue.get_nowait()
+    atexit.unregister(self.stop)
+
+  def notify(self):
+    """ Wakes up the thread waiting for new data """
+    self._data_event.set()
+
+  def get(self, timeout=None):
+    """ Returns the next item, blocking until one is produced. Exceptions
+    raised by produce_fn are re-raised here """
+    self.start()
+    qsize = self._queue.qsize()
+    self._depth_sum += qsize
+    self._n_gets += 1
+    if qsize == 0:
+      self._n_starved += 1
+      start = time.time()
+      item = self._queue.get(timeout=timeout)
+      self._starved_time += time.time() - start
+    else:
+      item = self._queue.get()
+    if isinstance(item, _Failure):
+      raise item.error
+    return item
+
+  def get_stats(self, reset=True):
+    n = max(self._n_gets, 1)
+    stats = {
+      f'{self._name}/queue_depth': self._depth_sum / n,
+      f'{self._name}/starved_frac': self._n_starved / n,
+      f'{self._name}/starved_time': self._starved_time,
+    }
+    if reset:
+      self._n_gets = 0
+      self._n_starved = 0
+      self._starved_time = 0
+      self._depth_sum = 0
+    return stats
+
+  def _run(self):
+    while not self._stop_event.is_set():
+      try:
+        item = self._produce_fn()
+      except Exception as e:
+        do_logging(f'{self._name} failed: {e}', level='error')
+        # the thread exits after handing the exception to get
+        item = _Failure(e)
+      if item is None:
+        self._data_event.wait(self._wait_time)
+        self._data_event.clear()
+        continue
+      while not self._stop_event.is_set():
+        try:
+          self._queue.put(item, timeout=self._wait_time)
+          break
+        except queue.Full:
+          pass
+      if isinstance(item, _Failure):
+        return